@@ -0,0 +1,783 @@
+import argparse
+import hashlib
+import os
+import random
+import selectors
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from protocol import (
+    MessageType, MessageReader, create_message, create_handshake_message, parse_message,
+    create_file_offer, create_ping_message, create_typing_message, MESSAGE_DELIMITER
+)
+from search_index import SearchIndex
+from heartbeat import IdleReaper
+from file_transfer import upload_file, download_file
+from simulation import Simulation
+from ephemeral import EVENT_WINDOW
+from outbound import OutboundScheduler, CHAT
+from fanout import SharedFanout
+
+HOST = '127.0.0.1'
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+def wait_for_port(host: str, port: int, timeout: float = 15.0):
+    """Block until something accepts connections on host:port"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Nothing listening on {host}:{port}")
+
+def start_server(port: int, *extra_args, cwd: str = None) -> subprocess.Popen:
+    """Launch server.py in its own process and wait until it accepts clients"""
+    process = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, '--port', str(port), *extra_args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=cwd
+    )
+    wait_for_port(HOST, port)
+    return process
+
+def stop_servers(processes):
+    """Stop servers the way Ctrl-C does, so their worker processes exit too"""
+    for process in processes:
+        process.send_signal(signal.SIGINT)
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def connect_client(host: str, port: int, username: str):
+    """Connect and complete the handshake; returns (socket, reader)"""
+    sock = socket.create_connection((host, port), timeout=10)
+    reader = MessageReader(sock)
+    sock.sendall(create_handshake_message(MessageType.HELLO))
+    if parse_message(reader.read_message())["type"] != MessageType.HELLO_ACK.value:
+        raise ConnectionError("Handshake failed")
+    sock.sendall(create_message(MessageType.USERNAME, username, username))
+    if parse_message(reader.read_message())["type"] != MessageType.USERNAME_ACK.value:
+        raise ConnectionError("Username not accepted")
+    sock.settimeout(None)
+    return sock, reader
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def run_chat_load(ports, clients_per_port: int, messages: int, timeout: float = 60.0,
+                  interval: float = 0.0) -> dict:
+    """Spread clients over ports, have each send messages, and time delivery to everyone else.
+
+    interval paces each sender; with the default of 0 they send flat out.
+    """
+    clients = []
+    for port in ports:
+        for i in range(clients_per_port):
+            clients.append(connect_client(HOST, port, f"bench{port}_{i}"))
+    expected = messages * (len(clients) - 1)
+    latencies = []
+    duplicates = [0]
+    lock = threading.Lock()
+
+    def receive(reader):
+        seen = set()
+        while len(seen) < expected:
+            try:
+                message = reader.read_message()
+            except socket.timeout:
+                return  # Counted as undelivered
+            if message is None:
+                return
+            data = parse_message(message)
+            if data["type"] != MessageType.CHAT.value:
+                continue
+            received = time.perf_counter()
+            if data["content"] in seen:
+                with lock:
+                    duplicates[0] += 1
+                continue
+            seen.add(data["content"])
+            with lock:
+                latencies.append(received - float(data["content"].split('|')[1]))
+
+    def send(sock, index):
+        for n in range(messages):
+            content = f"{index}:{n}|{time.perf_counter()}"
+            sock.sendall(create_message(MessageType.CHAT, f"bench{index}", content))
+            if interval:
+                time.sleep(interval)
+
+    for sock, _ in clients:
+        sock.settimeout(timeout)
+
+    # Let presence traffic from the connects settle before timing
+    time.sleep(0.5)
+    receivers = [threading.Thread(target=receive, args=(reader,), daemon=True)
+                 for _, reader in clients]
+    for thread in receivers:
+        thread.start()
+    start = time.perf_counter()
+    senders = [threading.Thread(target=send, args=(sock, i)) for i, (sock, _) in enumerate(clients)]
+    for thread in senders:
+        thread.start()
+    for thread in senders + receivers:
+        thread.join(timeout)
+    elapsed = time.perf_counter() - start
+    for sock, _ in clients:
+        sock.close()
+
+    return {
+        'clients': len(clients),
+        'delivered': len(latencies),
+        'expected': expected * len(clients),
+        'duplicates': duplicates[0],
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'mean_ms': statistics.mean(latencies) * 1000 if latencies else 0.0,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else 0.0,
+        'max_ms': max(latencies) * 1000 if latencies else 0.0,
+    }
+
+def print_result(label: str, result: dict):
+    print(f"{label}: {result['delivered']}/{result['expected']} delivered "
+          f"({result['duplicates']} duplicates) in {result['seconds']:.2f}s, "
+          f"{result['throughput']:.0f} msg/s, mean {result['mean_ms']:.2f} ms, "
+          f"p99 {result['p99_ms']:.2f} ms")
+
+def benchmark_federation(nodes: int, clients_per_node: int, messages: int, base_port: int):
+    """Compare one server against a federated mesh of localhost nodes"""
+    with tempfile.TemporaryDirectory() as directory:
+        single = [start_server(base_port, cwd=directory)]
+        try:
+            print_result("1 node", run_chat_load([base_port], clients_per_node * nodes, messages))
+        finally:
+            stop_servers(single)
+
+        ports = [base_port + i for i in range(nodes)]
+        peer_ports = [port + 1000 for port in ports]
+        processes = []
+        try:
+            for i, port in enumerate(ports):
+                # Each node dials the ones started before it, giving a full mesh
+                peers = ','.join(f"{HOST}:{peer_port}" for peer_port in peer_ports[:i])
+                processes.append(start_server(
+                    port, '--node-id', f"node{i}", '--peer-port', str(peer_ports[i]),
+                    '--peers', peers, cwd=directory
+                ))
+            time.sleep(2.0)  # Links come up asynchronously
+            print_result(f"{nodes} nodes", run_chat_load(ports, clients_per_node, messages))
+        finally:
+            stop_servers(processes)
+
+def benchmark_workers(max_workers: int, clients: int, messages: int, port: int):
+    """Measure message throughput as SO_REUSEPORT workers are added"""
+    for workers in sorted({1, max_workers}):
+        with tempfile.TemporaryDirectory() as directory:
+            processes = [start_server(port, '--workers', str(workers), cwd=directory)]
+            try:
+                time.sleep(1.0 + 0.5 * workers)  # Let the worker bus links come up
+                print_result(f"{workers} workers", run_chat_load([port], clients, messages))
+            finally:
+                stop_servers(processes)
+
+def benchmark_search(messages: int, queries: int):
+    """Time indexed search against scanning a log file for the same words"""
+    rng = random.Random(42)
+    words = [f"word{i}" for i in range(5000)]
+    users = [f"user{i}" for i in range(50)]
+    with tempfile.TemporaryDirectory() as directory:
+        index = SearchIndex(os.path.join(directory, 'search_index.jsonl'))
+        log_path = os.path.join(directory, 'chat_log.txt')
+        start = time.perf_counter()
+        with open(log_path, 'w', encoding='utf-8') as log:
+            for n in range(messages):
+                # Skewed word choice so some words are common and most are rare
+                content = ' '.join(words[int(rng.paretovariate(1.2)) % len(words)] for _ in range(8))
+                username = rng.choice(users)
+                index.add(username, content, date=f"2025-05-{1 + n * 28 // messages:02d}")
+                log.write(f"[00:00:00] {username}: {content}\n")
+        print(f"Indexed {messages} messages in {time.perf_counter() - start:.2f}s")
+
+        samples = [f"{rng.choice(words[:50])} {rng.choice(words)}" for _ in range(queries)]
+        start = time.perf_counter()
+        hits = sum(len(index.search(query)) for query in samples)
+        indexed = (time.perf_counter() - start) / queries
+        start = time.perf_counter()
+        for query in samples[:5]:
+            terms = query.split()
+            with open(log_path, encoding='utf-8') as log:
+                [line for line in log if all(f" {term}" in line for term in terms)]
+        scanned = (time.perf_counter() - start) / 5
+        index.close()
+    print(f"Indexed search: {indexed * 1000:.2f} ms/query ({hits} hits over {queries} queries)")
+    print(f"Log scan:       {scanned * 1000:.2f} ms/query")
+
+def benchmark_files(size_mb: int, clients: int, messages: int, port: int):
+    """Chat latency on its own, then while a large file is uploaded and downloaded"""
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'payload.bin')
+        with open(source, 'wb') as f:
+            f.truncate(size_mb * 1024 * 1024)
+        processes = [start_server(port, cwd=directory)]
+        try:
+            print_result("Chat alone", run_chat_load([port], clients, messages, interval=0.005))
+
+            sock, reader = connect_client(HOST, port, "uploader")
+            sock.sendall(create_file_offer("uploader", "payload.bin", size_mb * 1024 * 1024))
+            while True:
+                offer = parse_message(reader.read_message())
+                if offer["type"] == MessageType.FILE_OFFER.value:
+                    break
+            file_address = (HOST, offer["port"])
+            timings = {}
+
+            def transfer():
+                start = time.perf_counter()
+                upload_file(file_address, offer["file_id"], source)
+                timings['upload'] = time.perf_counter() - start
+                start = time.perf_counter()
+                download_file(file_address, offer["file_id"], os.path.join(directory, 'downloads'))
+                timings['download'] = time.perf_counter() - start
+
+            mover = threading.Thread(target=transfer)
+            mover.start()
+            time.sleep(0.2)  # Make sure the transfer is under way
+            print_result(f"Chat during {size_mb} MB transfer",
+                         run_chat_load([port], clients, messages, interval=0.005))
+            mover.join()
+            sock.close()
+            for direction, seconds in timings.items():
+                print(f"{direction.title()}: {seconds:.2f}s ({size_mb / seconds:.0f} MB/s)")
+        finally:
+            stop_servers(processes)
+
+def benchmark_handoff(clients: int, messages: int, port: int):
+    """Hand a loaded server over to a new process and measure the pause clients see"""
+    with tempfile.TemporaryDirectory() as directory:
+        handoff_path = os.path.join(directory, 'handoff.sock')
+        processes = [start_server(port, '--handoff', handoff_path, cwd=directory)]
+        try:
+            steady = run_chat_load([port], clients, messages, interval=0.02)
+            print_result("Chat without a handoff", steady)
+            print(f"Worst delivery latency: {steady['max_ms']:.1f} ms")
+            results = {}
+            load = threading.Thread(target=lambda: results.update(
+                run_chat_load([port], clients, messages, interval=0.02)
+            ))
+            load.start()
+            time.sleep(2.0)  # Connected and sending steadily
+            start = time.perf_counter()
+            processes.append(subprocess.Popen(
+                [sys.executable, SERVER_SCRIPT, '--port', str(port), '--handoff', handoff_path,
+                 '--take-over'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=directory
+            ))
+            processes[0].wait(timeout=30)
+            print(f"Old server exited {time.perf_counter() - start:.2f}s after the new one started")
+            load.join()
+            print_result("Chat across the handoff", results)
+            print(f"Worst delivery latency: {results['max_ms']:.1f} ms")
+        finally:
+            stop_servers(processes[1:])
+
+def run_accept_storm(port: int, connections: int, timeout: float = 30.0) -> dict:
+    """Open connections all at once and time each until the server answers its HELLO"""
+    selector = selectors.DefaultSelector()
+    hello = create_handshake_message(MessageType.HELLO)
+    started = {}
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(connections):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex((HOST, port))
+        started[sock] = time.perf_counter()
+        selector.register(sock, selectors.EVENT_WRITE)
+
+    deadline = start + timeout
+    remaining = connections
+    while remaining and time.perf_counter() < deadline:
+        for key, events in selector.select(timeout=max(0.0, deadline - time.perf_counter())):
+            sock = key.fileobj
+            if events & selectors.EVENT_WRITE:
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    sock.send(hello)
+                    selector.modify(sock, selectors.EVENT_READ)
+                    continue
+            elif sock.recv(4096).endswith(MESSAGE_DELIMITER):
+                latencies.append(time.perf_counter() - started[sock])
+            selector.unregister(sock)
+            remaining -= 1
+    elapsed = time.perf_counter() - start
+    selector.close()
+    for sock in started:
+        sock.close()
+    return {
+        'connections': connections,
+        'answered': len(latencies),
+        'seconds': elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000 if latencies else 0.0,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else 0.0,
+        'max_ms': max(latencies) * 1000 if latencies else 0.0,
+    }
+
+def benchmark_accept(connections: int, port: int):
+    """Reconnect storm and chat latency with the old listener settings and the tuned ones"""
+    profiles = [
+        ("listen(5), one accept per wakeup, Nagle on",
+         ['--backlog', '5', '--accept-batch', '1', '--no-nodelay', '--no-keepalive']),
+        ("Tuned defaults", []),
+    ]
+    for label, extra_args in profiles:
+        with tempfile.TemporaryDirectory() as directory:
+            processes = [start_server(port, *extra_args, cwd=directory)]
+            try:
+                storm = run_accept_storm(port, connections)
+                print(f"{label}: {storm['answered']}/{storm['connections']} connections answered "
+                      f"in {storm['seconds']:.2f}s, p50 {storm['p50_ms']:.1f} ms, "
+                      f"p99 {storm['p99_ms']:.1f} ms, max {storm['max_ms']:.1f} ms")
+                time.sleep(1.0)  # Let the server reap the storm's connections
+                print_result("  chat", run_chat_load([port], 4, 200, interval=0.005))
+            finally:
+                stop_servers(processes)
+
+class PingedSocket:
+    """Stands in for a live client connection in the reaper benchmark"""
+    def __init__(self):
+        self.pinged = False
+
+    def send(self, data, flags=0):
+        self.pinged = True
+        return len(data)
+
+    def shutdown(self, how):
+        pass
+
+def benchmark_reaper(connections: int, seconds: int, active: float):
+    """Per-tick cost of idle detection with the timer wheel and with a full scan.
+
+    Connections arrive spread over the first idle timeout, a fraction of
+    them send something every second, and the rest answer pings.
+    """
+    rng = random.Random(7)
+    clock = [0.0]
+    reaper = IdleReaper(ping_interval=30, idle_timeout=90, clock=lambda: clock[0])
+    sockets = [PingedSocket() for _ in range(connections)]
+    joining = iter(sockets)
+    warmup = int(reaper.idle_timeout)
+    wheel_ticks = []
+    scan_ticks = []
+    dropped = 0
+    for second in range(warmup + seconds):
+        clock[0] += 1.0
+        if second < warmup:
+            for sock in [next(joining) for _ in range(connections // warmup)]:
+                reaper.watch(sock, logged_in=True)
+        for sock in rng.sample(sockets, int(connections * active)):
+            if sock in reaper.last_activity:
+                reaper.touch(sock)
+        start = time.perf_counter()
+        dropped += len(reaper.check())
+        elapsed = time.perf_counter() - start
+        for sock in sockets:
+            if sock.pinged:
+                sock.pinged = False
+                reaper.touch(sock)  # The PONG
+        # The same decision made by sweeping every connection each tick
+        start = time.perf_counter()
+        now = clock[0]
+        for sock, last in list(reaper.last_activity.items()):
+            idle = now - last
+            if idle >= reaper.idle_timeout or idle >= reaper.ping_interval:
+                pass
+        if second >= warmup:
+            wheel_ticks.append(elapsed)
+            scan_ticks.append(time.perf_counter() - start)
+    print(f"{len(reaper.last_activity)} connections, {active:.0%} sending each second, "
+          f"{dropped} dropped")
+    print(f"Timer wheel: mean {statistics.mean(wheel_ticks) * 1000:.3f} ms/tick, "
+          f"max {max(wheel_ticks) * 1000:.3f} ms")
+    print(f"Full scan:   mean {statistics.mean(scan_ticks) * 1000:.3f} ms/tick, "
+          f"max {max(scan_ticks) * 1000:.3f} ms")
+
+def measure_control_latency(port: int, seconds: float) -> dict:
+    """Time PING round trips and fresh handshakes against a server until seconds have passed"""
+    sock, reader = connect_client(HOST, port, "probe")
+    pong = threading.Event()
+
+    def receive():
+        while True:
+            try:
+                message = reader.read_message()
+            except OSError:
+                return
+            if message is None:
+                return
+            if parse_message(message)["type"] == MessageType.PONG.value:
+                pong.set()
+
+    threading.Thread(target=receive, daemon=True).start()
+    pings = []
+    handshakes = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pong.clear()
+        start = time.perf_counter()
+        sock.sendall(create_ping_message())
+        if pong.wait(10):
+            pings.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        newcomer, _ = connect_client(HOST, port, "newcomer")
+        handshakes.append(time.perf_counter() - start)
+        newcomer.close()
+        time.sleep(0.02)
+    sock.close()
+    return {'pings': pings, 'handshakes': handshakes}
+
+def print_latencies(label: str, samples: list):
+    print(f"  {label}: {len(samples)} samples, p50 {percentile(samples, 0.5) * 1000:.1f} ms, "
+          f"p99 {percentile(samples, 0.99) * 1000:.1f} ms, max {max(samples) * 1000:.1f} ms")
+
+def benchmark_priority(flooders: int, listeners: int, messages: int, port: int):
+    """Control-message latency idle and under a chat flood, with and without priority lanes.
+
+    Flooders send chat flat out to everyone while listeners only read. A
+    probe meanwhile pings the server and opens new connections, timing
+    the PONG and the handshake acks.
+    """
+    for label, extra_args in (("Single FIFO lane", ['--no-priority-lanes']),
+                              ("Priority lanes", [])):
+        with tempfile.TemporaryDirectory() as directory:
+            processes = [start_server(port, *extra_args, cwd=directory)]
+            try:
+                idle = measure_control_latency(port, 2.0)
+                clients = [connect_client(HOST, port, f"flood{i}")
+                           for i in range(flooders + listeners)]
+                received = [0]
+
+                def drain(reader):
+                    while True:
+                        try:
+                            message = reader.read_message()
+                        except OSError:
+                            return
+                        if message is None:
+                            return
+                        received[0] += 1
+
+                def flood(sock, index):
+                    for n in range(messages):
+                        sock.sendall(create_message(MessageType.CHAT, f"flood{index}", f"{index}:{n}"))
+
+                for _, reader in clients:
+                    threading.Thread(target=drain, args=(reader,), daemon=True).start()
+                senders = [threading.Thread(target=flood, args=(sock, i), daemon=True)
+                           for i, (sock, _) in enumerate(clients[:flooders])]
+                start = time.perf_counter()
+                for thread in senders:
+                    thread.start()
+                time.sleep(0.5)  # Let queues build up
+                loaded = measure_control_latency(port, 3.0)
+                for thread in senders:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+                for sock, _ in clients:
+                    sock.close()
+            finally:
+                stop_servers(processes)
+        print(f"{label}: {received[0]} chat deliveries in {elapsed:.1f}s")
+        print_latencies("PING idle    ", idle['pings'])
+        print_latencies("PING flooded ", loaded['pings'])
+        print_latencies("Join idle    ", idle['handshakes'])
+        print_latencies("Join flooded ", loaded['handshakes'])
+
+def benchmark_simulation(clients: int, senders: int, messages: int, runs: int):
+    """Fan-out through the in-process simulation harness, with no ports or server process.
+
+    Every run processes the same messages in the same order; the digest of
+    what the last client received shows it.
+    """
+    for run in range(runs):
+        with Simulation() as simulation:
+            start = time.perf_counter()
+            members = [simulation.connect(f"user{i}") for i in range(clients)]
+            simulation.deliver()
+            joined = time.perf_counter() - start
+            for i in range(messages):
+                for client in members[:senders]:
+                    client.chat(f"{client.username} message {i}", msg_id=f"{client.username}-{i}")
+            start = time.perf_counter()
+            handled = simulation.run()
+            elapsed = time.perf_counter() - start
+            deliveries = sum(len(client.messages(MessageType.CHAT)) for client in members)
+            digest = hashlib.sha256()
+            for msg in members[-1].messages(MessageType.CHAT):
+                digest.update(msg["content"].encode('utf-8'))
+        print(f"Run {run + 1}: {clients} clients joined in {joined:.2f}s; {handled} messages, "
+              f"{deliveries} deliveries in {elapsed:.2f}s ({deliveries / elapsed:.0f}/s), "
+              f"order {digest.hexdigest()[:12]}")
+
+def benchmark_fanout(rooms: list, helper_counts: list, messages: int):
+    """Time to hand one chat message to every member of a room.
+
+    Members are local socketpairs nobody reads from, so messages is kept
+    small enough for the socket buffers to hold them all. Each helper
+    process needs its own copy of the room's sockets, so the largest room
+    is limited by the open file limit.
+    """
+    message = create_message(MessageType.CHAT, "bench", "x" * 100)
+    for size in rooms:
+        results = []
+        fanouts = [(helpers, SharedFanout(helpers)) for helpers in helper_counts]  # Fork before the room exists
+        pairs = [socket.socketpair() for _ in range(size)]
+        members = [server_end for server_end, _ in pairs]
+        try:
+            start = time.perf_counter()
+            for _ in range(messages):
+                for sock in members:
+                    sock.sendall(message)
+            results.append(("sendall loop", time.perf_counter() - start))
+            scheduler = OutboundScheduler(threads=(os.cpu_count() or 1) * 2)
+            for sock in members:
+                scheduler.register(sock)
+            scheduler.start()
+            start = time.perf_counter()
+            for _ in range(messages):
+                scheduler.send_many(members, message, CHAT)
+            scheduler.stop()
+            results.append(("OutboundScheduler", time.perf_counter() - start))
+            for helpers, fanout in fanouts:
+                for sock in members:
+                    fanout.register(sock)
+                    fanout.add_member(sock)
+                fanout.flush()
+                start = time.perf_counter()
+                for _ in range(messages):
+                    fanout.broadcast(message)
+                fanout.flush()
+                results.append((f"SharedFanout x{helpers}", time.perf_counter() - start))
+                fanout.stop()
+        finally:
+            for server_end, client_end in pairs:
+                server_end.close()
+                client_end.close()
+        print(f"Room of {size}, {messages} messages:")
+        for label, elapsed in results:
+            print(f"  {label:20} {elapsed / messages * 1000:8.2f} ms/message, "
+                  f"{size * messages / elapsed:9.0f} deliveries/s")
+
+def benchmark_typing(clients: int, typists: int, rate: int, seconds: int):
+    """Cost of a typing indicator storm, through the simulation harness.
+
+    Each typist sends rate events a second on the virtual clock, as a
+    client that sent one per keystroke would. The same run is repeated
+    with a zero window, so every event is broadcast. Times include the
+    simulated clients reading what they are sent.
+    """
+    for label, window in (("coalesced", EVENT_WINDOW), ("every event", 0.0)):
+        with Simulation() as simulation:
+            simulation.server.events.window = window
+            members = [simulation.connect(f"user{i}") for i in range(clients)]
+            simulation.run()
+            events = 0
+            elapsed = 0.0
+            tick = 1.0 / rate
+            for _ in range(seconds * rate):
+                for client in members[:typists]:
+                    client.send(create_typing_message(client.username, True))
+                events += typists
+                start = time.perf_counter()
+                simulation.advance(tick)
+                elapsed += time.perf_counter() - start
+            deliveries = sum(len(client.messages(MessageType.TYPING)) for client in members)
+        print(f"{label:12} {typists} of {clients} clients typing at {rate} events/s for {seconds}s: "
+              f"{events} events, {deliveries} deliveries, {elapsed / events * 1e6:.1f} us/event")
+
+class ReplaySocket:
+    """Serves a fixed byte string through recv/recv_into, like a socket whose peer sent it"""
+    def __init__(self, data: bytes, max_read: int = 65536):
+        self.data = memoryview(data)
+        self.position = 0
+        self.max_read = max_read
+
+    def recv(self, size: int) -> bytes:
+        size = min(size, self.max_read)
+        chunk = bytes(self.data[self.position:self.position + size])
+        self.position += len(chunk)
+        return chunk
+
+    def recv_into(self, view, size: int = 0) -> int:
+        size = min(size or len(view), self.max_read, len(self.data) - self.position)
+        view[:size] = self.data[self.position:self.position + size]
+        self.position += size
+        return size
+
+class LegacyReader:
+    """The receive path before MessageReader used recv_into, kept for comparison"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b""
+
+    def read_frame(self) -> bytes:
+        while MESSAGE_DELIMITER not in self.buffer:
+            chunk = self.sock.recv(1024)
+            if not chunk:
+                return None
+            self.buffer += chunk
+        message, _, self.buffer = self.buffer.partition(MESSAGE_DELIMITER)
+        return message
+
+def benchmark_receive(messages: int):
+    """Compare per-message time, transient allocation and memory held per connection of the two receive paths"""
+    stream = b"".join(
+        create_message(MessageType.CHAT, f"user{n % 50}", f"message number {n} " * 4, "12:00:00")
+        for n in range(messages)
+    )
+    for label, reader_class in (("recv + concat", LegacyReader), ("recv_into + memoryview", MessageReader)):
+        reader = reader_class(ReplaySocket(stream))
+        start = time.perf_counter()
+        while (frame := reader.read_frame()) is not None:
+            parse_message(frame)
+        per_message = (time.perf_counter() - start) / messages
+
+        # Second pass under tracemalloc: the high-water mark of memory
+        # allocated while receiving each frame (parsing is the same for both)
+        reader = reader_class(ReplaySocket(stream))
+        tracemalloc.start()
+        peaks = []
+        while True:
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            frame = reader.read_frame()
+            if frame is None:
+                break
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+            del frame
+        tracemalloc.stop()
+        print(f"{label:24} {per_message * 1e6:6.2f} us/message, "
+              f"{statistics.mean(peaks):7.0f} bytes allocated/message (mean peak), "
+              f"{percentile(peaks, 0.99):6.0f} p99")
+
+    # What each connection keeps between messages: read everything it was
+    # sent, then hold on to the reader the way an idle handler does
+    big = create_message(MessageType.CHAT, "user0", "x" * 1024 * 1024, "12:00:00")
+    connections = 50
+    for label, reader_class in (("recv + concat", LegacyReader), ("recv_into + memoryview", MessageReader)):
+        held = []
+        for data in (b"", big):
+            tracemalloc.start()
+            readers = []
+            for _ in range(connections):
+                reader = reader_class(ReplaySocket(data))
+                while reader.read_frame() is not None:
+                    pass
+                readers.append(reader)
+            held.append(tracemalloc.get_traced_memory()[0] / connections)
+            tracemalloc.stop()
+            del readers
+        print(f"{label:24} {held[0] / 1024:6.1f} KB/connection idle, "
+              f"{held[1] / 1024:6.1f} KB after a 1 MB message")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server benchmarks")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    federation = subparsers.add_parser('federation', help="Scale-out over federated nodes")
+    federation.add_argument('--nodes', type=int, default=3)
+    federation.add_argument('--clients-per-node', type=int, default=4)
+    federation.add_argument('--messages', type=int, default=50)
+    federation.add_argument('--base-port', type=int, default=9100)
+
+    workers = subparsers.add_parser('workers', help="Scale-up over SO_REUSEPORT workers")
+    workers.add_argument('--workers', type=int, default=os.cpu_count())
+    workers.add_argument('--clients', type=int, default=12)
+    workers.add_argument('--messages', type=int, default=50)
+    workers.add_argument('--port', type=int, default=9200)
+
+    search = subparsers.add_parser('search', help="History search latency")
+    search.add_argument('--messages', type=int, default=200000)
+    search.add_argument('--queries', type=int, default=200)
+
+    files = subparsers.add_parser('files', help="Chat p99 during a large file transfer")
+    files.add_argument('--size-mb', type=int, default=1024)
+    files.add_argument('--clients', type=int, default=4)
+    files.add_argument('--messages', type=int, default=400)
+    files.add_argument('--port', type=int, default=9300)
+
+    receive = subparsers.add_parser('receive', help="Allocations and memory on the receive path")
+    receive.add_argument('--messages', type=int, default=50000)
+
+    handoff = subparsers.add_parser('handoff', help="Pause while a new process takes over")
+    handoff.add_argument('--clients', type=int, default=10)
+    handoff.add_argument('--messages', type=int, default=250)
+    handoff.add_argument('--port', type=int, default=9400)
+
+    accept = subparsers.add_parser('accept', help="Connect latency during an accept storm")
+    accept.add_argument('--connections', type=int, default=2000)
+    accept.add_argument('--port', type=int, default=9500)
+
+    reaper = subparsers.add_parser('reaper', help="Idle detection cost per tick")
+    reaper.add_argument('--connections', type=int, default=10000)
+    reaper.add_argument('--seconds', type=int, default=300)
+    reaper.add_argument('--active', type=float, default=0.05,
+                        help="Fraction of connections sending something each second")
+
+    simulate = subparsers.add_parser('simulate', help="In-process fan-out with no ports")
+    simulate.add_argument('--clients', type=int, default=1000)
+    simulate.add_argument('--senders', type=int, default=10)
+    simulate.add_argument('--messages', type=int, default=20)
+    simulate.add_argument('--runs', type=int, default=3)
+
+    priority = subparsers.add_parser('priority', help="Control latency during a chat flood")
+    priority.add_argument('--flooders', type=int, default=10)
+    priority.add_argument('--listeners', type=int, default=40)
+    priority.add_argument('--messages', type=int, default=3000)
+    priority.add_argument('--port', type=int, default=9600)
+
+    fanout = subparsers.add_parser('fanout', help="Broadcast cost for large rooms")
+    fanout.add_argument('--rooms', type=int, nargs='+', default=[1000, 3000, 9000])
+    fanout.add_argument('--helpers', type=int, nargs='+', default=[1, 2, 4])
+    fanout.add_argument('--messages', type=int, default=20)
+
+    typing = subparsers.add_parser('typing', help="Cost of a typing indicator storm")
+    typing.add_argument('--clients', type=int, default=200)
+    typing.add_argument('--typists', type=int, default=20)
+    typing.add_argument('--rate', type=int, default=20, help="Events per typist per second")
+    typing.add_argument('--seconds', type=int, default=10)
+
+    args = parser.parse_args()
+    if args.benchmark == 'federation':
+        benchmark_federation(args.nodes, args.clients_per_node, args.messages, args.base_port)
+    elif args.benchmark == 'workers':
+        benchmark_workers(args.workers, args.clients, args.messages, args.port)
+    elif args.benchmark == 'search':
+        benchmark_search(args.messages, args.queries)
+    elif args.benchmark == 'files':
+        benchmark_files(args.size_mb, args.clients, args.messages, args.port)
+    elif args.benchmark == 'receive':
+        benchmark_receive(args.messages)
+    elif args.benchmark == 'handoff':
+        benchmark_handoff(args.clients, args.messages, args.port)
+    elif args.benchmark == 'accept':
+        benchmark_accept(args.connections, args.port)
+    elif args.benchmark == 'reaper':
+        benchmark_reaper(args.connections, args.seconds, args.active)
+    elif args.benchmark == 'priority':
+        benchmark_priority(args.flooders, args.listeners, args.messages, args.port)
+    elif args.benchmark == 'simulate':
+        benchmark_simulation(args.clients, args.senders, args.messages, args.runs)
+    elif args.benchmark == 'fanout':
+        benchmark_fanout(args.rooms, args.helpers, args.messages)
+    elif args.benchmark == 'typing':
+        benchmark_typing(args.clients, args.typists, args.rate, args.seconds)
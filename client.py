@@ -1,24 +1,71 @@
+import os
 import socket
 import threading
 from protocol import (
     MessageType, create_message, parse_message, format_message_for_display,
     create_handshake_message, setup_logging, ConnectionStatus, log_connection_status,
-    log_error
+    log_error, MessageReader, new_message_id, create_file_offer,
+    create_pong_message
 )
+from file_transfer import upload_file, download_file
 
 #Initialize the client
 HOST = '127.0.0.1'
 PORT = 8000
+file_port = None  # Sent by the server in the USERNAME_ACK and in offer replies
 
 # Get username when starting
 username = input("Enter your username: ")
 
+# Files offered with /upload, waiting for the server to assign an ID
+pending_uploads = {}
+
+# The receive thread answers pings while the input thread sends chat; without
+# a lock a PONG can land in the middle of a half-sent chat frame
+send_lock = threading.Lock()
+
+def send(frame):
+    with send_lock:
+        client_socket.sendall(frame)
+
+# File transfers run in their own threads so they don't hold up the chat
+def start_upload(file_id, path):
+    def run():
+        try:
+            upload_file((HOST, file_port), file_id, path)
+            print(f"Upload of {os.path.basename(path)} finished")
+        except Exception as e:
+            print(f"Upload failed: {e}")
+    threading.Thread(target=run, daemon=True).start()
+
+def start_download(file_id):
+    def run():
+        try:
+            print(f"Download saved to {download_file((HOST, file_port), file_id)}")
+        except Exception as e:
+            print(f"Download failed: {e}")
+    threading.Thread(target=run, daemon=True).start()
+
 def receive_message():
+    global file_port
     while True:
         try:
-            message = client_socket.recv(1024)
-            if message:
-                msg_data = parse_message(message)
+            frame = reader.read_frame()
+            if frame:
+                msg_data = parse_message(frame)
+                if msg_data["type"] == MessageType.PING.value:
+                    send(create_pong_message())
+                    continue
+                if msg_data["type"] in (MessageType.ROSTER.value, MessageType.PRESENCE.value,
+                                        MessageType.ACK.value, MessageType.TYPING.value):
+                    continue  # Roster updates and typing indicators are only shown by the GUI
+                if msg_data["type"] == MessageType.FILE_OFFER.value:
+                    # Our offer was accepted; stream the file on the side channel
+                    file_port = msg_data["port"]
+                    path = pending_uploads.pop(msg_data["content"], None)
+                    if path:
+                        start_upload(msg_data["file_id"], path)
+                    continue
                 print(format_message_for_display(msg_data))
             else:
                 print("Disconnected from server.")
@@ -35,10 +82,26 @@ def send_message():
             client_socket.close()
             print("Disconnected from the server.")
             break
-        chat_message = create_message(MessageType.CHAT, username, message)
-        client_socket.send(chat_message)
+        if message.lower().startswith("/search "):
+            send(create_message(MessageType.SEARCH, username, message[8:]))
+            continue
+        if message.lower().startswith("/upload "):
+            path = message[8:].strip()
+            if not os.path.isfile(path):
+                print(f"No such file: {path}")
+                continue
+            name = os.path.basename(path)
+            pending_uploads[name] = path
+            send(create_file_offer(username, name, os.path.getsize(path)))
+            continue
+        if message.lower().startswith("/download "):
+            start_download(message[10:].strip())
+            continue
+        chat_message = create_message(MessageType.CHAT, username, message, msg_id=new_message_id())
+        send(chat_message)
 
 def connect_to_server():
+    global file_port
     try:
         client_socket.connect((HOST, PORT))
         log_connection_status(ConnectionStatus.CONNECTING)
@@ -46,23 +109,24 @@ def connect_to_server():
         # Step 1: Send HELLO
         log_connection_status(ConnectionStatus.HANDSHAKE_STARTED)
         hello_msg = create_handshake_message(MessageType.HELLO)
-        client_socket.send(hello_msg)
+        client_socket.sendall(hello_msg)
         
         # Step 2: Wait for HELLO_ACK
-        response = parse_message(client_socket.recv(1024))
+        response = parse_message(reader.read_message())
         if response["type"] != MessageType.HELLO_ACK.value:
             log_error("handshake", "Unexpected response from server")
             return False
             
         # Step 3: Send Username
         username_msg = create_message(MessageType.USERNAME, username, username)
-        client_socket.send(username_msg)
+        client_socket.sendall(username_msg)
         
         # Step 4: Wait for USERNAME_ACK
-        response = parse_message(client_socket.recv(1024))
+        response = parse_message(reader.read_message())
         if response["type"] != MessageType.USERNAME_ACK.value:
             log_error("username", "Username not accepted")
             return False
+        file_port = response.get("file_port")
             
         log_connection_status(ConnectionStatus.CONNECTED)
         return True
@@ -73,12 +137,13 @@ def connect_to_server():
 
 # Replace the current connection code with:
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+reader = MessageReader(client_socket)
 if not connect_to_server():
     exit()
 
 # Send join message (after successful handshake)
 join_message = create_message(MessageType.JOIN, username, "joined the chat")
-client_socket.send(join_message)
+send(join_message)
 
 # Start threads
 receive_thread = threading.Thread(target=receive_message)
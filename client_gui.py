@@ -1,42 +1,52 @@
 import sys
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QTextEdit, QLineEdit, QPushButton, 
-                            QLabel, QInputDialog, QMessageBox)
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QThreadPool, QRunnable
+                            QLabel, QInputDialog, QMessageBox, QListWidget)
+from PyQt6.QtCore import Qt, QThread, pyqtSignal, QThreadPool, QRunnable, QTimer
 from PyQt6.QtGui import QFont, QColor
+import os
 import socket
 import logging
+import time
 from datetime import datetime
 from protocol import (
     MessageType, create_message, parse_message, format_message_for_display,
-    create_handshake_message, setup_logging
+    create_handshake_message, setup_logging, MessageReader, new_message_id,
+    create_file_offer, create_pong_message, create_typing_message,
+    TYPING_START, TYPING_REFRESH, TYPING_TIMEOUT
 )
+from file_transfer import upload_file, download_file
+from roster import RosterView
 import multiprocessing
 from concurrent.futures import ThreadPoolExecutor
 import queue
 
 class MessageProcessor(QRunnable):
     """Parallel message processor for handling incoming messages"""
-    def __init__(self, message, callback):
+    def __init__(self, msg_data, callback):
         super().__init__()
-        self.message = message
+        self.msg_data = msg_data
         self.callback = callback
 
     def run(self):
         try:
-            msg_data = parse_message(self.message)
-            formatted_message = format_message_for_display(msg_data)
+            formatted_message = format_message_for_display(self.msg_data)
             self.callback(formatted_message)
         except Exception as e:
             print(f"Error processing message: {e}")
 
 class ChatThread(QThread):
     message_received = pyqtSignal(str)
+    roster_received = pyqtSignal(dict)
+    typing_received = pyqtSignal(dict)
+    file_offer_accepted = pyqtSignal(dict)
     connection_error = pyqtSignal(str)
 
-    def __init__(self, client_socket):
+    def __init__(self, client_socket, reader, send):
         super().__init__()
         self.client_socket = client_socket
+        self.reader = reader
+        self.send = send  # Queues a frame behind everything else we send
         self.running = True
         self.thread_pool = QThreadPool()
         self.thread_pool.setMaxThreadCount(multiprocessing.cpu_count() * 2)
@@ -45,10 +55,30 @@ class ChatThread(QThread):
     def run(self):
         while self.running:
             try:
-                message = self.client_socket.recv(1024)
-                if message and self.running:
+                frame = self.reader.read_frame()
+                if frame is None:
+                    if self.running:
+                        self.connection_error.emit("Disconnected from server")
+                    break
+                if self.running:
+                    msg_data = parse_message(frame)
+                    if msg_data["type"] == MessageType.PING.value:
+                        self.send(create_pong_message())
+                        continue
+                    if msg_data["type"] == MessageType.ACK.value:
+                        continue  # Our own message reached the server
+                    if msg_data["type"] == MessageType.FILE_OFFER.value:
+                        self.file_offer_accepted.emit(msg_data)
+                        continue
+                    if msg_data["type"] in (MessageType.ROSTER.value, MessageType.PRESENCE.value):
+                        # Roster updates must be applied in arrival order
+                        self.roster_received.emit(msg_data)
+                        continue
+                    if msg_data["type"] == MessageType.TYPING.value:
+                        self.typing_received.emit(msg_data)
+                        continue
                     # Process message in parallel
-                    processor = MessageProcessor(message, self.message_received.emit)
+                    processor = MessageProcessor(msg_data, self.message_received.emit)
                     self.thread_pool.start(processor)
             except Exception as e:
                 if self.running:
@@ -61,7 +91,7 @@ class ChatThread(QThread):
         self.thread_pool.waitForDone()
 
 class MessageSender(QRunnable):
-    """Parallel message sender for handling outgoing messages"""
+    """Writes one frame to the chat connection; run only on the single-thread send pool"""
     def __init__(self, socket, message):
         super().__init__()
         self.socket = socket
@@ -69,18 +99,45 @@ class MessageSender(QRunnable):
 
     def run(self):
         try:
-            self.socket.send(self.message)
+            self.socket.sendall(self.message)
         except Exception as e:
             print(f"Error sending message: {e}")
 
+class FileTransfer(QRunnable):
+    """Runs an upload or download on the file port, off the chat connection"""
+    def __init__(self, action, args, describe, callback):
+        super().__init__()
+        self.action = action
+        self.args = args
+        self.describe = describe  # Turns the action's result into a chat line
+        self.callback = callback
+
+    def run(self):
+        try:
+            result = self.action(*self.args)
+            self.callback(self.describe(result))
+        except Exception as e:
+            self.callback(f"File transfer failed: {e}")
+
 class ChatWindow(QMainWindow):
+    transfer_finished = pyqtSignal(str)
+
     def __init__(self):
         super().__init__()
         self.client_socket = None
+        self.pending_uploads = {}  # File name -> local path, until the server assigns an ID
         self.username = None
         self.chat_thread = None
+        self.roster_view = RosterView()
+        self.typing_users = {}  # Username -> time.monotonic() when its indicator expires
+        self.typing_sent_at = None  # When we last told the others we are typing, None if not
         self.thread_pool = QThreadPool()
         self.thread_pool.setMaxThreadCount(multiprocessing.cpu_count() * 2)
+        # Every frame on the chat connection goes through one thread, so they
+        # leave whole and in order: a typing stop can't overtake its start
+        self.send_pool = QThreadPool()
+        self.send_pool.setMaxThreadCount(1)
+        self.transfer_finished.connect(self.display_message)
         self.initUI()
         self.connectToServer()
 
@@ -158,17 +215,45 @@ class ChatWindow(QMainWindow):
         """)
         layout.addWidget(title)
 
-        # Chat display with rich text support
+        # Chat display with rich text support, online list beside it
+        chat_layout = QHBoxLayout()
         self.chat_display = QTextEdit()
         self.chat_display.setReadOnly(True)
         self.chat_display.setAcceptRichText(True)  # Enable rich text
-        layout.addWidget(self.chat_display)
+        chat_layout.addWidget(self.chat_display, 3)
+
+        online_layout = QVBoxLayout()
+        self.online_label = QLabel("Online (0)")
+        self.online_list = QListWidget()
+        self.online_list.setStyleSheet("""
+            QListWidget {
+                background-color: #2d2d2d;
+                border: 1px solid #3d3d3d;
+                border-radius: 8px;
+                padding: 5px;
+                font-size: 13px;
+            }
+        """)
+        online_layout.addWidget(self.online_label)
+        online_layout.addWidget(self.online_list)
+        chat_layout.addLayout(online_layout, 1)
+        layout.addLayout(chat_layout)
+
+        # Who else is typing; entries expire unless the server refreshes them
+        self.typing_label = QLabel("")
+        self.typing_label.setStyleSheet("QLabel { color: #888888; font-style: italic; }")
+        layout.addWidget(self.typing_label)
+        self.typing_timer = QTimer(self)
+        self.typing_timer.timeout.connect(self.expire_typing)
+        self.typing_timer.start(1000)
 
         # Input area
         input_layout = QHBoxLayout()
         self.message_input = QLineEdit()
         self.message_input.setPlaceholderText("Type your message...")
         self.message_input.returnPressed.connect(self.send_message)
+        # Only user edits, not clear() after sending
+        self.message_input.textEdited.connect(self.input_edited)
         
         send_button = QPushButton("Send")
         send_button.clicked.connect(self.send_message)
@@ -188,6 +273,9 @@ class ChatWindow(QMainWindow):
 /help    - Display this help message
 /exit    - Exit the chat
 /clear   - Clear the chat window
+/search  - Search chat history (from:user, date:YYYY-MM-DD)
+/upload  - Share a file: /upload <path>
+/download - Fetch a shared file: /download <id>
 
 Press Enter or click Send to send a message.</span>
 ------------------------------------------
@@ -197,6 +285,8 @@ Press Enter or click Send to send a message.</span>
     def connectToServer(self):
         HOST = '127.0.0.1'
         PORT = 8000
+        self.server_host = HOST
+        self.file_port = None  # Sent by the server in the USERNAME_ACK and in offer replies
 
         # Get username
         username, ok = QInputDialog.getText(
@@ -211,6 +301,7 @@ Press Enter or click Send to send a message.</span>
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((HOST, PORT))
+            self.reader = MessageReader(self.client_socket)
             
             # Log handshake steps
             logging.info(f"Attempting handshake for user {username}")
@@ -219,8 +310,11 @@ Press Enter or click Send to send a message.</span>
             self._perform_handshake()
             
             # Start receive thread
-            self.chat_thread = ChatThread(self.client_socket)
+            self.chat_thread = ChatThread(self.client_socket, self.reader, self.send)
             self.chat_thread.message_received.connect(self.display_message)
+            self.chat_thread.roster_received.connect(self.apply_roster_update)
+            self.chat_thread.typing_received.connect(self.show_typing)
+            self.chat_thread.file_offer_accepted.connect(self.start_upload)
             self.chat_thread.connection_error.connect(self.handle_connection_error)
             self.chat_thread.start()
 
@@ -236,11 +330,11 @@ Press Enter or click Send to send a message.</span>
         """Perform handshake in parallel"""
         # Step 1: Send HELLO
         hello_msg = create_handshake_message(MessageType.HELLO)
-        self.client_socket.send(hello_msg)
+        self.client_socket.sendall(hello_msg)
         logging.info("Sent HELLO message")
         
         # Step 2: Receive HELLO_ACK
-        response = parse_message(self.client_socket.recv(1024))
+        response = parse_message(self.reader.read_message())
         logging.info(f"Received response: {response}")
         if response["type"] != MessageType.HELLO_ACK.value:
             logging.error(f"Unexpected response during HELLO: {response}")
@@ -248,21 +342,29 @@ Press Enter or click Send to send a message.</span>
         
         # Step 3: Send Username
         username_msg = create_message(MessageType.USERNAME, self.username, self.username)
-        self.client_socket.send(username_msg)
+        self.client_socket.sendall(username_msg)
         logging.info(f"Sent USERNAME: {self.username}")
         
         # Step 4: Receive USERNAME_ACK
-        response = parse_message(self.client_socket.recv(1024))
+        response = parse_message(self.reader.read_message())
         logging.info(f"Received username response: {response}")
         if response["type"] != MessageType.USERNAME_ACK.value:
             logging.error(f"Username not accepted: {response}")
             raise Exception("Username not accepted")
+        self.file_port = response.get("file_port")
 
         # Send join message
         join_message = create_message(MessageType.JOIN, self.username, "joined the chat")
-        self.client_socket.send(join_message)
+        self.client_socket.sendall(join_message)
         logging.info("Sent JOIN message")
 
+        # Ask for the online list once; PRESENCE deltas keep it current
+        self.client_socket.sendall(create_message(MessageType.ROSTER, self.username, ""))
+
+    def send(self, message: bytes):
+        """Queue a frame for the chat connection; safe to call from any thread"""
+        self.send_pool.start(MessageSender(self.client_socket, message))
+
     def send_message(self):
         message = self.message_input.text().strip()
         if message:
@@ -270,10 +372,10 @@ Press Enter or click Send to send a message.</span>
                 self.handle_command(message)
             else:
                 try:
-                    chat_message = create_message(MessageType.CHAT, self.username, message)
-                    # Send message in parallel
-                    sender = MessageSender(self.client_socket, chat_message)
-                    self.thread_pool.start(sender)
+                    chat_message = create_message(
+                        MessageType.CHAT, self.username, message, msg_id=new_message_id()
+                    )
+                    self.send(chat_message)
                     
                     # Display our own message immediately with highlighting
                     timestamp = datetime.now().strftime('%H:%M:%S')
@@ -284,10 +386,55 @@ Press Enter or click Send to send a message.</span>
                     )
                     
                     self.message_input.clear()
+                    self.stop_typing()
                 except Exception as e:
                     print(f"Error sending message: {e}")
                     self.statusBar().showMessage(f'Error sending message: {str(e)}')
 
+    def input_edited(self, text):
+        """Tell the others we are typing, at most once per TYPING_REFRESH; the server coalesces the rest"""
+        if not self.client_socket:
+            return
+        if text.strip() and not text.startswith('/'):
+            now = time.monotonic()
+            if self.typing_sent_at is None or now - self.typing_sent_at >= TYPING_REFRESH:
+                self.typing_sent_at = now
+                self.send(create_typing_message(self.username, True))
+        else:
+            self.stop_typing()
+
+    def stop_typing(self):
+        if self.typing_sent_at is not None and self.client_socket:
+            self.typing_sent_at = None
+            self.send(create_typing_message(self.username, False))
+
+    def show_typing(self, msg_data):
+        if msg_data["content"] == TYPING_START:
+            self.typing_users[msg_data["username"]] = time.monotonic() + TYPING_TIMEOUT
+        else:
+            self.typing_users.pop(msg_data["username"], None)
+        self.update_typing_label()
+
+    def expire_typing(self):
+        now = time.monotonic()
+        expired = [username for username, until in self.typing_users.items() if until <= now]
+        for username in expired:
+            del self.typing_users[username]
+        if expired:
+            self.update_typing_label()
+
+    def update_typing_label(self):
+        names = sorted(self.typing_users)
+        if not names:
+            text = ""
+        elif len(names) == 1:
+            text = f"{names[0]} is typing..."
+        elif len(names) <= 3:
+            text = f"{', '.join(names[:-1])} and {names[-1]} are typing..."
+        else:
+            text = "Several people are typing..."
+        self.typing_label.setText(text)
+
     def display_message(self, message):
         if self.username in message and "[System]" not in message:
             if f"{self.username}:" not in message:  # Not our message
@@ -301,18 +448,81 @@ Press Enter or click Send to send a message.</span>
         else:
             self.chat_display.append(message)
 
+    def apply_roster_update(self, msg_data):
+        """Apply a roster snapshot or delta to the online list"""
+        if msg_data["type"] == MessageType.ROSTER.value:
+            in_sync = self.roster_view.apply_snapshot(msg_data["version"], msg_data["users"])
+            self.online_list.clear()
+            self.online_list.addItems(sorted(self.roster_view.members))
+        else:
+            username = msg_data["username"]
+            was_online = username in self.roster_view.members
+            in_sync = self.roster_view.apply_delta(msg_data["version"], msg_data["content"], username)
+            is_online = username in self.roster_view.members
+            if is_online and not was_online:
+                self.online_list.addItem(username)
+                self.online_list.sortItems()
+            elif was_online and not is_online:
+                for item in self.online_list.findItems(username, Qt.MatchFlag.MatchExactly):
+                    self.online_list.takeItem(self.online_list.row(item))
+                if self.typing_users.pop(username, None) is not None:
+                    self.update_typing_label()
+        self.online_label.setText(f"Online ({len(self.roster_view.members)})")
+
+        if not in_sync:
+            # Missed a delta; fetch a fresh snapshot
+            request = create_message(MessageType.ROSTER, self.username, "")
+            self.send(request)
+
+    def start_upload(self, msg_data):
+        """The server accepted our offer; stream the file on the file port"""
+        self.file_port = msg_data["port"]
+        name = msg_data["content"]
+        path = self.pending_uploads.pop(name, None)
+        if path is None:
+            return
+        self.chat_display.append(f"Uploading {name}...")
+        self.thread_pool.start(FileTransfer(
+            upload_file, ((self.server_host, self.file_port), msg_data["file_id"], path),
+            lambda _: f"Upload of {name} finished", self.transfer_finished.emit
+        ))
+
     def handle_command(self, command):
         if command == '/exit':
             self.close()
         elif command == '/clear':
             self.chat_display.clear()
             self.chat_display.append("Chat cleared. Type /help for available commands.")
+        elif command.startswith('/search '):
+            search = create_message(MessageType.SEARCH, self.username, command[8:])
+            self.send(search)
+            self.message_input.clear()
+        elif command.startswith('/upload '):
+            path = command[8:].strip()
+            if not os.path.isfile(path):
+                self.chat_display.append(f"No such file: {path}")
+                return
+            name = os.path.basename(path)
+            self.pending_uploads[name] = path
+            offer = create_file_offer(self.username, name, os.path.getsize(path))
+            self.send(offer)
+            self.message_input.clear()
+        elif command.startswith('/download '):
+            file_id = command[10:].strip()
+            self.thread_pool.start(FileTransfer(
+                download_file, ((self.server_host, self.file_port), file_id),
+                lambda path: f"Download saved to {path}", self.transfer_finished.emit
+            ))
+            self.message_input.clear()
         elif command == '/help':
             help_text = """
 Available Commands:
 /help    - Display this help message
 /exit    - Exit the chat
 /clear   - Clear the chat window
+/search  - Search chat history (from:user, date:YYYY-MM-DD)
+/upload  - Share a file: /upload <path>
+/download - Fetch a shared file: /download <id>
 """
             self.chat_display.append(help_text)
 
@@ -331,8 +541,8 @@ Available Commands:
                 # Then send leave message
                 try:
                     leave_message = create_message(MessageType.LEAVE, self.username, "left the chat")
-                    sender = MessageSender(self.client_socket, leave_message)
-                    self.thread_pool.start(sender)
+                    self.send(leave_message)
+                    self.send_pool.waitForDone(1000)  # Let it go out before the socket closes
                 except:
                     pass  # Ignore send errors during shutdown
 
@@ -0,0 +1,46 @@
+import time
+from collections import OrderedDict
+
+class DedupCache:
+    """Recently seen client message IDs for one session.
+
+    Bounded both by entry count (least recently used first) and by age, so a
+    retry costs a single lookup and memory stays flat on long sessions.
+    """
+    def __init__(self, max_entries: int = 256, window: float = 60.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.window = window
+        self.clock = clock
+        self.entries = OrderedDict()  # msg_id -> (seq, time seen)
+
+    def get(self, msg_id: str) -> int:
+        """Return the sequence number already assigned to msg_id, or None"""
+        entry = self.entries.get(msg_id)
+        if entry is None:
+            return None
+        seq, seen = entry
+        now = self.clock()
+        if now - seen > self.window:
+            del self.entries[msg_id]
+            return None
+        # A retry keeps the entry alive for another window
+        self.entries[msg_id] = (seq, now)
+        self.entries.move_to_end(msg_id)
+        return seq
+
+    def put(self, msg_id: str, seq: int):
+        """Remember the sequence number assigned to msg_id"""
+        now = self.clock()
+        self.entries[msg_id] = (seq, now)
+        self.entries.move_to_end(msg_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        # Entries are ordered by when they were last seen, so expired ones sit at the front
+        while self.entries:
+            _, oldest_seen = next(iter(self.entries.values()))
+            if now - oldest_seen <= self.window:
+                break
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
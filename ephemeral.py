@@ -0,0 +1,79 @@
+import threading
+import time
+from protocol import EphemeralEvent
+
+EVENT_WINDOW = 1.0  # Seconds; each connection gets at most one event of a type broadcast per window
+
+class EventCoalescer:
+    """Rate-limits ephemeral events, such as typing indicators, before they are broadcast.
+
+    Events are kept per connection and event type. The first one after a
+    quiet window is emitted at once. Later ones in the same window only
+    replace the pending event, which is emitted when the window closes
+    unless it just repeats the last one emitted. A client sending hundreds
+    of events a second therefore costs a dict update each, and at most one
+    broadcast per window; a start/stop flicker within a window costs none.
+
+    Nothing is logged or stored. Pending events are checked every quarter
+    window from a background thread, or by calling check() with an
+    injected clock.
+    """
+    def __init__(self, emit, window: float = EVENT_WINDOW, clock=time.monotonic):
+        self.emit = emit  # Called as emit(socket, event) outside the lock
+        self.window = window
+        self.clock = clock
+        self.last = {}  # socket -> {type: (content, clock time) of the last event emitted}
+        self.pending = {}  # (socket, type) -> EphemeralEvent waiting for its window to close
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            time.sleep(self.window / 4)
+            if self.running:
+                self.check()
+
+    def submit(self, sock, event: EphemeralEvent):
+        """Emit an event from a connection now, later, or not at all"""
+        key = (sock, event.type)
+        now = self.clock()
+        with self.lock:
+            sent = self.last.setdefault(sock, {})
+            last = sent.get(event.type)
+            if last is not None and now - last[1] < self.window:
+                if event.content == last[0]:
+                    self.pending.pop(key, None)  # Back where the others last saw it
+                else:
+                    self.pending[key] = event
+                return
+            self.pending.pop(key, None)
+            sent[event.type] = (event.content, now)
+        self.emit(sock, event)
+
+    def check(self) -> int:
+        """Emit pending events whose window has closed; returns how many"""
+        now = self.clock()
+        due = []
+        with self.lock:
+            for (sock, msg_type), event in list(self.pending.items()):
+                sent = self.last[sock]
+                if now - sent[msg_type][1] >= self.window:
+                    del self.pending[sock, msg_type]
+                    sent[msg_type] = (event.content, now)
+                    due.append((sock, event))
+        for sock, event in due:
+            self.emit(sock, event)
+        return len(due)
+
+    def forget(self, sock):
+        """Drop a closed connection's state; clients clear its indicators when it leaves"""
+        with self.lock:
+            for msg_type in self.last.pop(sock, {}):
+                self.pending.pop((sock, msg_type), None)
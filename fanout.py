@@ -0,0 +1,380 @@
+import itertools
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import stat
+import struct
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from protocol import log_error
+from outbound import CONTROL, MAX_QUEUED_BYTES
+
+RING_SIZE = 64 * 1024 * 1024  # Bytes of encoded frames in flight to the helpers
+RECORD_SIZE = 64  # Largest control record sent to a helper
+RECORD_TIMEOUT = 5.0  # Seconds a helper may leave its control socket full before it counts as stuck
+
+# Records on a helper's control socket. Frames themselves stay in the ring;
+# a record only says where one is and who gets it.
+ADD = b'A'  # client id; the socket travels with it over SCM_RIGHTS
+MEMBER = b'M'  # client id; the client is logged in and gets broadcasts
+REMOVE = b'R'  # client id
+BROADCAST = b'B'  # ring position, length, client id to skip (0 for none)
+UNICAST = b'U'  # ring position, length, client id
+ID_RECORD = struct.Struct('=cI')
+FRAME_RECORD = struct.Struct('=cQII')
+
+class HelperClient:
+    """A client socket in a helper, with the bytes it hasn't been able to take yet"""
+    __slots__ = ('sock', 'backlog', 'backlog_bytes', 'cut_off')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.backlog = deque()
+        self.backlog_bytes = 0
+        self.cut_off = False
+
+def helper_send(selector, client: HelperClient, frame, max_backlog: int):
+    """Write a frame without blocking; what the socket can't take waits in the backlog"""
+    if client.cut_off:
+        return
+    sent = 0
+    if not client.backlog:
+        # MSG_DONTWAIT rather than a non-blocking socket: the server reads
+        # from a duplicate of it, which shares the blocking flag
+        try:
+            sent = client.sock.send(frame, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass
+        except OSError:
+            cut_off(selector, client)
+            return
+    if sent == len(frame):
+        return
+    if client.backlog_bytes + len(frame) - sent > max_backlog:
+        cut_off(selector, client)
+        return
+    if not client.backlog:
+        selector.register(client.sock, selectors.EVENT_WRITE, client)
+    client.backlog.append(bytes(frame[sent:]))
+    client.backlog_bytes += len(frame) - sent
+
+def drain_backlog(selector, client: HelperClient):
+    """Send as much of a client's backlog as its socket takes now"""
+    if client.cut_off:
+        return  # Removed earlier in the same wakeup
+    try:
+        sent = client.sock.sendmsg(list(itertools.islice(client.backlog, 1024)), [], socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return
+    except OSError:
+        cut_off(selector, client)
+        return
+    client.backlog_bytes -= sent
+    while sent:
+        chunk = client.backlog[0]
+        if sent < len(chunk):
+            client.backlog[0] = chunk[sent:]
+            break
+        sent -= len(chunk)
+        client.backlog.popleft()
+    if not client.backlog:
+        selector.unregister(client.sock)
+
+def cut_off(selector, client: HelperClient):
+    """Stop sending to a client that is gone or too far behind"""
+    if client.backlog:
+        selector.unregister(client.sock)
+    client.backlog.clear()
+    client.backlog_bytes = 0
+    client.cut_off = True
+    # The server's handler sees the shutdown and removes the client
+    try:
+        client.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def release_inherited_sockets(keep: int):
+    """Drop this process's copies of every socket but keep, a descriptor number.
+
+    A forked helper starts with all of the server's sockets: the listener,
+    clients taken over from a previous process, federation links, other
+    helpers' control sockets. While a copy is open here, the server closing
+    its own neither hangs up on the peer nor frees the port. Each is pointed
+    at /dev/null instead of closed, so a stale socket object here can never
+    close a descriptor number reused for a client handed over later.
+    """
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        for fd in map(int, os.listdir('/dev/fd')):
+            try:
+                if fd != keep and stat.S_ISSOCK(os.fstat(fd).st_mode):
+                    os.dup2(devnull, fd)
+            except OSError:
+                pass  # The listing's own descriptor, gone by now
+    finally:
+        os.close(devnull)
+
+def run_helper(index: int, helpers: int, shm_name: str, ring_size: int, control,
+               max_backlog: int = MAX_QUEUED_BYTES):
+    """Helper process: sends frames from the ring to the clients in its shard.
+
+    Sends never block. A client that can't take a frame right away gets
+    the rest from a backlog once its socket is writable again, and one
+    more than max_backlog bytes behind is shut down. A client that isn't
+    reading therefore holds up neither the others nor the ring.
+    """
+    # Ctrl-C reaches the whole process group; the server decides when helpers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    release_inherited_sockets(control.fileno())
+    shm = shared_memory.SharedMemory(name=shm_name)
+    consumed = shm.buf[:8 * helpers].cast('Q')
+    ring = shm.buf[8 * helpers:]
+    clients = {}  # client id -> HelperClient
+    members = {}  # client id -> HelperClient, logged in only
+    selector = selectors.DefaultSelector()
+    selector.register(control, selectors.EVENT_READ)
+    try:
+        while True:
+            for key, _ in selector.select():
+                if key.data is not None:
+                    drain_backlog(selector, key.data)
+                    continue
+                # Every record waiting, then back to the clients
+                while True:
+                    try:
+                        data, fds, _, _ = socket.recv_fds(control, RECORD_SIZE, 1, socket.MSG_DONTWAIT)
+                    except BlockingIOError:
+                        break
+                    if not data:
+                        return
+                    kind = data[:1]
+                    if kind in (BROADCAST, UNICAST):
+                        _, position, length, client_id = FRAME_RECORD.unpack(data)
+                        start = position % ring_size
+                        frame = ring[start:start + length]
+                        if kind == UNICAST:
+                            targets = [clients[client_id]] if client_id in clients else []
+                        else:
+                            targets = [client for member_id, client in members.items() if member_id != client_id]
+                        for client in targets:
+                            helper_send(selector, client, frame, max_backlog)
+                        frame.release()
+                        # Backlogs hold copies, so the ring space is free already
+                        consumed[index] = position + length
+                        continue
+                    _, client_id = ID_RECORD.unpack(data)
+                    if kind == ADD:
+                        clients[client_id] = HelperClient(socket.socket(fileno=fds[0]))
+                    elif kind == MEMBER:
+                        if client_id in clients:
+                            members[client_id] = clients[client_id]
+                    elif kind == REMOVE:
+                        members.pop(client_id, None)
+                        client = clients.pop(client_id, None)
+                        if client is not None:
+                            if client.backlog:
+                                selector.unregister(client.sock)
+                                client.backlog.clear()
+                            client.cut_off = True
+                            client.sock.close()
+    finally:
+        selector.close()
+        ring.release()
+        consumed.release()
+        shm.close()
+
+class SharedFanout:
+    """Sends to clients from helper processes, each owning a shard of the sockets.
+
+    Every outgoing frame is copied once into a shared-memory ring. Each
+    helper is sent a small fixed-size record saying where the frame is and
+    whether it goes to one client or to all logged-in clients but one,
+    then writes it to its own clients straight from shared memory. A
+    broadcast to a room of any size therefore costs the server one copy
+    and one record per helper, and the send calls are spread over the
+    helpers' cores. Nothing is pickled.
+
+    Helpers hold duplicates of the client sockets, passed over SCM_RIGHTS;
+    the server keeps reading from its own. All sends to a client go
+    through its helper, in order, so there are no priority lanes here. A
+    client that falls max_backlog bytes behind is shut down, as with
+    MAX_QUEUED_BYTES in the scheduler. The ring is reused once every
+    helper has moved past a frame; when it is full, senders wait for the
+    slowest helper with the lock released.
+
+    Offers the same calls as OutboundScheduler, plus add_member and
+    broadcast.
+    """
+    def __init__(self, helpers: int = 4, ring_size: int = RING_SIZE, max_backlog: int = MAX_QUEUED_BYTES):
+        self.helpers = helpers
+        self.ring_size = ring_size
+        # One 8-byte consumed position per helper, then the ring
+        self.shm = shared_memory.SharedMemory(create=True, size=8 * helpers + ring_size)
+        self.consumed = self.shm.buf[:8 * helpers].cast('Q')
+        self.ring = self.shm.buf[8 * helpers:]
+        for index in range(helpers):
+            self.consumed[index] = 0
+        self.head = 0  # Ring position of the next frame, counted from the start
+        self.assigned = [0] * helpers  # End of the last frame each helper was sent
+        self.lock = threading.Lock()
+        self.ids = {}  # socket -> (client id, helper index)
+        self.shard_sizes = [0] * helpers
+        self.next_id = itertools.count(1)
+        self.controls = []
+        self.processes = []
+        for index in range(helpers):
+            control, helper_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            process = multiprocessing.Process(
+                target=run_helper, daemon=True,
+                args=(index, helpers, self.shm.name, ring_size, helper_end, max_backlog)
+            )
+            process.start()
+            helper_end.close()
+            # Helpers never wait on clients, so a full control socket means one is stuck
+            control.settimeout(RECORD_TIMEOUT)
+            self.controls.append(control)
+            self.processes.append(process)
+
+    def start(self):
+        pass  # The helpers are running from the start
+
+    def stop(self):
+        """Wait for the helpers to send everything queued, then end them"""
+        self.flush()
+        with self.lock:
+            for control in self.controls:
+                control.close()
+            self.controls = []
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                log_error("fanout", f"Helper process {process.pid} did not exit; terminating it")
+                process.terminate()
+                process.join()
+        self.consumed.release()
+        self.ring.release()
+        self.shm.close()
+        self.shm.unlink()
+
+    def register(self, sock, weight: int = 1):
+        """Hand a new connection to the helper with the fewest clients"""
+        with self.lock:
+            if sock in self.ids or not self.controls:
+                return
+            index = self.shard_sizes.index(min(self.shard_sizes))
+            client_id = next(self.next_id)
+            self.ids[sock] = (client_id, index)
+            self.shard_sizes[index] += 1
+            self._send_record(index, ID_RECORD.pack(ADD, client_id), [sock.fileno()])
+
+    def add_member(self, sock):
+        """Include a logged-in client in broadcasts"""
+        self._send_id(sock, MEMBER)
+
+    def set_weight(self, sock, weight: int):
+        pass  # Each helper serves its clients in turn
+
+    def forget(self, sock):
+        with self.lock:
+            entry = self.ids.pop(sock, None)
+            if entry is not None:
+                client_id, index = entry
+                self.shard_sizes[index] -= 1
+                if self.controls:
+                    self._send_record(index, ID_RECORD.pack(REMOVE, client_id))
+
+    def _send_id(self, sock, kind: bytes):
+        with self.lock:
+            entry = self.ids.get(sock)
+            if entry is not None and self.controls:
+                client_id, index = entry
+                self._send_record(index, ID_RECORD.pack(kind, client_id))
+
+    def _send_record(self, index: int, record: bytes, fds=()):
+        """Send a record to a helper; caller holds the lock"""
+        try:
+            if fds:
+                socket.send_fds(self.controls[index], [record], fds)
+            else:
+                self.controls[index].send(record)
+        except socket.timeout:
+            log_error("fanout", f"Helper process {self.processes[index].pid} stopped taking records")
+            raise RuntimeError("A fan-out helper process is stuck")
+
+    def send(self, sock, message: bytes, lane: int = CONTROL):
+        """Send a message to one client through its helper"""
+        while True:
+            with self.lock:
+                entry = self.ids.get(sock)
+                if entry is None or not self.controls:
+                    return
+                position = self._write(message)
+                if position is not None:
+                    client_id, index = entry
+                    self.assigned[index] = position + len(message)
+                    self._send_record(index, FRAME_RECORD.pack(UNICAST, position, len(message), client_id))
+                    return
+            self._wait()
+
+    def send_many(self, socks, message: bytes, lane: int):
+        for sock in socks:
+            self.send(sock, message, lane)
+
+    def broadcast(self, message: bytes, exclude=None):
+        """Send a message to every logged-in client except exclude, writing it only once"""
+        while True:
+            with self.lock:
+                if not self.controls:
+                    return
+                position = self._write(message)
+                if position is not None:
+                    skip = self.ids.get(exclude, (0, None))[0]
+                    record = FRAME_RECORD.pack(BROADCAST, position, len(message), skip)
+                    for index in range(self.helpers):
+                        self.assigned[index] = position + len(message)
+                        self._send_record(index, record)
+                    return
+            self._wait()
+
+    def _write(self, message: bytes) -> int:
+        """Copy a frame into the ring and return its position, or None if it doesn't fit yet; caller holds the lock"""
+        length = len(message)
+        if length > self.ring_size:
+            raise ValueError("Message is larger than the fan-out ring")
+        position = self.head
+        if position % self.ring_size + length > self.ring_size:
+            position += self.ring_size - position % self.ring_size  # Frames never wrap
+        if position + length - self._tail() > self.ring_size:
+            return None
+        start = position % self.ring_size
+        self.ring[start:start + length] = message
+        self.head = position + length
+        return position
+
+    def _wait(self):
+        """Give the helpers a moment to move on; never called holding the lock"""
+        self._check_helpers()
+        time.sleep(0.0005)
+
+    def _tail(self) -> int:
+        """Oldest ring position a helper may still read; helpers with nothing pending don't count"""
+        pending = [self.consumed[index] for index in range(self.helpers)
+                   if self.consumed[index] < self.assigned[index]]
+        return min(pending, default=self.head)
+
+    def flush(self):
+        """Wait until the helpers have sent every frame written so far"""
+        with self.lock:
+            assigned = list(self.assigned)
+        while self.controls and any(self.consumed[index] < end for index, end in enumerate(assigned)):
+            self._wait()
+
+    def _check_helpers(self):
+        for process in self.processes:
+            if not process.is_alive():
+                log_error("fanout", f"Helper process {process.pid} exited")
+                raise RuntimeError("A fan-out helper process exited")
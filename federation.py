@@ -0,0 +1,413 @@
+import os
+import socket
+import threading
+import time
+from collections import deque
+from protocol import (
+    MessageType, MessageReader, ChatMessage, EphemeralEvent, InvalidMessage, create_peer_hello,
+    create_relay_message,
+    parse_message, log_error, MESSAGE_DELIMITER
+)
+from dedup import DedupCache
+
+MAX_LINK_QUEUE = 64 * 1024 * 1024  # A peer this many bytes behind is disconnected
+MESH_CHECK_DELAY = 10.0  # Seconds a node gets to link to a peer's peers before a warning
+
+def connect_to(address):
+    """Open a stream connection to a (host, port) or UNIX socket path"""
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    return socket.create_connection(address)
+
+class PeerLink:
+    """One open server-to-server connection.
+
+    Messages are queued and written by the link's own thread, so a peer
+    that stops reading never blocks a reader thread or anyone holding the
+    federation's locks. A peer that falls MAX_LINK_QUEUE bytes behind is
+    disconnected.
+    """
+    def __init__(self, sock, node_id: str, initiator: str, max_queued_bytes: int = MAX_LINK_QUEUE):
+        self.sock = sock
+        self.node_id = node_id
+        self.initiator = initiator
+        self.max_queued_bytes = max_queued_bytes
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.closed = False
+        self.ready = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def send(self, message: bytes):
+        """Queue a message; raises OSError once the link is closed or too far behind"""
+        with self.ready:
+            if self.closed:
+                raise OSError("Link is closed")
+            if self.queued_bytes + len(message) > self.max_queued_bytes:
+                raise OSError("Peer is too far behind")
+            self.queue.append(message)
+            self.queued_bytes += len(message)
+            self.ready.notify()
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                batch = b"".join(self.queue)
+                self.queue.clear()
+                self.queued_bytes = 0
+            try:
+                self.sock.sendall(batch)
+            except OSError as e:
+                log_error("federation", f"Send to {self.node_id} failed: {e}")
+                self.close()  # The link's reader notices and drops it
+                return
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.queue.clear()
+            self.queued_bytes = 0
+            self.ready.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class Federation:
+    """Links several ChatServer processes into one chat network.
+
+    Nodes form a full mesh over a separate peer port, so a node sends each
+    of its events straight to every peer and nobody forwards them: a
+    broadcast costs N-1 peer sends. Every relayed event carries its origin
+    node ID and that node's sequence number, and a node delivers an event
+    to its own clients only the first time it sees it, so a duplicate link
+    can't deliver it twice. Presence events carry the absolute
+    session count of a user on its origin node, so replays are harmless. When
+    the link to a node drops, the users on that node go offline.
+
+    Since nothing is forwarded, every node must be linked to every other:
+    each lists all the nodes started before it as peers. Nodes tell their
+    peers whom they are linked to, and a node that is still missing one of
+    those links after MESH_CHECK_DELAY logs a warning, as that node's users
+    and messages never reach it.
+
+    Addresses are (host, port) for TCP, or a filesystem path for a UNIX
+    socket when the nodes are worker processes on the same machine.
+    """
+    def __init__(self, server, node_id: str, address, peers=(),
+                 reconnect_delay: float = 1.0, seq: int = 0, log_relayed: bool = True):
+        self.server = server
+        self.log_relayed = log_relayed  # False when the origin node writes the same log
+        self.node_id = node_id
+        self.address = address
+        self.peers = list(peers)  # Addresses of the nodes this one dials
+        self.reconnect_delay = reconnect_delay
+        self.running = False
+        self.stopping = False
+
+        self.links = {}  # node_id -> PeerLink
+        self.links_lock = threading.Lock()
+
+        # Origin sequence numbers and this node's user sessions. Presence is
+        # published under the lock so a link sync can never miss or reorder one.
+        # seq continues from a previous process with this node ID, since peers
+        # still remember its events as seen.
+        self.seq = seq
+        self.local_sessions = {}  # username -> sessions on this node
+        self.lock = threading.Lock()
+
+        self.remote_sessions = {}  # node_id -> {username: sessions}
+        self.presence_seq = {}  # node_id -> last presence seq applied
+        self.remote_lock = threading.Lock()
+
+        self.seen = DedupCache(max_entries=100000, window=300.0)
+        self.seen_lock = threading.Lock()
+
+        self.peer_links = {}  # node_id -> node IDs that peer is linked to
+        self.unlinked = set()  # Nodes already warned about
+
+    def start(self):
+        """Listen for peers and start dialing the configured ones"""
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            self.listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(self.address)
+        self.listen_socket.listen(16)
+        self.running = True
+        threading.Thread(target=self.accept_peers, daemon=True).start()
+        for address in self.peers:
+            threading.Thread(target=self.dial_peer, args=(address,), daemon=True).start()
+        print(f"Node {self.node_id} accepting peers on {self.address}")
+
+    def stop(self):
+        self.running = False
+        self.stopping = True
+        try:
+            self.listen_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listen_socket.close()
+        with self.links_lock:
+            links = list(self.links.values())
+        for link in links:
+            link.close()
+
+    def accept_peers(self):
+        while self.running:
+            try:
+                sock, _ = self.listen_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.run_link, args=(sock, False), daemon=True).start()
+
+    def dial_peer(self, address):
+        """Keep a link to address open, reconnecting whenever it drops"""
+        node_id = None
+        while self.running:
+            if node_id is not None and node_id in self.links:
+                # Already linked through the peer's own connection to us
+                time.sleep(self.reconnect_delay)
+                continue
+            try:
+                sock = connect_to(address)
+            except OSError:
+                time.sleep(self.reconnect_delay)
+                continue
+            node_id = self.run_link(sock, True) or node_id
+            time.sleep(self.reconnect_delay)
+
+    def run_link(self, sock, dialed: bool) -> str:
+        """Handshake and serve one peer connection; returns the peer's node ID"""
+        reader = MessageReader(sock)
+        link = None
+        node_id = None
+        try:
+            if dialed:
+                sock.sendall(create_peer_hello(self.node_id, self.node_id))
+            message = reader.read_message()
+            hello = parse_message(message) if message else None
+            if not hello or hello["type"] != MessageType.PEER_HELLO.value:
+                return None
+            node_id = hello["node_id"]
+            if not dialed:
+                sock.sendall(create_peer_hello(self.node_id, node_id))
+
+            link = PeerLink(sock, node_id, hello["initiator"])
+            if not self.register_link(link):
+                link = None
+                return node_id
+            link.start()
+            self.send_sync(link)
+
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                self.handle_peer_message(link, frame)
+        except (OSError, ValueError, KeyError) as e:
+            log_error("federation", f"Link to {node_id or 'unknown node'}: {e}")
+        finally:
+            if link is not None:
+                self.drop_link(link)
+            sock.close()
+        return node_id
+
+    def register_link(self, link: PeerLink) -> bool:
+        """Add a link, resolving a duplicate towards the one dialed by the lower node ID"""
+        with self.links_lock:
+            current = self.links.get(link.node_id)
+            if current is not None:
+                preferred = min(self.node_id, link.node_id)
+                if current.initiator == preferred or link.initiator != preferred:
+                    return False
+                current.close()
+            self.links[link.node_id] = link
+        print(f"Node {self.node_id} linked to {link.node_id}")
+        self.announce_links()
+        return True
+
+    def drop_link(self, link: PeerLink):
+        """Forget a link and take the users of that node offline"""
+        with self.links_lock:
+            if self.links.get(link.node_id) is not link:
+                return  # Replaced by a newer link to the same node
+            del self.links[link.node_id]
+        with self.remote_lock:
+            self.peer_links.pop(link.node_id, None)
+        if self.stopping:
+            return  # This node is shutting down or handing off; its clients stay as they are
+        with self.remote_lock:
+            sessions = self.remote_sessions.pop(link.node_id, {})
+            self.presence_seq.pop(link.node_id, None)
+        for username, count in sessions.items():
+            self.apply_session_change(username, -count)
+        print(f"Node {self.node_id} lost link to {link.node_id}")
+        self.announce_links()
+        if sessions:
+            notice = ChatMessage(
+                MessageType.SYSTEM, "System",
+                f"Lost server node {link.node_id}; {len(sessions)} users went offline"
+            )
+            # Every node sees the loss; with a shared log, none of them logs it
+            self.server.broadcast_message(notice, None, relay=False, log=self.log_relayed)
+
+    def send_sync(self, link: PeerLink):
+        """Send this node's current sessions over a new link"""
+        with self.lock:
+            message = create_relay_message(
+                self.node_id, self.seq, "sync", sessions=dict(self.local_sessions)
+            )
+            self.send_to_link(link, message)
+
+    def announce_links(self):
+        """Tell every peer which nodes this one is linked to"""
+        with self.links_lock:
+            links = list(self.links.values())
+            nodes = sorted(self.links)
+        message = create_relay_message(self.node_id, self.seq, "links", nodes=nodes)
+        for link in links:
+            self.send_to_link(link, message)
+
+    def check_mesh(self) -> set:
+        """Warn about nodes a peer is linked to but this one isn't; returns them"""
+        with self.links_lock:
+            linked = set(self.links)
+        with self.remote_lock:
+            known = set().union(*self.peer_links.values())
+        unlinked = known - linked - {self.node_id}
+        for node_id in sorted(unlinked - self.unlinked):
+            log_error("federation", f"Node {self.node_id} has no link to node {node_id}; nothing "
+                                    f"is forwarded, so their users can't see each other. List every "
+                                    f"node started earlier in --peers.")
+        self.unlinked = unlinked
+        return unlinked
+
+    def send_to_link(self, link: PeerLink, message: bytes):
+        try:
+            link.send(message)
+        except OSError as e:
+            log_error("federation", f"Send to {link.node_id} failed: {e}")
+            link.close()  # The link's reader notices and drops it
+
+    def send_to_peers(self, message: bytes):
+        with self.links_lock:
+            links = list(self.links.values())
+        for link in links:
+            self.send_to_link(link, message)
+
+    def relay_chat(self, message: ChatMessage):
+        """Relay a message this node broadcast to its own clients"""
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+        frame = message.encode().rstrip(MESSAGE_DELIMITER).decode('utf-8')
+        self.send_to_peers(create_relay_message(self.node_id, seq, "chat", frame=frame))
+
+    def relay_event(self, event: EphemeralEvent):
+        """Relay an ephemeral event this node sent to its own clients, already coalesced"""
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+        frame = event.encode().rstrip(MESSAGE_DELIMITER).decode('utf-8')
+        self.send_to_peers(create_relay_message(self.node_id, seq, "event", frame=frame))
+
+    def publish_presence(self, username: str, change: int):
+        """Record a local session joining (+1) or leaving (-1) and tell the peers"""
+        with self.lock:
+            sessions = self.local_sessions.get(username, 0) + change
+            if sessions > 0:
+                self.local_sessions[username] = sessions
+            else:
+                self.local_sessions.pop(username, None)
+            self.seq += 1
+            self.send_to_peers(create_relay_message(
+                self.node_id, self.seq, "presence", username=username, sessions=max(sessions, 0)
+            ))
+
+    def handle_peer_message(self, link: PeerLink, frame):
+        """Handle one delimited frame from a peer (a view into its receive buffer)"""
+        data = parse_message(frame)
+        if data["type"] != MessageType.RELAY.value:
+            return
+        origin, seq, kind = data["origin"], data["seq"], data["kind"]
+
+        if kind == "sync":
+            # Only ever describes the node at the other end of this link
+            self.apply_sessions(origin, seq, data["sessions"], replace=True)
+            return
+        if kind == "links":
+            with self.remote_lock:
+                self.peer_links[origin] = set(data["nodes"])
+            # Links made around the same time may still be on their way
+            timer = threading.Timer(MESH_CHECK_DELAY, self.check_mesh)
+            timer.daemon = True
+            timer.start()
+            return
+        if origin == self.node_id:
+            return
+        with self.seen_lock:
+            if self.seen.get((origin, seq)) is not None:
+                return
+            self.seen.put((origin, seq), seq)
+
+        if kind == "chat":
+            try:
+                message = ChatMessage.decode(data["frame"].encode('utf-8') + MESSAGE_DELIMITER)
+            except InvalidMessage as e:
+                log_error("federation", f"Bad relayed message from {origin}: {e}")
+                return
+            self.server.broadcast_message(message, None, relay=False, log=self.log_relayed)
+        elif kind == "event":
+            try:
+                event = EphemeralEvent.decode(data["frame"].encode('utf-8') + MESSAGE_DELIMITER)
+            except InvalidMessage as e:
+                log_error("federation", f"Bad relayed event from {origin}: {e}")
+                return
+            self.server.broadcast_event(None, event, relay=False)
+        elif kind == "presence":
+            self.apply_sessions(origin, seq, {data["username"]: data["sessions"]})
+
+    def apply_sessions(self, origin: str, seq: int, sessions: dict, replace: bool = False):
+        """Bring origin's session counts up to date, ignoring stale presence"""
+        with self.remote_lock:
+            if seq < self.presence_seq.get(origin, -1):
+                return
+            self.presence_seq[origin] = seq
+            known = self.remote_sessions.setdefault(origin, {})
+            usernames = set(sessions) | (set(known) if replace else set())
+            changes = []
+            for username in usernames:
+                count = sessions.get(username, 0)
+                changes.append((username, count - known.get(username, 0)))
+                if count:
+                    known[username] = count
+                else:
+                    known.pop(username, None)
+        for username, change in changes:
+            self.apply_session_change(username, change)
+
+    def apply_session_change(self, username: str, change: int):
+        """Apply remote sessions to the local roster, announcing any presence change"""
+        roster = self.server.roster
+        for _ in range(abs(change)):
+            if change > 0:
+                self.server.announce_presence(roster.join(username), "join", username)
+            else:
+                self.server.announce_presence(roster.leave(username), "leave", username)
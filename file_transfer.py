@@ -0,0 +1,191 @@
+import json
+import os
+import re
+import socket
+import threading
+import uuid
+from protocol import (
+    MessageType, MessageReader, create_file_chunk_header, create_file_request,
+    parse_message, log_error
+)
+
+UPLOAD_DIR = 'uploads'
+CHUNK_SIZE = 1024 * 1024  # Bytes per FILE_CHUNK on upload
+RECEIVE_BUFFER = 256 * 1024  # File bodies pass through the reader's buffer, so read them in big pieces
+MAX_FILE_SIZE = 4 * 1024 ** 3
+FILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+class FileStore:
+    """Shared files on disk.
+
+    Each file is <id>.data plus a <id>.json sidecar. Metadata lives only on
+    disk, so any worker process can accept an upload offered on another one
+    or serve a download for it.
+    """
+    def __init__(self, directory: str = UPLOAD_DIR, max_size: int = MAX_FILE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def data_path(self, file_id: str) -> str:
+        return os.path.join(self.directory, f"{file_id}.data")
+
+    def _meta_path(self, file_id: str) -> str:
+        return os.path.join(self.directory, f"{file_id}.json")
+
+    def _write_meta(self, file_id: str, meta: dict):
+        temp_path = self._meta_path(file_id) + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self._meta_path(file_id))
+
+    def offer(self, username: str, name: str, size: int) -> str:
+        """Reserve an ID for an upload; returns None if the file is too large"""
+        if size < 0 or size > self.max_size:
+            return None
+        file_id = uuid.uuid4().hex
+        self._write_meta(file_id, {
+            "name": os.path.basename(name),
+            "size": size,
+            "username": username,
+            "complete": False
+        })
+        return file_id
+
+    def lookup(self, file_id: str) -> dict:
+        """Return a file's metadata, or None for unknown or malformed IDs"""
+        if not FILE_ID_PATTERN.match(file_id or ""):
+            return None
+        try:
+            with open(self._meta_path(file_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def mark_complete(self, file_id: str, meta: dict):
+        meta["complete"] = True
+        self._write_meta(file_id, meta)
+
+class FileServer:
+    """Side channel that moves file bodies off the chat connections.
+
+    Uploads arrive as FILE_CHUNK headers each followed by raw bytes, written
+    to disk through a fixed-size buffer. Downloads are served with
+    os.sendfile straight from the page cache. Every transfer has its own
+    connection and thread, so chat traffic never waits behind a file.
+    """
+    def __init__(self, store: FileStore, host: str, port: int, on_upload=None, reuse_port: bool = False):
+        self.store = store
+        self.on_upload = on_upload  # Called with (file_id, meta) once an upload completes
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.listen_socket.bind((host, port))
+        self.listen_socket.listen(16)
+        self.port = self.listen_socket.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self.accept_transfers, daemon=True).start()
+
+    def stop(self):
+        # Shutting down wakes the accept thread; a bare close would leave the
+        # port bound until the next connection came in
+        try:
+            self.listen_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listen_socket.close()
+
+    def accept_transfers(self):
+        while True:
+            try:
+                sock, _ = self.listen_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_transfer, args=(sock,), daemon=True).start()
+
+    def handle_transfer(self, sock):
+        reader = MessageReader(sock, bufsize=RECEIVE_BUFFER)
+        try:
+            message = reader.read_message()
+            request = parse_message(message) if message else None
+            if request is None:
+                return
+            if request["type"] == MessageType.FILE_CHUNK.value:
+                self.receive_upload(reader, request)
+            elif request["type"] == MessageType.FILE_REQUEST.value:
+                self.send_download(sock, request["file_id"])
+        except (OSError, ValueError, KeyError) as e:
+            log_error("file_transfer", str(e))
+        finally:
+            sock.close()
+
+    def receive_upload(self, reader: MessageReader, header: dict):
+        file_id = header["file_id"]
+        meta = self.store.lookup(file_id)
+        if meta is None or meta["complete"]:
+            log_error("file_transfer", f"Upload for unknown file {file_id}")
+            return
+        received = 0
+        with open(self.store.data_path(file_id), 'wb') as f:
+            while header["length"]:
+                if header["offset"] != received or received + header["length"] > meta["size"]:
+                    raise ValueError(f"Chunk out of range for file {file_id}")
+                reader.read_body(header["length"], f.write)
+                received += header["length"]
+                message = reader.read_message()
+                if message is None:
+                    raise ConnectionError(f"Upload of {file_id} cut short")
+                header = parse_message(message)
+        if received != meta["size"]:
+            raise ValueError(f"Upload of {file_id} ended at {received} of {meta['size']} bytes")
+        self.store.mark_complete(file_id, meta)
+        if self.on_upload:
+            self.on_upload(file_id, meta)
+
+    def send_download(self, sock, file_id: str):
+        meta = self.store.lookup(file_id)
+        if meta is None or not meta["complete"]:
+            sock.sendall(create_file_chunk_header(file_id, 0, -1))
+            return
+        sock.sendall(create_file_chunk_header(file_id, 0, meta["size"], meta["name"]))
+        with open(self.store.data_path(file_id), 'rb') as f:
+            offset = 0
+            while offset < meta["size"]:
+                sent = os.sendfile(sock.fileno(), f.fileno(), offset, meta["size"] - offset)
+                if not sent:
+                    break
+                offset += sent
+
+def upload_file(address, file_id: str, path: str, chunk_size: int = CHUNK_SIZE):
+    """Stream a local file to the file server in FILE_CHUNK pieces"""
+    with socket.create_connection(address) as sock, open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset < size:
+            length = min(chunk_size, size - offset)
+            sock.sendall(create_file_chunk_header(file_id, offset, length))
+            sock.sendfile(f, offset, length)
+            offset += length
+        sock.sendall(create_file_chunk_header(file_id, offset, 0))
+        # Returns once the server has stored the file and closed the connection
+        sock.shutdown(socket.SHUT_WR)
+        sock.recv(1)
+
+def download_file(address, file_id: str, directory: str = 'downloads') -> str:
+    """Fetch a shared file into directory; returns the saved path"""
+    with socket.create_connection(address) as sock:
+        sock.sendall(create_file_request(file_id))
+        reader = MessageReader(sock, bufsize=RECEIVE_BUFFER)
+        message = reader.read_message()
+        if message is None:
+            raise ConnectionError("File server closed the connection")
+        header = parse_message(message)
+        if header["length"] < 0:
+            raise FileNotFoundError(f"No shared file with ID {file_id}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, os.path.basename(header["name"]))
+        with open(path, 'wb') as f:
+            reader.read_body(header["length"], f.write)
+        return path
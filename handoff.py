@@ -0,0 +1,134 @@
+import json
+import os
+import socket
+import threading
+import time
+from protocol import log_error
+
+RECORD_SIZE = 65536  # Largest handoff record; they hold one client's state each
+
+def send_record(sock, record: dict, fds=()):
+    """Send one JSON record, passing any file descriptors along with it"""
+    socket.send_fds(sock, [json.dumps(record).encode('utf-8')], list(fds))
+
+def recv_record(sock) -> tuple:
+    """Receive one record; returns (record, sockets), or (None, []) once the sender is gone"""
+    data, fds, _, _ = socket.recv_fds(sock, RECORD_SIZE, 1)
+    sockets = [socket.socket(fileno=fd) for fd in fds]
+    if not data:
+        return None, sockets
+    return json.loads(data), sockets
+
+class Handoff:
+    """Graceful upgrade: hands a running server's connections to its successor.
+
+    The server listens on a UNIX socket at path. A new server process that
+    connects there is sent the listening socket and every logged-in client
+    with its username and retry cache, as file descriptors over SCM_RIGHTS.
+    Handlers stop reading at a message boundary, so nothing buffered is left
+    behind, and sends already under way finish before anything is passed on.
+    Clients stay connected throughout; their messages wait in the kernel
+    until the new process reads them.
+    """
+    def __init__(self, server, path: str, drain_timeout: float = 5.0):
+        self.server = server
+        self.path = path
+        self.drain_timeout = drain_timeout
+        # Readable once a handoff starts; handlers and the accept loop wait
+        # on it next to their own socket
+        self.wakeup, self.trigger = socket.socketpair()
+        self.requested = threading.Event()
+        self.finished = threading.Event()
+        self.clients = []  # (socket, username, DedupCache) passed on by handlers
+        self.clients_lock = threading.Lock()
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.listen_socket.bind(self.path)
+        self.listen_socket.listen(1)
+        threading.Thread(target=self.wait_for_successor, daemon=True).start()
+        print(f"Accepting a successor server on {self.path}")
+
+    def wait_for_successor(self):
+        try:
+            conn, _ = self.listen_socket.accept()
+        except OSError:
+            return
+        # The successor listens here next
+        self.listen_socket.close()
+        os.unlink(self.path)
+        try:
+            self.hand_over(conn)
+        except OSError as e:
+            log_error("handoff", str(e))
+        finally:
+            conn.close()
+            self.finished.set()
+
+    def pass_client(self, sock, username: str, dedup):
+        """Called by a client handler that stopped reading for the handoff"""
+        with self.clients_lock:
+            self.clients.append((sock, username, dedup))
+
+    def hand_over(self, conn):
+        server = self.server
+        paused_at = time.time()
+        self.requested.set()
+        self.trigger.send(b"!")  # Never read, so it wakes every waiter
+
+        server.reaper.stop()
+        server.events.stop()
+        server.archiver.stop()
+        server.accept_stopped.wait()
+        if server.federation:
+            server.federation.stop()
+        if not server.wait_for_handlers(self.drain_timeout):
+            log_error("handoff", "Some clients didn't reach a message boundary and are dropped")
+            # Their handlers see the connection close and finish before the
+            # scheduler they send through stops
+            server.close_handlers()
+            server.wait_for_handlers(self.drain_timeout)
+        # Let sends already queued for the clients finish
+        server.outbound.stop()
+        server.file_server.stop()
+        server.search_index.close()
+
+        with self.clients_lock:
+            clients = list(self.clients)
+        for sock, username, dedup in clients:
+            send_record(conn, {
+                "kind": "client",
+                "username": username,
+                "dedup": [[msg_id, seq] for msg_id, (seq, _) in dedup.entries.items()]
+            }, [sock.fileno()])
+        send_record(conn, {
+            "kind": "state",
+            "paused_at": paused_at,
+            "sequence": server.sequence,
+            "roster_version": server.roster.version,
+            "federation_seq": server.federation.seq if server.federation else 0,
+            "file_port": server.file_server.port
+        }, [server.server_socket.fileno()])
+        print(f"Handed {len(clients)} clients to the new server")
+
+def take_over(path: str) -> tuple:
+    """Take the listening socket and clients from the server handing off at path.
+
+    Returns (state, listening socket, [(socket, username, dedup entries)]).
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    conn.connect(path)
+    clients = []
+    try:
+        while True:
+            record, sockets = recv_record(conn)
+            if record is None:
+                raise ConnectionError("Old server exited before handing off its listener")
+            if record["kind"] == "client":
+                clients.append((sockets[0], record["username"], record["dedup"]))
+            elif record["kind"] == "state":
+                return record, sockets[0], clients
+    finally:
+        conn.close()
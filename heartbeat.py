@@ -0,0 +1,121 @@
+import socket
+import threading
+import time
+from protocol import create_ping_message
+from timer_wheel import TimerWheel
+
+PING_INTERVAL = 30.0  # Quiet seconds before a logged-in client is pinged
+IDLE_TIMEOUT = 90.0  # Quiet seconds before any connection is dropped
+
+class IdleReaper:
+    """Finds half-open client connections and closes them.
+
+    Handlers only record the time of each frame they read. Every connection
+    has one timer in a shared timer wheel; when it fires the reaper looks at
+    how long the connection has been quiet and pings it, drops it, or files
+    a new timer for when it could next need attention. Busy connections
+    therefore cost a dict store per message and one wheel operation per
+    ping interval.
+
+    Pings are written straight to the socket without blocking, unless a
+    send function is given to queue them, e.g. on the server's outbound
+    scheduler.
+    """
+    def __init__(self, ping_interval: float = PING_INTERVAL, idle_timeout: float = IDLE_TIMEOUT,
+                 tick: float = 1.0, clock=time.monotonic, send=None):
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.tick = tick
+        self.clock = clock
+        self.send = send
+        self.wheel = TimerWheel(tick, start=clock())
+        self.last_activity = {}  # socket -> clock time of its last frame
+        self.logged_in = set()  # Only these understand PING; the rest are mid-handshake
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            time.sleep(self.tick)
+            if self.running:
+                self.check()
+
+    def watch(self, sock, logged_in: bool = False):
+        """Start tracking a new connection"""
+        now = self.clock()
+        with self.lock:
+            self.last_activity[sock] = now
+            if logged_in:
+                self.logged_in.add(sock)
+            self.wheel.schedule(sock, now + self._quiet_limit(sock))
+
+    def mark_logged_in(self, sock):
+        """The handshake is done, so the connection can be pinged from now on"""
+        now = self.clock()
+        with self.lock:
+            if sock in self.last_activity:
+                self.logged_in.add(sock)
+                self.last_activity[sock] = now
+                self.wheel.schedule(sock, now + self.ping_interval)
+
+    def touch(self, sock):
+        """Record traffic on a connection; called for every frame, so it only stores a time"""
+        self.last_activity[sock] = self.clock()
+
+    def forget(self, sock):
+        with self.lock:
+            self.wheel.cancel(sock)
+            self.last_activity.pop(sock, None)
+            self.logged_in.discard(sock)
+
+    def _quiet_limit(self, sock) -> float:
+        return self.ping_interval if sock in self.logged_in else self.idle_timeout
+
+    def check(self) -> list:
+        """Handle the timers that came due; returns the connections dropped"""
+        now = self.clock()
+        to_ping = []
+        to_drop = []
+        with self.lock:
+            for sock in self.wheel.advance(now):
+                last = self.last_activity.get(sock)
+                if last is None:
+                    continue
+                idle = now - last
+                if idle >= self.idle_timeout:
+                    to_drop.append(sock)
+                elif sock in self.logged_in and idle >= self.ping_interval:
+                    to_ping.append(sock)
+                    self.wheel.schedule(sock, last + self.idle_timeout)
+                else:
+                    self.wheel.schedule(sock, last + self._quiet_limit(sock))
+
+        ping = create_ping_message()
+        for sock in to_ping:
+            if self.send is not None:
+                self.send(sock, ping)
+                continue
+            try:
+                # Never block here: a peer that isn't reading will be dropped anyway
+                if sock.send(ping, socket.MSG_DONTWAIT) == len(ping):
+                    continue
+            except BlockingIOError:
+                continue  # Send buffer full; nothing was written
+            except OSError:
+                pass
+            to_drop.append(sock)  # Dead, or a partial write that broke the framing
+        for sock in to_drop:
+            self.forget(sock)
+            try:
+                # Wakes the handler's recv, which then removes the client
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return to_drop
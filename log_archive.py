@@ -0,0 +1,198 @@
+import gzip
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from search_index import journal_date_sizes
+
+LOG_DIR = 'logs'
+RETENTION_DAYS = 90
+MAX_ARCHIVE_BYTES = 1024 ** 3
+ARCHIVE_INTERVAL = 3600.0  # Seconds between archival passes
+SETTLE_SECONDS = 3600.0  # A log must be this long untouched before it is archived
+COPY_CHUNK = 256 * 1024
+
+# Daily logs written by ChatServer.log_message and setup_logging
+LOG_NAME_PATTERN = re.compile(r"^(chat_log|debug)_(\d{4}-\d{2}-\d{2})\.(txt|log)$")
+CHAT_LINE_PATTERN = re.compile(r"^\[(\d{2}:\d{2}:\d{2})\] (.*?): (.*)$")
+# Search index journals, one per server process sharing the directory
+INDEX_NAME_PATTERN = re.compile(r"^search_index.*\.jsonl$")
+
+class LogArchiver:
+    """Background job that compresses finished daily logs and prunes old ones.
+
+    A chat or debug log is archived to <directory>/archive/<name>.gz once its
+    day is over and nothing has written to it for an hour. Archives older
+    than the retention period are deleted, then the oldest go until the
+    archive fits in max_archive_bytes. The search index journals in the
+    directory count toward that cap, and a day's index entries go with its
+    archives. The job runs in one thread at the lowest CPU priority and
+    copies in small chunks, so it never holds up the message path. Archived
+    logs stay readable through open_log and chat_history, which stream them
+    without unpacking to disk.
+
+    With archive_logs=False, another process archives and prunes the logs,
+    and this one only drops entries from its own search_index whose chat
+    log is gone.
+    """
+    def __init__(self, directory: str = LOG_DIR, retention_days: int = RETENTION_DAYS,
+                 max_archive_bytes: int = MAX_ARCHIVE_BYTES, interval: float = ARCHIVE_INTERVAL,
+                 settle_seconds: float = SETTLE_SECONDS, search_index=None, archive_logs: bool = True):
+        self.directory = directory
+        self.search_index = search_index  # This process's SearchIndex, kept in step with the logs
+        self.archive_logs = archive_logs
+        self.archive_directory = os.path.join(directory, 'archive')
+        self.retention_days = retention_days
+        self.max_archive_bytes = max_archive_bytes
+        self.interval = interval
+        self.settle_seconds = settle_seconds
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        # Linux schedules threads individually, so only this one is reniced
+        if sys.platform.startswith('linux'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            except OSError:
+                pass
+        while not self.stopped.is_set():
+            try:
+                self.run_once()
+            except OSError as e:
+                logging.error(f"Error (log_archive): {e}")
+            self.stopped.wait(self.interval)
+
+    def run_once(self, now: datetime = None) -> dict:
+        """Archive every finished log, then apply retention; returns what was done"""
+        now = now or datetime.now()
+        today = now.strftime('%Y-%m-%d')
+        archived = []
+        deleted = []
+        if self.archive_logs:
+            archived = self.archive_finished(now, today)
+            deleted = self.prune(now)
+        return {'archived': archived, 'deleted': deleted, 'unindexed': self.compact_index(now)}
+
+    def archive_finished(self, now: datetime, today: str) -> list:
+        archived = []
+        for name in sorted(os.listdir(self.directory)):
+            match = LOG_NAME_PATTERN.match(name)
+            if not match or match.group(2) >= today:
+                continue
+            path = os.path.join(self.directory, name)
+            if now.timestamp() - os.path.getmtime(path) < self.settle_seconds:
+                continue  # Something may still be writing to it
+            if self._open_in_this_process(path):
+                continue
+            self.archive(name)
+            archived.append(name)
+        return archived
+
+    def _open_in_this_process(self, path: str) -> bool:
+        """True for the debug log a long-running process's file handler still writes to"""
+        path = os.path.abspath(path)
+        return any(getattr(handler, 'baseFilename', None) == path
+                   for handler in logging.getLogger().handlers)
+
+    def archive(self, name: str):
+        """Compress one log into the archive and remove the original"""
+        os.makedirs(self.archive_directory, exist_ok=True)
+        source = os.path.join(self.directory, name)
+        target = os.path.join(self.archive_directory, name + '.gz')
+        # Unique per process, so workers sharing the directory can't collide
+        temp_path = f"{target}.{os.getpid()}.tmp"
+        with open(source, 'rb') as f, gzip.open(temp_path, 'wb') as out:
+            while True:
+                chunk = f.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                out.write(chunk)
+                time.sleep(0)  # Let the message path have the GIL between chunks
+        os.replace(temp_path, target)
+        try:
+            os.unlink(source)
+        except FileNotFoundError:
+            pass  # Archived by another worker at the same time
+
+    def prune(self, now: datetime) -> list:
+        """Delete archived days past the retention period, then oldest first until under the size cap"""
+        if not os.path.isdir(self.archive_directory):
+            return []
+        cutoff = (now - timedelta(days=self.retention_days)).strftime('%Y-%m-%d')
+        archives = {}  # date -> [(name, size)]
+        for name in os.listdir(self.archive_directory):
+            match = LOG_NAME_PATTERN.match(name[:-3]) if name.endswith('.gz') else None
+            if match:
+                path = os.path.join(self.archive_directory, name)
+                archives.setdefault(match.group(2), []).append((name, os.path.getsize(path)))
+        indexed = self.index_sizes()
+        deleted = []
+        total = sum(size for day in archives.values() for _, size in day) + sum(indexed.values())
+        for date in sorted(archives):
+            if date >= cutoff and total <= self.max_archive_bytes:
+                break
+            for name, size in sorted(archives[date]):
+                os.unlink(os.path.join(self.archive_directory, name))
+                deleted.append(name)
+                total -= size
+            # Dropped from the journals by compact_index once the chat log is gone
+            total -= indexed.get(date, 0)
+        return deleted
+
+    def index_sizes(self) -> dict:
+        """Bytes per day across every search index journal in the directory"""
+        sizes = {}
+        for name in os.listdir(self.directory):
+            if INDEX_NAME_PATTERN.match(name):
+                for date, size in journal_date_sizes(os.path.join(self.directory, name)).items():
+                    sizes[date] = sizes.get(date, 0) + size
+        return sizes
+
+    def compact_index(self, now: datetime) -> int:
+        """Drop search index entries past retention or older than every chat log left"""
+        if self.search_index is None:
+            return 0
+        keep_from = (now - timedelta(days=self.retention_days)).strftime('%Y-%m-%d')
+        dates = self.log_dates('chat_log')
+        if dates:
+            keep_from = max(keep_from, dates[0])
+        return self.search_index.compact(keep_from)
+
+    def open_log(self, name: str):
+        """Open a daily log for reading as text, wherever it currently lives"""
+        try:
+            return open(os.path.join(self.directory, name), encoding='utf-8', errors='replace')
+        except FileNotFoundError:
+            pass
+        return gzip.open(os.path.join(self.archive_directory, name + '.gz'), 'rt',
+                         encoding='utf-8', errors='replace')
+
+    def log_dates(self, kind: str = 'chat_log') -> list:
+        """Dates that have a log of the given kind, live or archived, oldest first"""
+        dates = set()
+        for directory in (self.directory, self.archive_directory):
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                match = LOG_NAME_PATTERN.match(name[:-3] if name.endswith('.gz') else name)
+                if match and match.group(1) == kind:
+                    dates.add(match.group(2))
+        return sorted(dates)
+
+    def chat_history(self):
+        """Yield (date, timestamp, username, content) for every logged message, oldest first"""
+        for date in self.log_dates('chat_log'):
+            with self.open_log(f"chat_log_{date}.txt") as f:
+                for line in f:
+                    match = CHAT_LINE_PATTERN.match(line.rstrip('\n'))
+                    if match:
+                        yield (date,) + match.groups()
@@ -0,0 +1,361 @@
+import selectors
+import socket
+import threading
+from collections import deque
+from protocol import MessageType
+
+# Lanes, highest priority first
+CONTROL = 0  # Handshake and message acks, errors, pings, replies to requests
+SYSTEM = 1  # Join/leave notices and roster deltas
+CHAT = 2
+LANES = (CONTROL, SYSTEM, CHAT)
+
+# Lane for each broadcastable message type; anything else is control traffic
+MESSAGE_LANES = {
+    MessageType.CHAT: CHAT,
+    MessageType.SYSTEM: SYSTEM,
+    MessageType.JOIN: SYSTEM,
+    MessageType.LEAVE: SYSTEM,
+    MessageType.PRESENCE: SYSTEM,
+    MessageType.TYPING: CHAT,
+}
+
+QUANTUM = 16 * 1024  # Bytes of system and chat traffic a weight-1 connection gets per turn
+MAX_QUEUED_BYTES = 4 * 1024 * 1024  # A connection this far behind is dropped as too slow
+MAX_PENDING_CHAT = 64 * 1024 * 1024  # Chat senders wait while this much chat is queued overall
+
+class OutboundQueue:
+    """Messages waiting to be written to one connection, one deque per lane"""
+    __slots__ = ('sock', 'lanes', 'weight', 'deficit', 'queued_bytes', 'ring', 'busy', 'parked', 'closed')
+
+    def __init__(self, sock, weight: int = 1):
+        self.sock = sock
+        self.lanes = (deque(), deque(), deque())
+        self.weight = weight
+        self.deficit = 0  # Bytes this connection may still send this round
+        self.queued_bytes = 0
+        self.ring = None  # Lane of the ready ring this queue is waiting in
+        self.busy = False  # A sender thread is writing to it, or it is parked
+        self.parked = False  # Waiting for its socket to take more data
+        self.closed = False
+
+    def first_lane(self) -> int:
+        for lane in LANES:
+            if self.lanes[lane]:
+                return lane
+        return None
+
+class OutboundScheduler:
+    """Send queues for client connections, drained by a few sender threads.
+
+    Every message goes into its connection's control, system or chat lane.
+    Connections with something to send wait in one ready ring per lane, and
+    sender threads always serve the highest-priority ring first, so an ack
+    or error reply is never stuck behind chat traffic for other clients. A
+    connection's own control messages go out ahead of anything it has
+    queued. System and chat traffic is shared between connections by
+    deficit round robin: each turn a connection may send up to its weight
+    times QUANTUM bytes, then goes to the back of the ring.
+
+    Sender threads never block on a socket. What a full socket doesn't take
+    stays at the front of its queue, and the connection is parked until a
+    watcher thread sees the socket writable again, so clients that stop
+    reading can't tie up the senders and stall everyone else.
+
+    A connection that falls MAX_QUEUED_BYTES behind is shut down, which its
+    handler sees as a disconnect. While too much chat is queued overall,
+    chat broadcasts wait for the senders to catch up, so a flood slows its
+    senders down instead of growing memory.
+
+    With priority=False everything shares the chat lane in arrival order,
+    which is how the server sent before lanes existed. With no sender
+    threads, flush() does all the sending in the caller's thread.
+    """
+    def __init__(self, threads: int = 4, priority: bool = True, quantum: int = QUANTUM,
+                 max_queued_bytes: int = MAX_QUEUED_BYTES, max_pending_chat: int = MAX_PENDING_CHAT):
+        self.threads = threads
+        self.priority = priority
+        self.quantum = quantum
+        self.max_queued_bytes = max_queued_bytes
+        self.max_pending_chat = max_pending_chat
+        self.queues = {}  # socket -> OutboundQueue
+        self.rings = (deque(), deque(), deque())
+        self.pending_chat = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.space = threading.Condition(self.lock)
+        self.stopping = False
+        self.senders = []
+        # Parked connections, and the thread waiting for their sockets
+        self.parked = 0
+        self.to_park = []
+        self.to_unpark = []
+        self.selector = None
+        self.wakeup = self.wakeup_writer = None
+        self.watcher = None
+
+    def start(self):
+        if self.threads:
+            self.selector = selectors.DefaultSelector()
+            self.wakeup, self.wakeup_writer = socket.socketpair()
+            self.wakeup_writer.setblocking(False)
+            self.selector.register(self.wakeup, selectors.EVENT_READ)
+            self.watcher = threading.Thread(target=self.watch_writable, daemon=True)
+            self.watcher.start()
+        for _ in range(self.threads):
+            sender = threading.Thread(target=self.run, daemon=True)
+            sender.start()
+            self.senders.append(sender)
+
+    def stop(self):
+        """Let the sender threads finish what is queued, then end them"""
+        with self.lock:
+            self.stopping = True
+            self.ready.notify_all()
+        for sender in self.senders:
+            sender.join()
+        self.senders = []
+        if self.watcher is not None:
+            with self.lock:
+                self._wake_watcher()
+            self.watcher.join()
+            self.watcher = None
+            self.selector.close()
+            self.wakeup.close()
+            self.wakeup_writer.close()
+
+    def register(self, sock, weight: int = 1):
+        """Start queueing for a connection; registering it again changes nothing"""
+        with self.lock:
+            if sock not in self.queues:
+                self.queues[sock] = OutboundQueue(sock, weight)
+
+    def set_weight(self, sock, weight: int):
+        """Give a connection weight times the usual share of system and chat sending"""
+        with self.lock:
+            queue = self.queues.get(sock)
+            if queue is not None:
+                queue.weight = weight
+
+    def forget(self, sock):
+        """Drop a connection and whatever it still had queued"""
+        with self.lock:
+            queue = self.queues.pop(sock, None)
+            if queue is not None:
+                self._discard(queue)
+
+    def send(self, sock, message: bytes, lane: int = CONTROL):
+        """Queue a message for one connection.
+
+        Control messages for a connection with nothing queued are written at
+        once from the calling thread, saving the hand-off to a sender. That
+        write never blocks: whatever the socket buffer can't take is queued
+        and sent once the socket drains, so a client that isn't reading can't
+        hold up the caller, such as the idle reaper pinging everyone.
+        """
+        if lane == CONTROL and self.priority and self.senders:
+            with self.lock:
+                queue = self.queues.get(sock)
+                idle = queue is not None and not (queue.busy or queue.closed or queue.queued_bytes)
+                if idle:
+                    queue.busy = True
+            if idle:
+                self._write(queue, [message], blocking=False)
+                return
+        self.send_many((sock,), message, lane)
+
+    def send_many(self, socks, message: bytes, lane: int):
+        """Queue the same message for several connections"""
+        if not self.priority:
+            lane = CHAT
+        too_slow = []
+        with self.lock:
+            if lane == CHAT and self.senders:
+                self.space.wait_for(lambda: self.pending_chat < self.max_pending_chat
+                                    or self.stopping)
+            size = len(message)
+            for sock in socks:
+                queue = self.queues.get(sock)
+                if queue is None or queue.closed:
+                    continue
+                if queue.queued_bytes + size > self.max_queued_bytes:
+                    self._discard(queue)
+                    too_slow.append(sock)
+                    continue
+                queue.lanes[lane].append(message)
+                queue.queued_bytes += size
+                if lane == CHAT:
+                    self.pending_chat += size
+                if not queue.busy and (queue.ring is None or lane < queue.ring):
+                    # Stale entries left in lower rings are skipped when reached
+                    queue.ring = lane
+                    self.rings[lane].append(queue)
+                    self.ready.notify()
+        for sock in too_slow:
+            self._shutdown(sock)
+
+    def run(self):
+        while True:
+            with self.lock:
+                job = self._next()
+                while job is None:
+                    # Parked connections still have queued bytes to finish
+                    if self.stopping and not self.parked:
+                        return
+                    self.ready.wait()
+                    job = self._next()
+            self._write(*job, blocking=False)
+
+    def watch_writable(self):
+        """Hand parked connections back to the senders once their sockets take data again"""
+        while True:
+            events = self.selector.select()
+            with self.lock:
+                for key, _ in events:
+                    if key.fileobj is self.wakeup:
+                        try:
+                            self.wakeup.recv(4096)
+                        except BlockingIOError:
+                            pass
+                        continue
+                    self.selector.unregister(key.fileobj)
+                    self._unpark(key.data)
+                # Forgotten connections first: their socket may already be
+                # closed and its descriptor reused by one being parked below
+                for queue in self.to_unpark:
+                    try:
+                        self.selector.unregister(queue.sock)
+                    except (KeyError, ValueError):
+                        pass  # Never registered, or already handed back
+                    self._unpark(queue)
+                for queue in self.to_park:
+                    if queue.parked:
+                        self.selector.register(queue.sock, selectors.EVENT_WRITE, queue)
+                self.to_unpark.clear()
+                self.to_park.clear()
+                if self.stopping and not self.parked:
+                    return
+
+    def flush(self):
+        """Send everything queued, in scheduling order, from the calling thread"""
+        while True:
+            with self.lock:
+                job = self._next()
+            if job is None:
+                return
+            self._write(*job)
+
+    def _next(self):
+        """Take the next connection to serve and the bytes it may send now; caller holds the lock"""
+        for lane in LANES:
+            ring = self.rings[lane]
+            while ring:
+                queue = ring.popleft()
+                if queue.busy or queue.closed or queue.ring != lane:
+                    continue
+                queue.ring = None
+                queue.busy = True
+                return queue, self._take(queue, lane)
+        return None
+
+    def _take(self, queue, ring: int) -> list:
+        control = queue.lanes[CONTROL]
+        batch = list(control)
+        control.clear()
+        if ring != CONTROL:
+            # Deficit round robin over system and chat traffic
+            queue.deficit += self.quantum * queue.weight
+            for lane in (SYSTEM, CHAT):
+                messages = queue.lanes[lane]
+                while messages and len(messages[0]) <= queue.deficit:
+                    message = messages.popleft()
+                    queue.deficit -= len(message)
+                    batch.append(message)
+                    if lane == CHAT:
+                        self.pending_chat -= len(message)
+            if not queue.lanes[SYSTEM] and not queue.lanes[CHAT]:
+                queue.deficit = 0  # Unused allowance doesn't carry over an idle spell
+            self.space.notify_all()
+        queue.queued_bytes -= sum(len(message) for message in batch)
+        return batch
+
+    def _write(self, queue, batch: list, blocking: bool = True):
+        rest = b""
+        try:
+            if batch:
+                # One write per turn, however many messages it carries
+                data = b"".join(batch)
+                if blocking:
+                    queue.sock.sendall(data)
+                else:
+                    try:
+                        sent = queue.sock.send(data, socket.MSG_DONTWAIT)
+                    except BlockingIOError:
+                        sent = 0
+                    rest = data[sent:]
+        except OSError as e:
+            print(f"Error sending message: {e}")
+            with self.lock:
+                self._discard(queue)
+            # Shutting down wakes the handler's recv, which then removes the client
+            self._shutdown(queue.sock)
+        with self.lock:
+            if queue.closed:
+                queue.busy = False
+                return
+            if rest:
+                # Ahead of anything queued meanwhile, so the frame is finished first
+                queue.lanes[CONTROL].appendleft(rest)
+                queue.queued_bytes += len(rest)
+                # The socket is full; it stays busy until the watcher sees it drain
+                queue.parked = True
+                self.parked += 1
+                self.to_park.append(queue)
+                self._wake_watcher()
+                return
+            queue.busy = False
+            self._requeue(queue)
+
+    def _requeue(self, queue):
+        """Put a connection back in the ring for its most urgent lane; caller holds the lock"""
+        lane = queue.first_lane()
+        if lane is not None:
+            queue.ring = lane
+            self.rings[lane].append(queue)
+            self.ready.notify()
+
+    def _unpark(self, queue):
+        """Let the senders serve a parked connection again; caller holds the lock"""
+        if not queue.parked:
+            return
+        queue.parked = False
+        queue.busy = False
+        self.parked -= 1
+        if not queue.closed:
+            self._requeue(queue)
+        # Senders waiting to stop recheck whether anything is still parked
+        self.ready.notify_all()
+
+    def _wake_watcher(self):
+        try:
+            self.wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            pass  # Already has wakeups pending
+
+    def _discard(self, queue):
+        """Empty a queue for good; caller holds the lock"""
+        self.pending_chat -= sum(len(message) for message in queue.lanes[CHAT])
+        for messages in queue.lanes:
+            messages.clear()
+        queue.queued_bytes = 0
+        queue.closed = True
+        if queue.parked:
+            self.to_unpark.append(queue)
+            self._wake_watcher()
+        self.space.notify_all()
+
+    def _shutdown(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
@@ -3,6 +3,8 @@ from enum import Enum
 from datetime import datetime
 import logging
 import os
+import select
+import uuid
 
 # Set up logging
 def setup_logging():
@@ -52,35 +54,423 @@ class MessageType(Enum):
     LEAVE = "leave"
     SYSTEM = "system"
     ERROR = "error"  # Add error type
+    ROSTER = "roster"  # Full list of online users (request and snapshot reply)
+    PRESENCE = "presence"  # Versioned join/leave delta for the roster
+    ACK = "ack"  # Server sequence number assigned to a client message ID
+    PEER_HELLO = "peer_hello"  # Server-to-server link setup with the node's local users
+    RELAY = "relay"  # Chat or presence event forwarded between server nodes
+    SEARCH = "search"  # History search query, and the server's ranked results
+    FILE_OFFER = "file_offer"  # Client wants to share a file; server replies with its ID
+    FILE_CHUNK = "file_chunk"  # Header for raw file bytes on the file connection
+    FILE_REQUEST = "file_request"  # Ask the file connection for a stored file
+    PING = "ping"  # Liveness check; the other side answers with PONG
+    PONG = "pong"
+    TYPING = "typing"  # Ephemeral: a user started or stopped typing; never logged or stored
 
-def create_message(msg_type: MessageType, username: str, content: str, timestamp: str = None) -> bytes:
-    """Create a formatted message following the chat protocol"""
-    if timestamp is None:
-        timestamp = datetime.now().strftime('%H:%M:%S')
-        
-    return json.dumps({
-        "type": msg_type.value,
+# Every message on the wire ends with this byte. json.dumps escapes newlines
+# inside strings, so it can never appear inside an encoded message.
+MESSAGE_DELIMITER = b"\n"
+
+def encode_message(payload: dict) -> bytes:
+    """Encode a message dictionary as a single delimited frame"""
+    return json.dumps(payload).encode('utf-8') + MESSAGE_DELIMITER
+
+# Wire type string -> MessageType, built once so a lookup replaces Enum value comparisons
+MESSAGE_TYPES = {member.value: member for member in MessageType}
+
+# Types a ChatMessage may carry: the ones shown to users and broadcast by the server
+CHAT_MESSAGE_TYPES = {
+    member.value: member
+    for member in (MessageType.CHAT, MessageType.JOIN, MessageType.LEAVE,
+                   MessageType.SYSTEM, MessageType.ERROR)
+}
+
+# Everything a ChatMessage frame may hold; a client frame with more is re-encoded
+CHAT_MESSAGE_FIELDS = frozenset(("type", "username", "content", "timestamp", "msg_id"))
+
+# Types an EphemeralEvent may carry, with the content each allows
+EPHEMERAL_MESSAGE_TYPES = {MessageType.TYPING.value: MessageType.TYPING}
+TYPING_START = "start"
+TYPING_STOP = "stop"
+EPHEMERAL_CONTENT = {MessageType.TYPING: (TYPING_START, TYPING_STOP)}
+
+TYPING_REFRESH = 3.0  # Seconds between repeated "start" events while a user keeps typing
+TYPING_TIMEOUT = 6.0  # Seconds a typing indicator stays up without a refresh
+
+class InvalidMessage(ValueError):
+    """A message that isn't valid JSON or lacks a field its type requires"""
+
+class ChatMessage:
+    """A user-visible message, parsed and validated once and encoded at most once.
+
+    A message read off the wire keeps the frame it arrived in as its
+    encoding, so broadcasting it to any number of clients, relaying it to
+    other nodes and logging it never serializes it again. The encoding is
+    cached on first use, so treat the fields as read-only.
+    """
+    __slots__ = ('type', 'username', 'content', 'timestamp', 'msg_id', '_encoded')
+
+    def __init__(self, msg_type: MessageType, username: str, content: str, timestamp: str = None,
+                 msg_id: str = None):
+        if timestamp is None:
+            timestamp = datetime.now().strftime('%H:%M:%S')
+        self.type = msg_type
+        self.username = username
+        self.content = content
+        self.timestamp = timestamp
+        self.msg_id = msg_id
+        self._encoded = None
+
+    @classmethod
+    def from_dict(cls, data: dict, encoded: bytes = None) -> 'ChatMessage':
+        """Validate a parsed message; encoded is the delimited frame it was parsed from"""
+        msg_type = CHAT_MESSAGE_TYPES.get(data.get("type"))
+        if msg_type is None:
+            raise InvalidMessage(f"Not a chat message type: {data.get('type')!r}")
+        username = data.get("username")
+        content = data.get("content")
+        timestamp = data.get("timestamp")
+        msg_id = data.get("msg_id")
+        # Exact type checks: cheap, and JSON can't produce str subclasses anyway
+        if type(username) is not str or type(content) is not str or type(timestamp) is not str:
+            raise InvalidMessage(f"{msg_type.value} message needs string username, content and timestamp")
+        if msg_id is not None and type(msg_id) is not str:
+            raise InvalidMessage("msg_id must be a string")
+        message = cls(msg_type, username, content, timestamp, msg_id)
+        message._encoded = encoded
+        return message
+
+    @classmethod
+    def decode(cls, frame) -> 'ChatMessage':
+        """Parse and validate one delimited frame (bytes or a memoryview)"""
+        try:
+            data = parse_message(frame)
+        except ValueError as e:
+            raise InvalidMessage(str(e))
+        if type(data) is not dict:
+            raise InvalidMessage("Message is not a JSON object")
+        return cls.from_dict(data, bytes(frame))
+
+    def to_dict(self) -> dict:
+        payload = {
+            "type": self.type.value,
+            "username": self.username,
+            "content": self.content,
+            "timestamp": self.timestamp
+        }
+        if self.msg_id is not None:
+            payload["msg_id"] = self.msg_id
+        return payload
+
+    def encode(self) -> bytes:
+        """The delimited wire frame, serialized on first use only"""
+        if self._encoded is None:
+            self._encoded = encode_message(self.to_dict())
+        return self._encoded
+
+class EphemeralEvent:
+    """A passing status such as a typing indicator.
+
+    Unlike a ChatMessage it is never logged, indexed, acknowledged or
+    replayed: it goes to whoever is online at the time, after the server
+    has coalesced repeats, and is lost if nobody is.
+    """
+    __slots__ = ('type', 'username', 'content', '_encoded')
+
+    def __init__(self, msg_type: MessageType, username: str, content: str):
+        self.type = msg_type
+        self.username = username
+        self.content = content
+        self._encoded = None
+
+    @classmethod
+    def from_dict(cls, data: dict, encoded: bytes = None) -> 'EphemeralEvent':
+        """Validate a parsed event; encoded is the delimited frame it was parsed from"""
+        msg_type = EPHEMERAL_MESSAGE_TYPES.get(data.get("type"))
+        if msg_type is None:
+            raise InvalidMessage(f"Not an ephemeral event type: {data.get('type')!r}")
+        username = data.get("username")
+        content = data.get("content")
+        if type(username) is not str:
+            raise InvalidMessage(f"{msg_type.value} event needs a string username")
+        if content not in EPHEMERAL_CONTENT[msg_type]:
+            raise InvalidMessage(f"Unknown {msg_type.value} event: {content!r}")
+        event = cls(msg_type, username, content)
+        event._encoded = encoded
+        return event
+
+    @classmethod
+    def decode(cls, frame) -> 'EphemeralEvent':
+        """Parse and validate one delimited frame (bytes or a memoryview)"""
+        try:
+            data = parse_message(frame)
+        except ValueError as e:
+            raise InvalidMessage(str(e))
+        if type(data) is not dict:
+            raise InvalidMessage("Message is not a JSON object")
+        return cls.from_dict(data, bytes(frame))
+
+    def to_dict(self) -> dict:
+        return {"type": self.type.value, "username": self.username, "content": self.content}
+
+    def encode(self) -> bytes:
+        """The delimited wire frame, serialized on first use only"""
+        if self._encoded is None:
+            self._encoded = encode_message(self.to_dict())
+        return self._encoded
+
+def create_typing_message(username: str, typing: bool) -> bytes:
+    """Tell the others that username started (or stopped) typing"""
+    return EphemeralEvent(MessageType.TYPING, username, TYPING_START if typing else TYPING_STOP).encode()
+
+def create_message(msg_type: MessageType, username: str, content: str, timestamp: str = None,
+                   msg_id: str = None) -> bytes:
+    """Create a formatted message following the chat protocol.
+
+    msg_id is an optional client-chosen ID; resending a message with the same
+    ID lets the server drop the duplicate and just acknowledge it again.
+    """
+    return ChatMessage(msg_type, username, content, timestamp, msg_id).encode()
+
+def new_message_id() -> str:
+    """Generate a client message ID"""
+    return uuid.uuid4().hex
+
+def create_ack_message(msg_id: str, seq: int) -> bytes:
+    """Acknowledge a client message with the server sequence number it was given"""
+    return encode_message({
+        "type": MessageType.ACK.value,
+        "msg_id": msg_id,
+        "seq": seq
+    })
+
+def create_roster_message(version: int, users: list) -> bytes:
+    """Create a roster snapshot carrying every online user and the roster version"""
+    return encode_message({
+        "type": MessageType.ROSTER.value,
+        "username": "System",
+        "content": "",
+        "users": users,
+        "version": version,
+        "timestamp": datetime.now().strftime('%H:%M:%S')
+    })
+
+def create_presence_message(version: int, action: str, username: str) -> bytes:
+    """Create a roster delta; action is "join" or "leave" """
+    return encode_message({
+        "type": MessageType.PRESENCE.value,
         "username": username,
-        "content": content,
-        "timestamp": timestamp
-    }).encode('utf-8')
+        "content": action,
+        "version": version,
+        "timestamp": datetime.now().strftime('%H:%M:%S')
+    })
+
+def create_peer_hello(node_id: str, initiator: str) -> bytes:
+    """Create the first message on a server-to-server link; initiator is the dialing node"""
+    return encode_message({
+        "type": MessageType.PEER_HELLO.value,
+        "node_id": node_id,
+        "initiator": initiator
+    })
+
+def create_relay_message(origin: str, seq: int, kind: str, **fields) -> bytes:
+    """Create an event relayed between nodes; (origin, seq) identifies it network-wide"""
+    payload = {
+        "type": MessageType.RELAY.value,
+        "origin": origin,
+        "seq": seq,
+        "kind": kind
+    }
+    payload.update(fields)
+    return encode_message(payload)
+
+def create_search_results(query: str, results: list) -> bytes:
+    """Create the reply to a SEARCH request"""
+    return encode_message({
+        "type": MessageType.SEARCH.value,
+        "username": "System",
+        "content": query,
+        "results": results,
+        "timestamp": datetime.now().strftime('%H:%M:%S')
+    })
+
+def create_file_offer(username: str, name: str, size: int, file_id: str = None,
+                      port: int = None) -> bytes:
+    """Offer a file for upload; the server's reply adds the file ID and file port"""
+    payload = {
+        "type": MessageType.FILE_OFFER.value,
+        "username": username,
+        "content": name,
+        "size": size,
+        "timestamp": datetime.now().strftime('%H:%M:%S')
+    }
+    if file_id is not None:
+        payload["file_id"] = file_id
+        payload["port"] = port
+    return encode_message(payload)
+
+def create_file_chunk_header(file_id: str, offset: int, length: int, name: str = None) -> bytes:
+    """Header sent ahead of length raw bytes of a file; length 0 ends an upload"""
+    payload = {
+        "type": MessageType.FILE_CHUNK.value,
+        "file_id": file_id,
+        "offset": offset,
+        "length": length
+    }
+    if name is not None:
+        payload["name"] = name
+    return encode_message(payload)
+
+def create_file_request(file_id: str) -> bytes:
+    """Ask for a stored file on the file connection"""
+    return encode_message({
+        "type": MessageType.FILE_REQUEST.value,
+        "file_id": file_id
+    })
+
+def create_ping_message() -> bytes:
+    """Ask the other side to show it is still there"""
+    return encode_message({"type": MessageType.PING.value})
+
+def create_pong_message() -> bytes:
+    """Answer a PING"""
+    return encode_message({"type": MessageType.PONG.value})
 
 def parse_message(message: bytes) -> dict:
-    """Parse a received message from bytes to dictionary"""
-    return json.loads(message.decode('utf-8'))
+    """Parse a received message (bytes or a memoryview frame) to a dictionary"""
+    return json.loads(str(message, 'utf-8'))
+
+class ReadInterrupted(Exception):
+    """Raised by a MessageReader whose interrupt socket became readable"""
+
+class MessageReader:
+    """Split a socket's byte stream back into individual messages.
+
+    Data is received straight into one preallocated buffer per connection
+    with recv_into. Messages are located in place and handed out as
+    memoryview slices, so reading a message allocates nothing; the buffer is
+    only compacted when its tail runs out of room, and only grown for a
+    message larger than the whole buffer.
+
+    The buffer starts at bufsize, small enough for tens of thousands of
+    idle connections, and goes back to that size once a message that made
+    it grow has been read.
+
+    If interrupt is set to a socket, a read that has no buffered data to
+    continue from waits on it too and raises ReadInterrupted once it is
+    readable, leaving the connection at a message boundary.
+    """
+    def __init__(self, sock, bufsize: int = 4096, max_message_size: int = 16 * 1024 * 1024):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.max_message_size = max_message_size
+        self.buffer = bytearray(bufsize)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First unread byte
+        self.end = 0  # One past the last received byte
+        self.interrupt = None
+
+    def _fill(self) -> bool:
+        """Receive more data after the unread bytes; False once the peer has closed"""
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.bufsize:
+                # Nothing unread, so give back what an oversized message took
+                self.view.release()
+                self.buffer = bytearray(self.bufsize)
+                self.view = memoryview(self.buffer)
+            if self.interrupt is not None:
+                # poll rather than select, which can't take descriptors past 1023
+                poller = select.poll()
+                poller.register(self.sock, select.POLLIN)
+                poller.register(self.interrupt, select.POLLIN)
+                ready = [fd for fd, _ in poller.poll()]
+                if self.interrupt.fileno() in ready:
+                    raise ReadInterrupted()
+        elif self.end == len(self.buffer):
+            unread = self.end - self.start
+            if self.start:
+                # Compact: slide the partial message to the front
+                self.buffer[:unread] = self.buffer[self.start:self.end]
+            else:
+                if unread >= self.max_message_size:
+                    raise ValueError("Message exceeds the maximum size")
+                self.view.release()
+                self.buffer = self.buffer + bytearray(len(self.buffer))
+                self.view = memoryview(self.buffer)
+            self.start, self.end = 0, unread
+        received = self.sock.recv_into(self.view[self.end:])
+        if not received:
+            return False
+        self.end += received
+        return True
+
+    def has_frame(self) -> bool:
+        """True if a whole message is already buffered, so read_frame won't touch the socket"""
+        return self.buffer.find(MESSAGE_DELIMITER, self.start, self.end) >= 0
+
+    def read_frame(self) -> memoryview:
+        """Return the next message including its delimiter, or None once the peer has closed.
+
+        The view points into the receive buffer and is only valid until the
+        next read; copy it with bytes() to keep it.
+        """
+        scanned = self.start
+        while True:
+            index = self.buffer.find(MESSAGE_DELIMITER, scanned, self.end)
+            if index >= 0:
+                frame = self.view[self.start:index + 1]
+                self.start = index + 1
+                return frame
+            scanned = self.end - self.start  # Offset survives compaction
+            if not self._fill():
+                return None
+            scanned += self.start
+
+    def read_message(self) -> bytes:
+        """Return a copy of the next message without its delimiter, or None once the peer has closed"""
+        frame = self.read_frame()
+        if frame is None:
+            return None
+        return bytes(frame[:-1])
+
+    def read_body(self, length: int, sink):
+        """Pass exactly length raw bytes that follow the last message to sink.
+
+        Used for file bodies, which are not JSON. The bytes go through the
+        receive buffer, so memory stays bounded however long the body is.
+        """
+        remaining = length
+        while remaining:
+            if self.start == self.end and not self._fill():
+                raise ConnectionError("Connection closed in the middle of a file body")
+            count = min(remaining, self.end - self.start)
+            sink(self.view[self.start:self.start + count])
+            self.start += count
+            remaining -= count
 
 def format_message_for_display(msg_data: dict) -> str:
+    if msg_data["type"] == "search":
+        lines = [f"[{msg_data['timestamp']}] Search results for '{msg_data['content']}':"]
+        for result in msg_data["results"]:
+            lines.append(
+                f"  {result['date']} [{result['timestamp']}] {result['username']}: {result['content']}"
+            )
+        if not msg_data["results"]:
+            lines.append("  No matches")
+        return "\n".join(lines)
     if msg_data["type"] == "system":
         return f"[{msg_data['timestamp']}] System: {msg_data['content']}"
     else:
-        return f"[{msg_data['timestamp']} {msg_data['username']}: {msg_data['content']}"
+        return f"[{msg_data['timestamp']}] {msg_data['username']}: {msg_data['content']}"
 
-def create_handshake_message(msg_type: MessageType) -> bytes:
-    """Create a simple handshake message"""
-    return json.dumps({
+def create_handshake_message(msg_type: MessageType, **fields) -> bytes:
+    """Create a simple handshake message, with any extra fields the reply carries"""
+    return encode_message({
         "type": msg_type.value,
-        "content": msg_type.value.upper()  # e.g., "HELLO", "HELLO_ACK"
-    }).encode('utf-8')
+        "content": msg_type.value.upper(),  # e.g., "HELLO", "HELLO_ACK"
+        **fields
+    })
 
 def log_error(error_type: str, details: str):
     """Log error messages"""
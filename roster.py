@@ -0,0 +1,82 @@
+import threading
+
+class Roster:
+    """Server-side list of online users.
+
+    Every change bumps the version so clients can apply PRESENCE deltas in
+    order and notice when they have missed one.
+    """
+    def __init__(self):
+        self.version = 0
+        self.sessions = {}  # username -> number of open connections
+        self.lock = threading.Lock()
+
+    def join(self, username: str) -> int:
+        """Add a session; return the new version, or None if the user was already online"""
+        with self.lock:
+            count = self.sessions.get(username, 0)
+            self.sessions[username] = count + 1
+            if count:
+                return None
+            self.version += 1
+            return self.version
+
+    def leave(self, username: str) -> int:
+        """Drop a session; return the new version, or None if the user is still online"""
+        with self.lock:
+            count = self.sessions.get(username, 0)
+            if count > 1:
+                self.sessions[username] = count - 1
+                return None
+            if not count:
+                return None
+            del self.sessions[username]
+            self.version += 1
+            return self.version
+
+    def restore(self, version: int, usernames: list):
+        """Add sessions taken over from a previous server process without a version bump per user"""
+        with self.lock:
+            for username in usernames:
+                self.sessions[username] = self.sessions.get(username, 0) + 1
+            self.version = max(self.version, version)
+
+    def snapshot(self) -> tuple:
+        """Return (version, sorted usernames) taken atomically"""
+        with self.lock:
+            return self.version, sorted(self.sessions)
+
+class RosterView:
+    """Client-side copy of the roster kept current by PRESENCE deltas"""
+    def __init__(self):
+        self.version = None  # None until the first snapshot arrives
+        self.members = set()
+        self.pending = []
+
+    def apply_snapshot(self, version: int, users: list) -> bool:
+        """Replace the roster, then replay any deltas that arrived while waiting for it"""
+        self.version = version
+        self.members = set(users)
+        pending, self.pending = self.pending, []
+        for delta in sorted(pending):
+            if not self.apply_delta(*delta):
+                return False
+        return True
+
+    def apply_delta(self, version: int, action: str, username: str) -> bool:
+        """Apply one delta. Returns False when a gap means a new snapshot is needed."""
+        if self.version is None:
+            self.pending.append((version, action, username))
+            return True
+        if version <= self.version:
+            return True  # Already covered by the snapshot
+        if version != self.version + 1:
+            self.version = None
+            self.pending = [(version, action, username)]
+            return False
+        if action == "join":
+            self.members.add(username)
+        else:
+            self.members.discard(username)
+        self.version = version
+        return True
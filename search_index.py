@@ -0,0 +1,224 @@
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+
+TOKEN_PATTERN = re.compile(r"\w+")
+FILTER_PATTERN = re.compile(r"\b(from|date):(\S+)")
+
+def tokenize(text: str) -> list:
+    return TOKEN_PATTERN.findall(text.lower())
+
+def journal_date_sizes(path: str) -> dict:
+    """Bytes each day takes up in a search index journal, without loading it"""
+    sizes = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # Being appended to right now
+            # add() writes the date first, so it can be read without parsing
+            if line.startswith(b'{"date": "'):
+                date = line[10:20].decode('ascii')
+            else:
+                date = json.loads(line)["date"]
+            sizes[date] = sizes.get(date, 0) + len(line)
+    return sizes
+
+class Posting:
+    """Message IDs containing one token (ascending) with the token's count in each"""
+    __slots__ = ('ids', 'counts')
+
+    def __init__(self):
+        self.ids = array('I')
+        self.counts = array('H')
+
+    def add(self, doc_id: int, count: int):
+        self.ids.append(doc_id)
+        self.counts.append(min(count, 0xFFFF))
+
+    def count(self, doc_id: int) -> int:
+        """Occurrences in doc_id, or 0; ids are sorted so this is a binary search"""
+        i = bisect_left(self.ids, doc_id)
+        if i < len(self.ids) and self.ids[i] == doc_id:
+            return self.counts[i]
+        return 0
+
+class SearchIndex:
+    """Incremental inverted index over chat history.
+
+    Each indexed message is appended to a JSON-lines journal next to the chat
+    logs and gets the next message ID. In memory the index keeps token
+    postings, per-user ID lists and the ID range of each day; message text is
+    read back from the journal only for the results returned. Message IDs are
+    handed out in time order, so every posting list is sorted and
+    intersecting them needs no sets.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.postings = {}  # token -> Posting
+        self.users = {}  # lowercased username -> array of message IDs
+        self.dates = {}  # 'YYYY-MM-DD' -> [first ID, last ID]
+        self.offsets = array('Q')  # message ID -> journal offset
+        self.load()
+        self.journal = open(self.path, 'ab')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def load(self):
+        """Rebuild the in-memory index from the journal"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Torn final write from a crash; cut off below
+                entry = json.loads(line)
+                self._index(offset, entry["date"], entry["username"], entry["content"])
+                offset += len(line)
+        if offset != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+
+    def compact(self, keep_from: str) -> int:
+        """Drop messages dated before keep_from; returns how many were dropped.
+
+        The journal is rewritten without them and the index rebuilt from it,
+        so message IDs are renumbered. The rewrite happens outside the lock;
+        only messages added meanwhile are copied over while holding it.
+        """
+        with self.lock:
+            if self.journal.closed or all(date >= keep_from for date in self.dates):
+                return 0
+            end = self.journal.tell()
+            before = len(self.offsets)
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(self.path, 'rb') as f, open(temp_path, 'wb') as out:
+            for line in f:
+                if f.tell() > end:
+                    break
+                if json.loads(line)["date"] >= keep_from:
+                    out.write(line)
+        compacted = SearchIndex(temp_path)
+        with self.lock:
+            with open(self.path, 'rb') as f:
+                f.seek(end)
+                tail = f.read()
+            for line in tail.splitlines(keepends=True):
+                entry = json.loads(line)
+                offset = compacted.journal.tell()
+                compacted.journal.write(line)
+                compacted._index(offset, entry["date"], entry["username"], entry["content"])
+            compacted.journal.flush()
+            os.replace(temp_path, self.path)
+            self.journal.close()
+            self.journal = compacted.journal
+            self.postings = compacted.postings
+            self.users = compacted.users
+            self.dates = compacted.dates
+            self.offsets = compacted.offsets
+            return before + tail.count(b"\n") - len(self.offsets)
+
+    def add(self, username: str, content: str, timestamp: str = None, date: str = None) -> int:
+        """Index a message and append it to the journal; returns its message ID"""
+        now = datetime.now()
+        entry = {
+            "date": date or now.strftime('%Y-%m-%d'),
+            "timestamp": timestamp or now.strftime('%H:%M:%S'),
+            "username": username,
+            "content": content
+        }
+        line = json.dumps(entry).encode('utf-8') + b"\n"
+        with self.lock:
+            offset = self.journal.tell()
+            self.journal.write(line)
+            self.journal.flush()
+            return self._index(offset, entry["date"], username, content)
+
+    def _index(self, offset: int, date: str, username: str, content: str) -> int:
+        doc_id = len(self.offsets)
+        self.offsets.append(offset)
+        counts = {}
+        for token in tokenize(content):
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = Posting()
+            posting.add(doc_id, count)
+        self.users.setdefault(username.lower(), array('I')).append(doc_id)
+        day = self.dates.setdefault(date, [doc_id, doc_id])
+        day[1] = doc_id
+        return doc_id
+
+    def search(self, query: str, limit: int = 20) -> list:
+        """Return up to limit matches for query, best first.
+
+        Every word must match. "from:<user>" and "date:<YYYY-MM-DD>" narrow the
+        results. Matches are scored by tf-idf, with newer messages winning ties.
+        """
+        filters = dict((key, value.lower()) for key, value in FILTER_PATTERN.findall(query))
+        terms = sorted(set(tokenize(FILTER_PATTERN.sub(" ", query))))
+
+        with self.lock:
+            total = len(self.offsets)
+            postings = [self.postings.get(term) for term in terms]
+            if not total or any(posting is None for posting in postings):
+                return []
+
+            low, high = 0, total - 1
+            if "date" in filters:
+                if filters["date"] not in self.dates:
+                    return []
+                low, high = self.dates[filters["date"]]
+
+            if "from" in filters:
+                candidates = self.users.get(filters["from"], array('I'))
+            elif postings:
+                # Walk the rarest term and probe the others
+                candidates = min(postings, key=lambda posting: len(posting.ids)).ids
+            elif "date" in filters:
+                candidates = range(low, high + 1)
+            else:
+                return []
+
+            lo = bisect_left(candidates, low)
+            hi = bisect_left(candidates, high + 1)
+            idf = [math.log(1 + total / len(posting.ids)) for posting in postings]
+            scored = []
+            for i in range(lo, hi):
+                doc_id = candidates[i]
+                score = 0.0
+                for posting, weight in zip(postings, idf):
+                    count = posting.count(doc_id)
+                    if not count:
+                        break
+                    score += weight * (1 + math.log(count))
+                else:
+                    scored.append((score, doc_id))
+            best = heapq.nlargest(limit, scored)
+            offsets = [self.offsets[doc_id] for _, doc_id in best]
+            # Opened under the lock, so a compaction can't swap the file
+            # out from under the offsets
+            journal = open(self.path, 'rb')
+
+        results = []
+        with journal as f:
+            for (score, doc_id), offset in zip(best, offsets):
+                f.seek(offset)
+                entry = json.loads(f.readline())
+                entry["id"] = doc_id
+                entry["score"] = round(score, 3)
+                results.append(entry)
+        return results
+
+    def close(self):
+        with self.lock:
+            self.journal.close()
@@ -1,44 +1,223 @@
+import selectors
 import socket
 import threading
+import time
 from datetime import datetime
 import os
 from protocol import (
-    MessageType, create_message, parse_message, create_handshake_message,
+    MessageType, MESSAGE_TYPES, CHAT_MESSAGE_FIELDS, ChatMessage, EphemeralEvent, InvalidMessage,
+    create_message, parse_message, create_handshake_message,
+    create_roster_message, create_presence_message, create_ack_message, create_search_results,
+    create_file_offer, create_pong_message,
+    MessageReader, ReadInterrupted,
     setup_logging, ConnectionStatus, log_connection_status, log_error
 )
+from roster import Roster
+from dedup import DedupCache
+from federation import Federation
+from search_index import SearchIndex
+from file_transfer import FileStore, FileServer, UPLOAD_DIR
+from handoff import Handoff, take_over
+from socket_tuning import SocketTuning
+from heartbeat import IdleReaper, PING_INTERVAL, IDLE_TIMEOUT
+from log_archive import LogArchiver
+from ephemeral import EventCoalescer
+from outbound import OutboundScheduler, MESSAGE_LANES, CONTROL, SYSTEM
+from fanout import SharedFanout
 import multiprocessing
-from multiprocessing import Pool, Process, Manager
-from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, Process
 import queue
 import json
+import argparse
+import signal
+import shutil
+import tempfile
 
 HOST = '127.0.0.1'
 PORT = 8000#anby ports below 1024 are for system services
+SEARCH_INDEX_PATH = 'logs/search_index.jsonl'
 
 # Create logs directory if it doesn't exist
 if not os.path.exists('logs'):
     os.makedirs('logs')
 
 class ChatServer:
-    def __init__(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((HOST, PORT))
-        self.server_socket.listen(5)
-        
-        # Shared resources using multiprocessing Manager
-        self.manager = Manager()
-        self.clients = self.manager.dict()
-        self.message_queue = self.manager.Queue()
-        
-        # Thread pool for client handling
+    def __init__(self, host=HOST, port=PORT, reuse_port=False, search_index_path=SEARCH_INDEX_PATH,
+                 file_port=None, upload_dir=UPLOAD_DIR, listen_socket=None, tuning=None,
+                 ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT, archive_logs=True,
+                 listen=True, clock=None, log_dir='logs', send_threads=None, priority_lanes=True,
+                 fanout_helpers=0):
+        """listen=False binds no ports at all: no chat listener and no file server.
+        Connections are then handed to the server directly, as the simulation
+        harness does. A clock replaces time.monotonic for idle tracking, and
+        the caller drives the reaper by calling reaper.check() itself. With
+        send_threads=0 the caller also sends queued messages, with
+        outbound.flush(). fanout_helpers > 0 moves all client sends to that
+        many helper processes sharing a shared-memory ring.
+        """
+        self.fanout = SharedFanout(fanout_helpers) if fanout_helpers else None
+
+        self.tuning = tuning or SocketTuning()
+        self.log_dir = log_dir
+        if not listen:
+            self.server_socket = None
+        elif listen_socket is not None:
+            # Taken over from the previous server process, still listening
+            self.server_socket = listen_socket
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Connections this port closed on shutdown sit in TIME_WAIT for a
+            # minute; without this a restart can't bind until they expire
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                # Worker processes each bind the same port; the kernel spreads
+                # incoming connections across their listen queues
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.server_socket.bind((host, port))
+        if self.server_socket is not None:
+            self.tuning.configure_listener(self.server_socket)
+
+        # Connected sockets -> username. Sockets can't be shared through a
+        # Manager proxy (lookups compare pickled copies), so this stays local.
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        self.roster = Roster()
+
+        # Server-wide sequence number given to every chat message
+        self.sequence = 0
+        self.sequence_lock = threading.Lock()
+
+        # Set by enable_federation when this node is linked to others
+        self.federation = None
+
+        # Set by enable_handoff when a successor process may take over
+        self.handoff = None
+        self.accept_stopped = threading.Event()
+        self.handler_sockets = set()  # Connections whose handler thread is running
+        self.handlers_changed = threading.Condition()
+
+        # Per-connection send queues: control replies ahead of system
+        # notices ahead of chat, with chat shared fairly between clients
         self.num_cores = multiprocessing.cpu_count()
-        self.thread_pool = ThreadPoolExecutor(max_workers=self.num_cores * 2)
-        
-        print(f"Server started on {HOST}:{PORT} with {self.num_cores} cores")
+        if send_threads is None:
+            send_threads = self.num_cores * 2
+        if self.fanout is not None:
+            self.outbound = self.fanout
+        else:
+            self.outbound = OutboundScheduler(send_threads, priority=priority_lanes)
+        self.outbound.start()
+
+        # Pings quiet clients and drops the ones that have gone away
+        if clock is None:
+            self.reaper = IdleReaper(ping_interval, idle_timeout, send=self.outbound.send)
+            self.reaper.start()
+        else:
+            self.reaper = IdleReaper(ping_interval, idle_timeout, clock=clock,
+                                     send=self.outbound.send)
+
+        # Throttles typing indicators and other ephemeral events per client
+        if clock is None:
+            self.events = EventCoalescer(self.broadcast_event)
+            self.events.start()
+        else:
+            self.events = EventCoalescer(self.broadcast_event, clock=clock)
+
+        # Compresses and prunes finished daily logs. Only one process per
+        # logs directory should do that, but any can read the history.
+        self.archiver = LogArchiver(log_dir, archive_logs=archive_logs)
+
+        # Chat history index answering SEARCH requests
+        self.search_index = SearchIndex(search_index_path)
+        if not len(self.search_index):
+            self.import_history()
+        # Every process trims its own index to the history still on disk
+        self.archiver.search_index = self.search_index
+        if archive_logs or listen:
+            self.archiver.start()
+
+        # File bodies travel on their own port. By default the kernel picks a free
+        # one, so nodes on neighbouring chat ports can't collide; clients are told
+        # which in the USERNAME_ACK and in every offer reply
+        self.file_store = FileStore(upload_dir)
+        self.file_server = None
+        if listen:
+            self.file_server = FileServer(
+                self.file_store, host, 0 if file_port is None else file_port,
+                on_upload=self.announce_file, reuse_port=reuse_port
+            )
+            self.file_server.start()
+
+        if listen:
+            print(f"Server started on {host}:{port} with {self.num_cores} cores")
+
+    def enable_federation(self, node_id, address, peers=(), seq=0, shared_logs=False):
+        """Link this server to other nodes so users and broadcasts are shared.
+
+        shared_logs=True when the nodes write to the same logs directory, as
+        workers do; each message is then logged only by the node it came from.
+        """
+        self.federation = Federation(self, node_id, address, peers, seq=seq,
+                                     log_relayed=not shared_logs)
+        # Clients taken over from a previous process are already logged in
+        with self.clients_lock:
+            usernames = list(self.clients.values())
+        for username in usernames:
+            self.federation.publish_presence(username, 1)
+        self.federation.start()
+
+    def enable_handoff(self, path):
+        """Let a new server process take over this one's connections through path"""
+        self.handoff = Handoff(self, path)
+        self.handoff.start()
+
+    def wait_for_handlers(self, timeout):
+        """Wait until every client handler has returned; False if some are still running"""
+        with self.handlers_changed:
+            return self.handlers_changed.wait_for(lambda: not self.handler_sockets, timeout)
+
+    def close_handlers(self):
+        """Cut off the connections of handlers still running, so they finish"""
+        with self.handlers_changed:
+            sockets = list(self.handler_sockets)
+        for client_socket in sockets:
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def restore_state(self, state, clients):
+        """Adopt the counters and logged-in clients handed over by the previous process"""
+        with self.sequence_lock:
+            self.sequence = state["sequence"]
+        with self.clients_lock:
+            for client_socket, username, _ in clients:
+                self.clients[client_socket] = username
+                # Before any handler runs, so no broadcast can miss them
+                self.outbound.register(client_socket)
+                if self.fanout is not None:
+                    self.fanout.add_member(client_socket)
+        # Clients already list these users, so nothing is announced
+        self.roster.restore(state["roster_version"], [username for _, username, _ in clients])
+
+    def resume_clients(self, state, clients):
+        """Start reading from the handed-over clients again"""
+        for client_socket, username, dedup_entries in clients:
+            dedup = DedupCache()
+            for msg_id, seq in dedup_entries:
+                dedup.put(msg_id, seq)
+            self.start_handler(client_socket, username, dedup)
+        pause = (time.time() - state["paused_at"]) * 1000
+        print(f"Took over {len(clients)} clients; traffic was paused for {pause:.1f} ms")
+
+    def import_history(self):
+        """Index chat logs written before the search index existed, archived ones included"""
+        for date, timestamp, username, content in self.archiver.chat_history():
+            if username != "System":
+                self.search_index.add(username, content, timestamp, date)
 
     def log_message(self, message):
         current_date = datetime.now().strftime('%Y-%m-%d')
-        log_file = f'logs/chat_log_{current_date}.txt'
+        log_file = os.path.join(self.log_dir, f'chat_log_{current_date}.txt')
         timestamp = datetime.now().strftime('%H:%M:%S')
         log_entry = f"[{timestamp}] {message}"
         with open(log_file, 'a', encoding='utf-8') as f:
@@ -48,113 +227,285 @@ class ChatServer:
         """Process message in a separate thread"""
         try:
             msg_data = parse_message(message_data)
+            # Everything past here indexes the message by field and type
+            if type(msg_data) is not dict:
+                raise InvalidMessage("Message is not a JSON object")
+            if type(msg_data.get("type")) is not str:
+                raise InvalidMessage(f"Message type must be a string, not {msg_data.get('type')!r}")
             return msg_data
         except Exception as e:
             log_error("message_processing", str(e))
             return None
 
-    def broadcast_message(self, message, sender_socket=None):
-        """Broadcast message to all clients except sender"""
+    def broadcast_message(self, message: ChatMessage, sender_socket=None, relay=True, log=True):
+        """Broadcast message to all clients except sender.
+
+        relay=False is used for messages that arrived from another node, and
+        log=False for ones that node has already written to a shared log.
+        """
         try:
-            msg_data = self.process_message(message)
-            if msg_data:
-                self.log_message(f"{msg_data['username']}: {msg_data['content']}")
-                
-                # Create broadcast tasks
-                broadcast_tasks = []
-                for client_socket in self.clients:
-                    if client_socket != sender_socket:
-                        broadcast_tasks.append((client_socket, message))
-                
-                # Submit broadcast tasks to thread pool
-                futures = []
-                for client_socket, msg in broadcast_tasks:
-                    future = self.thread_pool.submit(self._send_to_client, client_socket, msg)
-                    futures.append(future)
-                
-                # Wait for all broadcasts to complete
-                for future in futures:
-                    future.result()
+            if log:
+                self.log_message(f"{message.username}: {message.content}")
+            if message.type is MessageType.CHAT:
+                self.search_index.add(message.username, message.content, message.timestamp)
+            lane = MESSAGE_LANES.get(message.type, CONTROL)
+            self.send_to_all(message.encode(), sender_socket, lane)
+            if relay and self.federation:
+                self.federation.relay_chat(message)
                     
         except Exception as e:
             log_error("broadcast", str(e))
 
-    def _send_to_client(self, client_socket, message):
-        """Send message to a single client"""
+    def broadcast_event(self, sender_socket, event: EphemeralEvent, relay=True):
+        """Send an ephemeral event to all clients except sender; never logged or indexed"""
         try:
-            client_socket.send(message)
+            self.send_to_all(event.encode(), sender_socket, MESSAGE_LANES.get(event.type, CONTROL))
+            if relay and self.federation:
+                self.federation.relay_event(event)
         except Exception as e:
-            print(f"Error sending message: {e}")
-            self.remove_client(client_socket)
+            log_error("broadcast", str(e))
+
+    def send_to_all(self, message, sender_socket=None, lane=SYSTEM):
+        """Queue an encoded message for every client except sender, without logging it"""
+        if self.fanout is not None:
+            # The helpers know who is logged in, so the room is never walked here
+            self.fanout.broadcast(message, sender_socket)
+            return
+        # Snapshot the recipients so remove_client can run during the fan-out
+        with self.clients_lock:
+            recipients = [sock for sock in self.clients if sock != sender_socket]
+        self.outbound.send_many(recipients, message, lane)
 
     def remove_client(self, client_socket):
         """Remove client from the system"""
-        if client_socket in self.clients:
-            username = self.clients[client_socket]
-            del self.clients[client_socket]
-            client_socket.close()
-            leave_message = create_message(MessageType.SYSTEM, "System", f"{username} left the chat")
-            self.broadcast_message(leave_message, None)
-            print(f"Client {username} disconnected.")
-
-    def handle_client(self, client_socket):
-        """Handle client connection with parallel processing"""
+        with self.clients_lock:
+            username = self.clients.pop(client_socket, None)
+        self.outbound.forget(client_socket)
+        client_socket.close()
+        if username is None:
+            return
+        leave_message = ChatMessage(MessageType.SYSTEM, "System", f"{username} left the chat")
+        self.broadcast_message(leave_message, None)
+        self.announce_presence(self.roster.leave(username), "leave", username)
+        if self.federation:
+            self.federation.publish_presence(username, -1)
+        print(f"Client {username} disconnected.")
+
+    def next_sequence(self):
+        """Assign the next server sequence number"""
+        with self.sequence_lock:
+            self.sequence += 1
+            return self.sequence
+
+    def handle_chat(self, client_socket, username, frame, msg_data, dedup):
+        """Broadcast a chat message once, acknowledging retries from the cache"""
+        # The frame goes out as it came only if it holds nothing but a chat
+        # message from this client; anything else is encoded afresh
+        as_sent = msg_data.get("username") == username and msg_data.keys() <= CHAT_MESSAGE_FIELDS
         try:
-            client_address = client_socket.getpeername()
-            log_connection_status(ConnectionStatus.CONNECTING, f"from {client_address}")
-            
-            # Handshake process
-            message = client_socket.recv(1024)
-            msg_data = self.process_message(message)
-            
-            if msg_data["type"] != MessageType.HELLO.value:
-                log_error("handshake", f"Client {client_address} didn't say HELLO")
-                client_socket.close()
+            # The single copy out of the receive buffer; the fan-out outlives the frame
+            message = ChatMessage.from_dict(msg_data, bytes(frame) if as_sent else None)
+        except InvalidMessage as e:
+            log_error("message_validation", str(e))
+            return
+        if message.username != username:
+            message = ChatMessage(message.type, username, message.content, message.timestamp, message.msg_id)
+        msg_id = message.msg_id
+        if msg_id is not None:
+            seq = dedup.get(msg_id)
+            if seq is not None:
+                # Retry of a message we already broadcast; just re-acknowledge
+                self.outbound.send(client_socket, create_ack_message(msg_id, seq))
                 return
-                
-            log_connection_status(ConnectionStatus.HANDSHAKE_STARTED, f"with {client_address}")
-            
-            # Send HELLO_ACK
-            hello_ack = create_handshake_message(MessageType.HELLO_ACK)
-            client_socket.send(hello_ack)
+        seq = self.next_sequence()
+        if msg_id is not None:
+            dedup.put(msg_id, seq)
+        print(f"Received: {message.username}: {message.content}")
+        self.broadcast_message(message, client_socket)
+        if msg_id is not None:
+            self.outbound.send(client_socket, create_ack_message(msg_id, seq))
+
+    def handle_event(self, client_socket, username, frame, msg_data):
+        """Pass an ephemeral event to the coalescer, which decides when it goes out"""
+        try:
+            event = EphemeralEvent.from_dict(msg_data, bytes(frame))
+        except InvalidMessage as e:
+            log_error("message_validation", str(e))
+            return
+        if event.username != username:
+            event = EphemeralEvent(event.type, username, event.content)
+        self.events.submit(client_socket, event)
+
+    def announce_presence(self, version, action, username):
+        """Fan out a roster delta if the roster actually changed"""
+        if version is not None:
+            self.send_to_all(create_presence_message(version, action, username))
+
+    def send_search_results(self, client_socket, query):
+        """Answer a SEARCH request from the index"""
+        results = self.search_index.search(query)
+        self.outbound.send(client_socket, create_search_results(query, results))
+
+    def accept_file_offer(self, client_socket, username, msg_data):
+        """Reserve an upload and tell the client where to send the bytes"""
+        name, size = msg_data.get("content"), msg_data.get("size")
+        if type(name) is not str or type(size) is not int:
+            log_error("message_validation", "file_offer needs a string name and an integer size")
+            return
+        if self.file_server is None:
+            self.outbound.send(client_socket, create_message(
+                MessageType.ERROR, "System", "File sharing is not available on this server"
+            ))
+            return
+        file_id = self.file_store.offer(username, name, size)
+        if file_id is None:
+            self.outbound.send(client_socket, create_message(
+                MessageType.ERROR, "System", f"{name} is too large to share"
+            ))
+            return
+        self.outbound.send(client_socket, create_file_offer(
+            username, name, size, file_id, self.file_server.port
+        ))
+
+    def announce_file(self, file_id, meta):
+        """Tell everyone a completed upload can be downloaded"""
+        size_mb = meta["size"] / (1024 * 1024)
+        notice = ChatMessage(
+            MessageType.SYSTEM, "System",
+            f"{meta['username']} shared {meta['name']} ({size_mb:.1f} MB). "
+            f"Download with /download {file_id}"
+        )
+        self.broadcast_message(notice, None)
+
+    def send_roster(self, client_socket):
+        """Reply with a full roster snapshot; later changes arrive as deltas"""
+        version, users = self.roster.snapshot()
+        self.outbound.send(client_socket, create_roster_message(version, users))
+
+    def handshake(self, client_socket, reader):
+        """Run the HELLO and USERNAME exchange; returns the username, or None"""
+        client_address = client_socket.getpeername()
+        log_connection_status(ConnectionStatus.CONNECTING, f"from {client_address}")
+
+        message = reader.read_message()
+        msg_data = self.process_message(message) if message else None
+        
+        if not msg_data or msg_data["type"] != MessageType.HELLO.value:
+            log_error("handshake", f"Client {client_address} didn't say HELLO")
+            return None
             
-            # Get username
-            message = client_socket.recv(1024)
-            msg_data = self.process_message(message)
+        log_connection_status(ConnectionStatus.HANDSHAKE_STARTED, f"with {client_address}")
+        
+        # Send HELLO_ACK
+        hello_ack = create_handshake_message(MessageType.HELLO_ACK)
+        self.outbound.send(client_socket, hello_ack)
+        
+        # Get username
+        message = reader.read_message()
+        msg_data = self.process_message(message) if message else None
+        
+        if not msg_data or msg_data["type"] != MessageType.USERNAME.value:
+            print("Expected username, got something else")
+            return None
+        if type(msg_data.get("content")) is not str:
+            log_error("handshake", f"Client {client_address} sent no username")
+            return None
             
-            if msg_data["type"] != MessageType.USERNAME.value:
-                print("Expected username, got something else")
-                client_socket.close()
-                return
-                
-            username = msg_data["content"]
-            self.clients[client_socket] = username
+        username = msg_data["content"]
+        if self.file_server is not None:
+            username_ack = create_handshake_message(MessageType.USERNAME_ACK, file_port=self.file_server.port)
+        else:
             username_ack = create_handshake_message(MessageType.USERNAME_ACK)
-            client_socket.send(username_ack)
-            
-            log_connection_status(ConnectionStatus.CONNECTED, f"Client {username} fully connected")
-            print(f"{username} joined the chat")
+        self.outbound.send(client_socket, username_ack)
+        self.reaper.mark_logged_in(client_socket)
+        with self.clients_lock:
+            self.clients[client_socket] = username
+        if self.fanout is not None:
+            self.fanout.add_member(client_socket)
+        self.announce_presence(self.roster.join(username), "join", username)
+        if self.federation:
+            self.federation.publish_presence(username, 1)
+        
+        log_connection_status(ConnectionStatus.CONNECTED, f"Client {username} fully connected")
+        print(f"{username} joined the chat")
+        return username
+
+    def handle_frame(self, client_socket, username, frame, dedup):
+        """Act on one message from a logged-in client"""
+        self.reaper.touch(client_socket)
+
+        # Process message in parallel
+        msg_data = self.process_message(frame)
+        if msg_data is None:
+            return
+        msg_type = MESSAGE_TYPES.get(msg_data.get("type"))
+        if msg_type is MessageType.PONG:
+            return  # Only needed to show the client is alive
+        if msg_type is MessageType.PING:
+            self.outbound.send(client_socket, create_pong_message())
+        elif msg_type is MessageType.ROSTER:
+            self.send_roster(client_socket)
+        elif msg_type is MessageType.SEARCH:
+            if type(msg_data.get("content")) is str:
+                self.send_search_results(client_socket, msg_data["content"])
+            else:
+                log_error("message_validation", "search needs a string query")
+        elif msg_type is MessageType.FILE_OFFER:
+            self.accept_file_offer(client_socket, username, msg_data)
+        elif msg_type is MessageType.TYPING:
+            self.handle_event(client_socket, username, frame, msg_data)
+        elif msg_type is MessageType.JOIN:
+            system_message = ChatMessage(
+                MessageType.SYSTEM, 
+                "System", 
+                f"{username} joined the chat"
+            )
+            self.broadcast_message(system_message, client_socket)
+        elif msg_type is MessageType.LEAVE:
+            pass  # Announced once the connection closes
+        elif msg_type is MessageType.CHAT:
+            self.handle_chat(client_socket, username, frame, msg_data, dedup)
+        else:
+            # System and error messages only ever come from the server
+            log_error("message_validation", f"Clients can't send {msg_data.get('type')!r} messages")
+
+    def handle_client(self, client_socket, username=None, dedup=None):
+        """Handle client connection with parallel processing.
+
+        Clients handed over by a previous server process come with their
+        username and retry cache and skip the handshake.
+        """
+        handed_off = False
+        try:
+            reader = MessageReader(client_socket)
+            if self.handoff:
+                # Before the handshake, so a connection that never says HELLO
+                # can't hold up a handoff
+                reader.interrupt = self.handoff.wakeup
+            if username is None:
+                try:
+                    username = self.handshake(client_socket, reader)
+                except ReadInterrupted:
+                    return  # Not logged in yet; the client reconnects to the new process
+                if username is None:
+                    return
+                dedup = DedupCache()
             
             # Message handling loop
             while True:
                 try:
-                    message = client_socket.recv(1024)
-                    if not message:
+                    # A view into the connection's receive buffer, valid
+                    # until the next read
+                    frame = reader.read_frame()
+                    if frame is None:
                         break
-                        
-                    # Process message in parallel
-                    msg_data = self.process_message(message)
-                    if msg_data["type"] == MessageType.JOIN.value:
-                        system_message = create_message(
-                            MessageType.SYSTEM, 
-                            "System", 
-                            f"{username} joined the chat"
-                        )
-                        self.broadcast_message(system_message, client_socket)
-                    else:
-                        print(f"Received: {message.decode('utf-8')}")
-                        self.broadcast_message(message, client_socket)
-                        
+                    self.handle_frame(client_socket, username, frame, dedup)
+
+                except ReadInterrupted:
+                    # Stopped at a message boundary; the next process picks up from here
+                    self.handoff.pass_client(client_socket, username, dedup)
+                    handed_off = True
+                    break
                 except Exception as e:
                     print(f"Error handling client {username}: {e}")
                     break
@@ -163,31 +514,205 @@ class ChatServer:
             log_error("client_handler", str(e))
         
         finally:
-            if client_socket in self.clients:
-                log_connection_status(
-                    ConnectionStatus.DISCONNECTED, 
-                    f"Client {self.clients[client_socket]} disconnected"
-                )
-            self.remove_client(client_socket)
+            if handed_off:
+                self.reaper.forget(client_socket)
+            else:
+                self.drop_client(client_socket)
+            with self.handlers_changed:
+                self.handler_sockets.discard(client_socket)
+                self.handlers_changed.notify_all()
+
+    def drop_client(self, client_socket):
+        """Forget a connection whose handler is done with it and announce the departure"""
+        self.reaper.forget(client_socket)
+        self.events.forget(client_socket)
+        username = self.clients.get(client_socket)
+        if username is not None:
+            log_connection_status(
+                ConnectionStatus.DISCONNECTED, 
+                f"Client {username} disconnected"
+            )
+        self.remove_client(client_socket)
+
+    def start_handler(self, client_socket, username=None, dedup=None):
+        # Each client gets its own thread; sends go through the outbound
+        # scheduler's threads so a slow recipient can't stall its sender
+        with self.handlers_changed:
+            self.handler_sockets.add(client_socket)
+        self.outbound.register(client_socket)
+        self.reaper.watch(client_socket, logged_in=username is not None)
+        threading.Thread(
+            target=self.handle_client, args=(client_socket, username, dedup), daemon=True
+        ).start()
 
     def accept_clients(self):
         """Accept and handle client connections"""
+        selector = selectors.DefaultSelector()
+        selector.register(self.server_socket, selectors.EVENT_READ)
+        if self.handoff:
+            selector.register(self.handoff.wakeup, selectors.EVENT_READ)
         try:
             while True:
-                client_socket, client_address = self.server_socket.accept()
-                print(f"New connection from {client_address}")
-                # Submit client handling to thread pool
-                self.thread_pool.submit(self.handle_client, client_socket)
+                events = selector.select()
+                if self.handoff and any(key.fileobj is self.handoff.wakeup for key, _ in events):
+                    # The listening socket now belongs to the new process
+                    self.accept_stopped.set()
+                    self.handoff.finished.wait()
+                    return
+                # Drain the backlog, so a reconnect storm costs one wakeup
+                # per batch instead of one per connection
+                for _ in range(self.tuning.accept_batch):
+                    try:
+                        client_socket, client_address = self.server_socket.accept()
+                    except BlockingIOError:
+                        break
+                    except OSError as e:
+                        # e.g. out of file descriptors; back off rather than spin
+                        log_error("accept", str(e))
+                        time.sleep(0.1)
+                        break
+                    self.tuning.configure_connection(client_socket)
+                    print(f"New connection from {client_address}")
+                    self.start_handler(client_socket)
                 
         except KeyboardInterrupt:
             print("Server shutting down...")
             # Cleanup
-            self.thread_pool.shutdown()
-            for client_socket in self.clients:
-                client_socket.close()
+            self.reaper.stop()
+            self.events.stop()
+            self.archiver.stop()
+            if self.federation:
+                self.federation.stop()
+            self.file_server.stop()
+            self.outbound.stop()
+            with self.clients_lock:
+                for client_socket in list(self.clients):
+                    client_socket.close()
+            self.search_index.close()
             self.server_socket.close()
 
-if __name__ == "__main__":
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or HOST, int(port)
+
+def run_worker(index, bus_paths, host, port, file_port, tuning=None,
+               ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT, priority_lanes=True,
+               fanout_helpers=0):
+    """One worker process: its own connections, linked to the others over the bus"""
     setup_logging()
-    server = ChatServer()
+    server = ChatServer(
+        host, port, reuse_port=True, search_index_path=f'logs/search_index_worker{index}.jsonl',
+        file_port=file_port, tuning=tuning, ping_interval=ping_interval, idle_timeout=idle_timeout,
+        archive_logs=index == 0, priority_lanes=priority_lanes, fanout_helpers=fanout_helpers
+    )
+    # Dial the workers started before this one; together that forms a full mesh
+    server.enable_federation(f"worker{index}", bus_paths[index], bus_paths[:index], shared_logs=True)
     server.accept_clients()
+
+def run_workers(num_workers, host=HOST, port=PORT, file_port=None, tuning=None,
+                ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT, priority_lanes=True,
+                fanout_helpers=0):
+    """Fork worker processes that share the listening port via SO_REUSEPORT.
+
+    Chat, system and presence traffic crosses between workers over UNIX
+    sockets, so every client still sees one chat room.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+    bus_dir = tempfile.mkdtemp(prefix='chat_bus_')
+    bus_paths = [os.path.join(bus_dir, f"worker{i}.sock") for i in range(num_workers)]
+    workers = [Process(target=run_worker, args=(i, bus_paths, host, port, file_port, tuning,
+                                                ping_interval, idle_timeout, priority_lanes,
+                                                fanout_helpers))
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    print(f"Started {num_workers} workers on {host}:{port}")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # A terminal Ctrl-C reaches the workers too; pass it on to any that
+        # didn't get it (e.g. the parent was signalled on its own)
+        for worker in workers:
+            worker.join(timeout=2)
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGINT)
+                worker.join()
+    finally:
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NetComs chat server")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--node-id', help="Enable federation under this node ID")
+    parser.add_argument('--peer-port', type=int, help="Port for server-to-server links")
+    parser.add_argument('--peers', default="",
+                        help="Comma-separated host:port addresses of every node started "
+                             "before this one; nodes must form a full mesh")
+    parser.add_argument('--file-port', type=int, help="Port for file transfers (default: any free port)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Worker processes sharing the port via SO_REUSEPORT")
+    parser.add_argument('--backlog', type=int, default=socket.SOMAXCONN,
+                        help="Pending connections queued by the kernel")
+    parser.add_argument('--accept-batch', type=int, default=64,
+                        help="Most connections accepted per listener wakeup")
+    parser.add_argument('--send-buffer', type=int, help="SO_SNDBUF for client sockets")
+    parser.add_argument('--receive-buffer', type=int, help="SO_RCVBUF for client sockets")
+    parser.add_argument('--no-nodelay', action='store_true',
+                        help="Leave Nagle's algorithm on for client sockets")
+    parser.add_argument('--no-keepalive', action='store_true',
+                        help="Don't send TCP keepalive probes to idle clients")
+    parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL,
+                        help="Seconds a client may stay quiet before it is pinged")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="Seconds a client may stay quiet before it is disconnected")
+    parser.add_argument('--no-priority-lanes', action='store_true',
+                        help="Send everything to a client in arrival order, with no control lane")
+    parser.add_argument('--fanout-helpers', type=int, default=0,
+                        help="Send to clients from this many helper processes (for very large rooms)")
+    parser.add_argument('--handoff', metavar='PATH',
+                        help="UNIX socket where a new server process can take over this one")
+    parser.add_argument('--take-over', action='store_true',
+                        help="Start by taking over the clients of the server at --handoff")
+    args = parser.parse_args()
+    if args.take_over and not args.handoff:
+        parser.error("--take-over needs --handoff")
+    tuning = SocketTuning(
+        backlog=args.backlog, accept_batch=args.accept_batch, nodelay=not args.no_nodelay,
+        send_buffer=args.send_buffer, receive_buffer=args.receive_buffer,
+        keepalive=not args.no_keepalive
+    )
+
+    if args.workers > 1:
+        run_workers(args.workers, args.host, args.port, args.file_port, tuning,
+                    args.ping_interval, args.idle_timeout, not args.no_priority_lanes,
+                    args.fanout_helpers)
+    else:
+        setup_logging()
+        index_path = f'logs/search_index_{args.node_id}.jsonl' if args.node_id else SEARCH_INDEX_PATH
+        state, listen_socket, clients = None, None, []
+        if args.take_over:
+            state, listen_socket, clients = take_over(args.handoff)
+        server = ChatServer(
+            args.host, args.port, search_index_path=index_path,
+            # Handed-over clients were told the old process's file port
+            file_port=state["file_port"] if state and args.file_port is None else args.file_port,
+            listen_socket=listen_socket, tuning=tuning,
+            ping_interval=args.ping_interval, idle_timeout=args.idle_timeout,
+            priority_lanes=not args.no_priority_lanes, fanout_helpers=args.fanout_helpers
+        )
+        if state:
+            server.restore_state(state, clients)
+        if args.handoff:
+            server.enable_handoff(args.handoff)
+        if args.node_id:
+            peers = [parse_address(peer) for peer in args.peers.split(',') if peer]
+            peer_address = (args.host, args.peer_port or args.port + 1000)
+            server.enable_federation(
+                args.node_id, peer_address, peers, seq=state["federation_seq"] if state else 0
+            )
+        if state:
+            server.resume_clients(state, clients)
+        server.accept_clients()
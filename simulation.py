@@ -0,0 +1,252 @@
+import contextlib
+import errno
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from protocol import (
+    MessageType, create_message, create_handshake_message, create_pong_message,
+    parse_message, MessageReader
+)
+from dedup import DedupCache
+from heartbeat import PING_INTERVAL, IDLE_TIMEOUT
+from server import ChatServer
+
+class VirtualClock:
+    """A clock that only moves when advanced, for deterministic idle timing"""
+    def __init__(self, start: float = 0.0):
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+class MemorySocket:
+    """One end of an in-memory stream connection.
+
+    Supports the socket calls ChatServer makes on client connections. Writes
+    never block and land in the peer's inbox; reads behave like a
+    non-blocking socket, raising BlockingIOError when nothing has arrived
+    and returning 0 once the connection is shut down and drained.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.peer = None
+        self.inbox = deque()  # bytes chunks, oldest first
+        self.shut_down = False
+        self.lock = threading.Lock()  # Broadcasts write from the server's pool threads
+
+    def getpeername(self) -> str:
+        return self.peer.name
+
+    def readable(self) -> bool:
+        """True if a read would return data or end-of-stream instead of blocking"""
+        return bool(self.inbox) or self.shut_down or self.peer.shut_down
+
+    def recv_into(self, buffer, nbytes: int = 0) -> int:
+        view = memoryview(buffer).cast('B')
+        size = nbytes or len(view)
+        received = 0
+        with self.lock:
+            while self.inbox and received < size:
+                chunk = self.inbox.popleft()
+                count = min(len(chunk), size - received)
+                view[received:received + count] = chunk[:count]
+                if count < len(chunk):
+                    self.inbox.appendleft(chunk[count:])
+                received += count
+        if not received and not (self.shut_down or self.peer.shut_down):
+            raise BlockingIOError(errno.EAGAIN, "No data waiting")
+        return received
+
+    def recv(self, bufsize: int) -> bytes:
+        buffer = bytearray(bufsize)
+        return bytes(buffer[:self.recv_into(buffer)])
+
+    def sendall(self, data):
+        if self.shut_down or self.peer.shut_down:
+            raise BrokenPipeError(errno.EPIPE, "Connection closed")
+        with self.peer.lock:
+            self.peer.inbox.append(bytes(data))
+
+    def send(self, data, flags: int = 0) -> int:
+        self.sendall(data)
+        return len(data)
+
+    def shutdown(self, how: int):
+        self.shut_down = True
+
+    def close(self):
+        self.shut_down = True
+
+def memory_socketpair(name: str):
+    """Return (server end, client end) of a new in-memory connection"""
+    server_end = MemorySocket(f"server:{name}")
+    client_end = MemorySocket(name)
+    server_end.peer = client_end
+    client_end.peer = server_end
+    return server_end, client_end
+
+class SimulatedClient:
+    """A chat client driven by a Simulation"""
+    def __init__(self, username: str, sock, server_sock, answer_pings: bool = True, clock=time.monotonic):
+        self.username = username
+        self.sock = sock
+        self.server_sock = server_sock
+        self.reader = MessageReader(sock)
+        self.server_reader = MessageReader(server_sock)  # The server's side of the connection
+        self.dedup = DedupCache(clock=clock)
+        self.answer_pings = answer_pings
+        self.connected = True
+        self.received = []  # Parsed messages, oldest first
+
+    def send(self, message: bytes):
+        self.sock.sendall(message)
+
+    def chat(self, content: str, msg_id: str = None):
+        self.send(create_message(MessageType.CHAT, self.username, content, msg_id=msg_id))
+
+    def deliver(self) -> int:
+        """Read whatever the server has sent; returns the number of messages"""
+        count = 0
+        while self.reader.has_frame() or self.sock.inbox:
+            frame = self.reader.read_frame()
+            if frame is None:
+                break
+            msg_data = parse_message(frame)
+            if msg_data["type"] == MessageType.PING.value and self.answer_pings:
+                try:
+                    self.send(create_pong_message())
+                except BrokenPipeError:
+                    pass  # Dropped by the server in the meantime
+            self.received.append(msg_data)
+            count += 1
+        return count
+
+    def messages(self, msg_type: MessageType) -> list:
+        return [msg for msg in self.received if msg["type"] == msg_type.value]
+
+class Simulation:
+    """Runs ChatServer's message handling in-process with no ports and no threads per client.
+
+    Clients talk to the server over MemorySocket pairs. The simulation
+    reads their messages in rounds, one message per client per round in
+    connection order, and hands each to ChatServer.handle_frame, so a run
+    with the same inputs always processes messages in the same order.
+    Idle tracking and event coalescing use a VirtualClock that moves only
+    through advance().
+    Logs and the search index go to a scratch directory (logs to log_dir
+    instead if given, e.g. one shared by several simulations), and the server's
+    console output is discarded unless an output stream is given.
+    """
+    def __init__(self, ping_interval: float = PING_INTERVAL, idle_timeout: float = IDLE_TIMEOUT,
+                 directory: str = None, output=None, log_dir: str = None):
+        self.temp_dir = None
+        if directory is None:
+            self.temp_dir = tempfile.TemporaryDirectory()
+            directory = self.temp_dir.name
+        self.owns_output = output is None
+        self.output = open(os.devnull, 'w') if output is None else output
+        self.clock = VirtualClock()
+        self.clients = {}  # username -> SimulatedClient, in connection order
+        with self.quiet():
+            self.server = ChatServer(
+                listen=False, clock=self.clock, log_dir=log_dir or directory, archive_logs=False,
+                search_index_path=os.path.join(directory, 'search_index.jsonl'),
+                upload_dir=os.path.join(directory, 'uploads'), send_threads=0,
+                ping_interval=ping_interval, idle_timeout=idle_timeout
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def quiet(self):
+        return contextlib.redirect_stdout(self.output)
+
+    def connect(self, username: str, answer_pings: bool = True) -> SimulatedClient:
+        """Connect a client and complete its handshake.
+
+        Like everything the server sends, the replies are read by the client
+        at the end of the next step.
+        """
+        server_sock, sock = memory_socketpair(username)
+        client = SimulatedClient(username, sock, server_sock, answer_pings, self.clock)
+        # The handshake reads both messages in turn, so they can be sent up front
+        client.send(create_handshake_message(MessageType.HELLO))
+        client.send(create_message(MessageType.USERNAME, username, username))
+        with self.quiet():
+            self.server.outbound.register(server_sock)
+            self.server.reaper.watch(server_sock)
+            if self.server.handshake(server_sock, client.server_reader) is None:
+                self.server.drop_client(server_sock)
+                client.connected = False
+                return client
+        self.clients[username] = client
+        return client
+
+    def disconnect(self, username: str):
+        """Close a client's connection and let the server notice"""
+        self.clients[username].sock.close()
+        self.run()
+
+    def deliver(self) -> int:
+        """Send what the server queued and let every client read it"""
+        with self.quiet():
+            self.server.outbound.flush()
+        return sum(client.deliver() for client in list(self.clients.values()))
+
+    def step(self) -> int:
+        """Handle at most one message from each client; returns how many were handled"""
+        handled = 0
+        with self.quiet():
+            for client in list(self.clients.values()):
+                if not (client.server_reader.has_frame() or client.server_sock.readable()):
+                    continue
+                frame = client.server_reader.read_frame()
+                if frame is None:
+                    client.connected = False
+                    del self.clients[client.username]
+                    self.server.drop_client(client.server_sock)
+                    continue
+                self.server.handle_frame(client.server_sock, client.username, frame, client.dedup)
+                handled += 1
+        self.deliver()
+        return handled
+
+    def run(self) -> int:
+        """Step until no client has anything left to send; returns the messages handled"""
+        total = 0
+        while True:
+            handled = self.step()
+            # A step that only found closed connections can still have left replies
+            if not handled and not any(client.server_sock.readable()
+                                       for client in self.clients.values()):
+                return total
+            total += handled
+
+    def advance(self, seconds: float) -> list:
+        """Move the clock on, let the reaper and event coalescer act, and run; returns the usernames dropped"""
+        self.clock.advance(seconds)
+        with self.quiet():
+            dropped = self.server.reaper.check()
+            self.server.events.check()
+        names = [client.username for client in self.clients.values()
+                 if client.server_sock in dropped]
+        self.deliver()
+        self.run()
+        return names
+
+    def close(self):
+        with self.quiet():
+            self.server.outbound.stop()
+            self.server.search_index.close()
+        if self.owns_output:
+            self.output.close()
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
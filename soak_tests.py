@@ -0,0 +1,285 @@
+import argparse
+import os
+import random
+import socket
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from protocol import MessageType, create_message, create_typing_message, parse_message
+from chat_benchmarks import HOST, start_server, stop_servers, connect_client
+
+def process_stats(pid: int) -> dict:
+    """Resident memory, open file descriptors and threads of a process, from /proc"""
+    stats = {"fds": len(os.listdir(f"/proc/{pid}/fd"))}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                stats["rss_kb"] = int(line.split()[1])
+            elif line.startswith("Threads:"):
+                stats["threads"] = int(line.split()[1])
+    return stats
+
+class SoakRun:
+    """Churns clients through connect, chat and disconnect against one server process.
+
+    Each of a few driver threads owns a share of the client slots and goes
+    round them every ROUND seconds: an empty slot connects a new client, a
+    connected one reads whatever has arrived for it, then chats, sends a
+    typing event, or disconnects. A disconnect is a LEAVE and close, a
+    close halfway through a frame, or a reset. A sampler records the
+    server's memory, descriptors and threads alongside the traffic.
+    """
+    ROUND = 0.1  # Seconds between visits to each client slot
+
+    def __init__(self, port: int, clients: int, drivers: int, rate: float, churn: float,
+                 pid: int, interval: float):
+        self.port = port
+        self.clients = clients
+        self.drivers = drivers
+        self.rate = rate  # Chat messages per connected client per second
+        self.churn = churn  # Chance a connected client leaves on each visit
+        self.pid = pid
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.counts = {"connects": 0, "connect_failures": 0, "disconnects": 0,
+                       "sent": 0, "delivered": 0, "connected": 0}
+        self.samples = []  # One dict per interval: process_stats plus traffic since the last
+        self.errors = []
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def run(self, seconds: float):
+        start = time.monotonic()
+        threads = [threading.Thread(target=self.drive, args=(index,), daemon=True)
+                   for index in range(self.drivers)]
+        for thread in threads:
+            thread.start()
+        last = dict(self.counts)
+        while time.monotonic() - start < seconds:
+            time.sleep(self.interval)
+            with self.lock:
+                counts = dict(self.counts)
+            sample = process_stats(self.pid)
+            sample["elapsed"] = time.monotonic() - start
+            sample["connected"] = counts["connected"]
+            for name in ("connects", "sent", "delivered"):
+                sample[name] = (counts[name] - last[name]) / self.interval
+            self.samples.append(sample)
+            last = counts
+        self.stopping.set()
+        for thread in threads:
+            thread.join()
+
+    def drive(self, index: int):
+        rng = random.Random(index)
+        slots = [None] * (self.clients // self.drivers + (index < self.clients % self.drivers))
+        generation = 0
+        try:
+            while not self.stopping.is_set():
+                for slot, sock in enumerate(slots):
+                    if sock is None:
+                        generation += 1
+                        slots[slot] = self.connect(f"soak{index}_{slot}_{generation}")
+                        continue
+                    if not self.drain(sock):
+                        self.close(sock)
+                        slots[slot] = None
+                        continue
+                    roll = rng.random()
+                    if roll < self.churn:
+                        self.leave(sock, rng.randrange(3))
+                        slots[slot] = None
+                    elif roll < self.churn + self.rate * self.ROUND:
+                        self.send(sock, create_message(MessageType.CHAT, "soak", "x" * rng.randrange(10, 200)))
+                    elif roll < self.churn + 2 * self.rate * self.ROUND:
+                        self.send(sock, create_typing_message("soak", rng.random() < 0.5))
+                time.sleep(self.ROUND)
+        except Exception as e:
+            self.errors.append(f"Driver {index}: {e!r}")
+        finally:
+            for sock in slots:
+                if sock is not None:
+                    self.close(sock)
+
+    def connect(self, username: str):
+        try:
+            sock, _ = connect_client(HOST, self.port, username)
+        except (OSError, ConnectionError):
+            self.count("connect_failures")
+            return None
+        self.count("connects")
+        self.count("connected")
+        return sock
+
+    def send(self, sock, message: bytes):
+        try:
+            sock.sendall(message)
+            self.count("sent")
+        except OSError:
+            pass  # Dropped by the server; the next drain notices
+
+    def drain(self, sock) -> bool:
+        """Read everything waiting without blocking; False once the server has closed"""
+        frames = 0
+        try:
+            while True:
+                data = sock.recv(65536, socket.MSG_DONTWAIT)
+                if not data:
+                    return False
+                frames += data.count(b"\n")
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self.count("delivered", frames)
+
+    def leave(self, sock, how: int):
+        try:
+            if how == 0:
+                sock.sendall(create_message(MessageType.LEAVE, "soak", "left the chat"))
+            elif how == 1:
+                sock.sendall(create_message(MessageType.CHAT, "soak", "cut off")[:20])
+            else:
+                # Close with a reset instead of a FIN
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except OSError:
+            pass
+        self.close(sock)
+
+    def close(self, sock):
+        sock.close()
+        self.count("connected", -1)
+        self.count("disconnects")
+
+    def report(self):
+        print(f"{'time':>6} {'rss MB':>7} {'fds':>5} {'threads':>7} {'clients':>7} "
+              f"{'conn/s':>7} {'sent/s':>7} {'recv/s':>8}")
+        for sample in self.samples:
+            print(f"{sample['elapsed']:6.0f} {sample['rss_kb'] / 1024:7.1f} {sample['fds']:5} "
+                  f"{sample['threads']:7} {sample['connected']:7} {sample['connects']:7.1f} "
+                  f"{sample['sent']:7.1f} {sample['delivered']:8.0f}")
+
+class TestSoak(unittest.TestCase):
+    """Runs a ChatServer process under client churn and fails on leaks or slowdown.
+
+    Settings come from SOAK_* environment variables, or from the command
+    line when this file is run directly:
+
+        python soak_tests.py --seconds 600 --clients 500
+
+    The first fifth of the run is warm-up. After it, the server's memory
+    may grow by max_rss_growth_mb at most, and delivery throughput over
+    the last third of the run must stay within max_slowdown of the first
+    third. Once every client has gone, descriptors and threads must come
+    back to what the server had before the run. Reads /proc, so Linux only.
+    """
+    seconds = float(os.environ.get("SOAK_SECONDS", 30))
+    clients = int(os.environ.get("SOAK_CLIENTS", 200))
+    drivers = int(os.environ.get("SOAK_DRIVERS", 10))
+    rate = float(os.environ.get("SOAK_RATE", 0.5))
+    churn = float(os.environ.get("SOAK_CHURN", 0.02))
+    port = int(os.environ.get("SOAK_PORT", 9900))
+    server_args = os.environ.get("SOAK_SERVER_ARGS", "").split()
+    max_rss_growth_mb = float(os.environ.get("SOAK_MAX_RSS_GROWTH_MB", 32))
+    max_slowdown = float(os.environ.get("SOAK_MAX_SLOWDOWN", 0.5))
+    settle_seconds = 15.0  # Time the server gets to clean up after the last client leaves
+
+    def setUp(self):
+        if not os.path.isdir("/proc/self/fd"):
+            self.skipTest("Needs /proc")
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.server = start_server(self.port, *self.server_args, cwd=self.temp_dir.name)
+
+    def tearDown(self):
+        stop_servers([self.server])
+        self.temp_dir.cleanup()
+
+    def round_trip(self, tag: str):
+        """One client says something and another hears it"""
+        listener, reader = connect_client(HOST, self.port, f"{tag}_listener")
+        speaker, _ = connect_client(HOST, self.port, f"{tag}_speaker")
+        try:
+            speaker.sendall(create_message(MessageType.CHAT, f"{tag}_speaker", tag))
+            listener.settimeout(10)
+            while True:
+                msg = parse_message(reader.read_message())
+                if msg["type"] == MessageType.CHAT.value and msg["content"] == tag:
+                    return
+        finally:
+            listener.close()
+            speaker.close()
+
+    def settled(self, baseline: dict) -> dict:
+        """Wait for descriptors and threads to come back down; returns the last reading"""
+        deadline = time.monotonic() + self.settle_seconds
+        while True:
+            stats = process_stats(self.server.pid)
+            back = stats["fds"] <= baseline["fds"] and stats["threads"] <= baseline["threads"]
+            if back or time.monotonic() > deadline:
+                return stats
+            time.sleep(0.2)
+
+    def test_churn(self):
+        """Test that the server survives churn without leaking or slowing down"""
+        self.round_trip("warmup")
+        baseline = self.settled(process_stats(self.server.pid))
+        run = SoakRun(self.port, self.clients, self.drivers, self.rate, self.churn,
+                      self.server.pid, interval=max(1.0, self.seconds / 30))
+        run.run(self.seconds)
+        final = self.settled(baseline)
+        run.report()
+        print(f"{run.counts['connects']} connects ({run.counts['connect_failures']} failed), "
+              f"{run.counts['disconnects']} disconnects, {run.counts['sent']} messages sent, "
+              f"{run.counts['delivered']} delivered")
+        print(f"Before: {baseline}  after: {final}")
+
+        self.assertIsNone(self.server.poll(), "Server process exited")
+        self.assertEqual(run.errors, [])
+        self.assertLessEqual(run.counts["connect_failures"], max(1, run.counts["connects"] // 100))
+        self.assertLessEqual(final["fds"], baseline["fds"], "File descriptors leaked")
+        self.assertLessEqual(final["threads"], baseline["threads"], "Threads leaked")
+
+        steady = [sample for sample in run.samples if sample["elapsed"] > self.seconds / 5]
+        self.assertGreaterEqual(len(steady), 3, "Run too short to judge")
+        growth_mb = (final["rss_kb"] - steady[0]["rss_kb"]) / 1024
+        self.assertLessEqual(growth_mb, self.max_rss_growth_mb,
+                             f"Memory grew {growth_mb:.1f} MB after warm-up")
+        third = max(1, len(steady) // 3)
+        first = statistics.median(sample["delivered"] for sample in steady[:third])
+        last = statistics.median(sample["delivered"] for sample in steady[-third:])
+        self.assertGreaterEqual(last, first * (1 - self.max_slowdown),
+                                f"Deliveries fell from {first:.0f}/s to {last:.0f}/s")
+
+        # Still serving, and nothing went wrong while clients came and went mid-broadcast
+        self.round_trip("after")
+        with open(os.path.join(self.temp_dir.name, 'logs',
+                               f'debug_{time.strftime("%Y-%m-%d")}.log')) as f:
+            broadcast_errors = [line for line in f if "Error (broadcast)" in line]
+        self.assertEqual(broadcast_errors, [])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server soak test")
+    parser.add_argument('--seconds', type=float, default=TestSoak.seconds)
+    parser.add_argument('--clients', type=int, default=TestSoak.clients)
+    parser.add_argument('--drivers', type=int, default=TestSoak.drivers,
+                        help="Threads driving the clients")
+    parser.add_argument('--rate', type=float, default=TestSoak.rate,
+                        help="Chat messages per client per second")
+    parser.add_argument('--churn', type=float, default=TestSoak.churn,
+                        help="Chance a client disconnects on each 0.1 s visit")
+    parser.add_argument('--port', type=int, default=TestSoak.port)
+    parser.add_argument('--max-rss-growth-mb', type=float, default=TestSoak.max_rss_growth_mb)
+    parser.add_argument('--max-slowdown', type=float, default=TestSoak.max_slowdown)
+    parser.add_argument('server_args', nargs='*', default=TestSoak.server_args, help="Passed to server.py, after --")
+    args = parser.parse_args()
+    for name, value in vars(args).items():
+        setattr(TestSoak, name, value)
+    unittest.main(argv=[sys.argv[0], '-v'])
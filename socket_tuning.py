@@ -0,0 +1,51 @@
+import socket
+
+class SocketTuning:
+    """Options for the chat listener and the client connections it accepts.
+
+    Buffer sizes left as None stay under the kernel's autotuning. Keepalive
+    probes find clients whose machines vanished without closing the
+    connection; the timings are in seconds.
+    """
+    def __init__(self, backlog: int = socket.SOMAXCONN, accept_batch: int = 64,
+                 nodelay: bool = True, send_buffer: int = None, receive_buffer: int = None,
+                 keepalive: bool = True, keepalive_idle: int = 60, keepalive_interval: int = 10,
+                 keepalive_count: int = 5):
+        self.backlog = backlog  # Completed connections the kernel queues before refusing more
+        self.accept_batch = accept_batch  # Most connections accepted per listener wakeup
+        self.nodelay = nodelay  # Send small chat frames at once instead of waiting on Nagle
+        self.send_buffer = send_buffer
+        self.receive_buffer = receive_buffer
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+
+    def configure_listener(self, sock):
+        """Apply buffer sizes and the backlog to a bound socket and start listening.
+
+        Accepted connections inherit the buffer sizes, which have to be set
+        before listen() to take part in the TCP window negotiation. The
+        listener is made non-blocking so the accept loop can drain a whole
+        burst of connections and then go back to waiting.
+        """
+        if self.send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        if self.receive_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+
+    def configure_connection(self, sock):
+        """Apply per-connection options to an accepted client socket"""
+        sock.setblocking(True)
+        if self.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # The probe timings are Linux and BSD options
+            for option, value in (('TCP_KEEPIDLE', self.keepalive_idle),
+                                  ('TCP_KEEPINTVL', self.keepalive_interval),
+                                  ('TCP_KEEPCNT', self.keepalive_count)):
+                if hasattr(socket, option):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
@@ -4,9 +4,41 @@ from protocol import (
     create_message, 
     parse_message, 
     format_message_for_display,
-    create_handshake_message
+    create_handshake_message,
+    create_roster_message,
+    create_presence_message,
+    create_ack_message,
+    create_search_results,
+    MessageReader,
+    ReadInterrupted,
+    ChatMessage,
+    EphemeralEvent,
+    create_typing_message,
+    InvalidMessage
 )
+from roster import Roster, RosterView
+from dedup import DedupCache
+from federation import Federation, PeerLink
+from search_index import SearchIndex, journal_date_sizes
+from file_transfer import FileStore, FileServer, upload_file, download_file
+from handoff import Handoff, send_record, recv_record
+from socket_tuning import SocketTuning
+from timer_wheel import TimerWheel
+from heartbeat import IdleReaper
+from log_archive import LogArchiver
+from ephemeral import EventCoalescer
+from simulation import Simulation
+from outbound import OutboundScheduler, CONTROL, SYSTEM, CHAT
+from fanout import SharedFanout
+from protocol import create_relay_message
+from chat_benchmarks import start_server, stop_servers, connect_client
 import json
+import os
+import socket
+import tempfile
+import threading
+import gzip
+import time
 from datetime import datetime
 
 class TestProtocol(unittest.TestCase):
@@ -106,5 +138,1117 @@ class TestProtocol(unittest.TestCase):
         with self.assertRaises(KeyError):
             format_message_for_display(parsed)
 
+    def test_message_reader_splits_stream(self):
+        """Test that back-to-back messages are split on the delimiter"""
+        left, right = socket.socketpair()
+        try:
+            first = create_message(MessageType.CHAT, self.username, "one", self.timestamp)
+            second = create_presence_message(3, "join", self.username)
+            left.sendall(first + second[:10])
+            left.sendall(second[10:])
+            left.close()
+
+            reader = MessageReader(right, bufsize=7)
+            self.assertEqual(parse_message(reader.read_message())['content'], "one")
+            self.assertEqual(parse_message(reader.read_message())['version'], 3)
+            self.assertIsNone(reader.read_message())
+        finally:
+            right.close()
+
+    def test_message_ids_and_acks(self):
+        """Test optional client message IDs and server acknowledgements"""
+        plain = parse_message(create_message(MessageType.CHAT, self.username, self.content))
+        self.assertNotIn('msg_id', plain)
+
+        tagged = parse_message(
+            create_message(MessageType.CHAT, self.username, self.content, msg_id="abc")
+        )
+        self.assertEqual(tagged['msg_id'], "abc")
+
+        ack = parse_message(create_ack_message("abc", 42))
+        self.assertEqual(ack['type'], MessageType.ACK.value)
+        self.assertEqual((ack['msg_id'], ack['seq']), ("abc", 42))
+
+class TestChatMessage(unittest.TestCase):
+    def test_decoded_message_keeps_its_frame(self):
+        """Test that a parsed message is re-sent as the exact bytes it arrived in"""
+        frame = create_message(MessageType.CHAT, "alice", "hi", "12:00:00", msg_id="m1")
+        message = ChatMessage.decode(memoryview(frame))
+        self.assertIs(message.type, MessageType.CHAT)
+        self.assertEqual((message.username, message.content, message.msg_id), ("alice", "hi", "m1"))
+        self.assertEqual(message.encode(), frame)
+        self.assertIs(message.encode(), message.encode())
+
+    def test_new_message_round_trips(self):
+        """Test that a locally built message encodes once and parses back the same"""
+        message = ChatMessage(MessageType.SYSTEM, "System", "bob left the chat", "12:00:00")
+        self.assertEqual(parse_message(message.encode()), message.to_dict())
+        self.assertNotIn("msg_id", message.to_dict())
+        self.assertFalse(hasattr(message, "__dict__"))
+
+    def test_invalid_messages_are_rejected(self):
+        """Test validation of JSON, message type and field types"""
+        for frame in (b'invalid json\n', b'[1, 2]\n',
+                      b'{"type": "chat"}\n',
+                      b'{"type": "hello", "username": "a", "content": "b", "timestamp": "c"}\n',
+                      b'{"type": "chat", "username": "a", "content": 5, "timestamp": "c"}\n',
+                      b'{"type": "chat", "username": "a", "content": "b", "timestamp": "c", "msg_id": 7}\n'):
+            with self.assertRaises(InvalidMessage):
+                ChatMessage.decode(frame)
+
+    def test_ephemeral_events_are_validated(self):
+        """Test that typing events round-trip and only carry start or stop"""
+        frame = create_typing_message("alice", True)
+        event = EphemeralEvent.decode(frame)
+        self.assertEqual((event.type, event.username, event.content), (MessageType.TYPING, "alice", "start"))
+        self.assertEqual(event.encode(), frame)
+        for frame in (b'{"type": "typing", "username": "a", "content": "dancing"}\n',
+                      b'{"type": "typing", "content": "stop"}\n',
+                      create_message(MessageType.CHAT, "a", "start")):
+            with self.assertRaises(InvalidMessage):
+                EphemeralEvent.decode(frame)
+
+class TestDedupCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.cache = DedupCache(max_entries=3, window=10.0, clock=lambda: self.now)
+
+    def test_retry_returns_assigned_sequence(self):
+        """Test that a retried ID maps back to its first sequence number"""
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", 7)
+        self.assertEqual(self.cache.get("a"), 7)
+
+    def test_least_recently_used_is_evicted(self):
+        """Test that the cache stays within max_entries"""
+        for seq, msg_id in enumerate("abc"):
+            self.cache.put(msg_id, seq)
+        self.cache.get("a")
+        self.cache.put("d", 3)
+        self.assertEqual(len(self.cache), 3)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), 0)
+
+    def test_entries_expire_after_window(self):
+        """Test the time window on cached IDs"""
+        self.cache.put("a", 1)
+        self.now = 5.0
+        self.cache.put("b", 2)
+        self.now = 12.0
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("b"), 2)
+        self.now = 30.0
+        self.cache.put("c", 3)
+        self.assertEqual(len(self.cache), 1)
+
+class TestMessageReader(unittest.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_frames_are_views_into_the_buffer(self):
+        """Test that frames keep their delimiter and need no copy"""
+        self.left.sendall(create_message(MessageType.CHAT, "alice", "one", "12:00:00"))
+        frame = MessageReader(self.right).read_frame()
+        self.assertIsInstance(frame, memoryview)
+        self.assertEqual(bytes(frame[-1:]), b"\n")
+        self.assertEqual(parse_message(frame)['content'], "one")
+
+    def test_buffer_compacts_and_grows(self):
+        """Test messages that straddle the end of the buffer or outgrow it"""
+        reader = MessageReader(self.right, bufsize=64)
+        contents = ["a" * 10, "b" * 30, "c" * 200, "d" * 5]
+        for content in contents:
+            self.left.sendall(create_message(MessageType.CHAT, "alice", content, "12:00:00"))
+        self.left.close()
+        received = []
+        sizes = []
+        while True:
+            frame = reader.read_frame()
+            if frame is None:
+                break
+            received.append(parse_message(frame)['content'])
+            sizes.append(len(reader.buffer))
+        self.assertEqual(received, contents)
+        self.assertGreaterEqual(max(sizes), 256)
+        # Back to the starting size once the big message has been read
+        self.assertEqual(len(reader.buffer), 64)
+
+    def test_oversized_message_is_refused(self):
+        """Test the cap on how far the buffer may grow"""
+        reader = MessageReader(self.right, bufsize=16, max_message_size=32)
+        self.left.sendall(b"x" * 100)
+        with self.assertRaises(ValueError):
+            reader.read_frame()
+
+    def test_body_follows_message(self):
+        """Test raw bytes after a header, partly already buffered"""
+        reader = MessageReader(self.right, bufsize=32)
+        body = os.urandom(1000)
+        self.left.sendall(b'{"type": "file_chunk"}\n' + body + b'{"type": "chat"}\n')
+        self.assertEqual(parse_message(reader.read_frame())['type'], "file_chunk")
+        chunks = []
+        reader.read_body(len(body), lambda view: chunks.append(bytes(view)))
+        self.assertEqual(b"".join(chunks), body)
+        self.assertEqual(parse_message(reader.read_frame())['type'], "chat")
+
+class TestHandoff(unittest.TestCase):
+    def test_reader_stops_only_at_message_boundary(self):
+        """Test that an interrupt never strands half a message in the buffer"""
+        left, right = socket.socketpair()
+        wakeup, trigger = socket.socketpair()
+        reader = MessageReader(right)
+        reader.interrupt = wakeup
+        message = create_message(MessageType.CHAT, "alice", "hi", "12:00:00")
+        left.sendall(message + message[:10])
+        self.assertEqual(parse_message(reader.read_frame())['content'], "hi")
+        trigger.send(b"!")
+        left.sendall(message[10:])
+        self.assertEqual(parse_message(reader.read_frame())['content'], "hi")
+        with self.assertRaises(ReadInterrupted):
+            reader.read_frame()
+        for sock in (left, right, wakeup, trigger):
+            sock.close()
+
+    def test_client_socket_passes_between_processes(self):
+        """Test sending a live connection with its state over SCM_RIGHTS"""
+        old, new = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        client, server_side = socket.socketpair()
+        send_record(old, {"kind": "client", "username": "alice"}, [server_side.fileno()])
+        server_side.close()
+        record, sockets = recv_record(new)
+        self.assertEqual(record["username"], "alice")
+        client.sendall(b"still connected")
+        self.assertEqual(sockets[0].recv(100), b"still connected")
+        old.close()
+        self.assertEqual(recv_record(new), (None, []))
+        for sock in sockets + [new, client]:
+            sock.close()
+
+    def test_drain_does_not_wait_for_handshakes(self):
+        """Test that clients not logged in are dropped at a handoff, even mid-message"""
+        with Simulation() as simulation:
+            server = simulation.server
+            server.handoff = Handoff(server, "unused.sock")  # Never started; only its trigger is used
+            silent, server_side = socket.socketpair()
+            partial, partial_server_side = socket.socketpair()
+            with simulation.quiet():
+                server.start_handler(server_side)
+                server.start_handler(partial_server_side)
+                partial.sendall(create_handshake_message(MessageType.HELLO)[:5])
+                time.sleep(0.2)  # Let the handler read the first half
+                server.handoff.trigger.send(b"!")
+                # The silent connection stops at once; the one halfway through a
+                # message only when it is cut off
+                self.assertFalse(server.wait_for_handlers(0.5))
+                self.assertEqual(server.handler_sockets, {partial_server_side})
+                server.close_handlers()
+                self.assertTrue(server.wait_for_handlers(5))
+            for sock in (silent, partial):
+                sock.settimeout(5)
+                self.assertEqual(sock.recv(100), b"")
+                sock.close()
+
+class TestSocketTuning(unittest.TestCase):
+    def test_listener_drains_and_connections_are_tuned(self):
+        """Test the non-blocking listener and the options on accepted sockets"""
+        tuning = SocketTuning(backlog=16, receive_buffer=65536)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        tuning.configure_listener(listener)
+        with self.assertRaises(BlockingIOError):
+            listener.accept()
+
+        clients = [socket.create_connection(listener.getsockname()) for _ in range(3)]
+        accepted = []
+        while len(accepted) < len(clients):
+            try:
+                accepted.append(listener.accept()[0])
+            except BlockingIOError:
+                time.sleep(0.01)
+        for sock in accepted:
+            tuning.configure_connection(sock)
+            self.assertIsNone(sock.gettimeout())
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+        for sock in clients + accepted + [listener]:
+            sock.close()
+
+class TestTimerWheel(unittest.TestCase):
+    def test_timers_fire_on_their_tick(self):
+        """Test near and far timers, including ones that cascade down levels"""
+        wheel = TimerWheel(tick=1.0, slots=4, levels=3)
+        deadlines = {"a": 1, "b": 3, "c": 9, "d": 40, "e": 100}
+        for key, deadline in deadlines.items():
+            wheel.schedule(key, deadline)
+        fired = {}
+        for now in range(1, 101):
+            for key in wheel.advance(now):
+                fired[key] = now
+        self.assertEqual(fired, deadlines)
+        self.assertEqual(len(wheel), 0)
+
+    def test_cancel_and_reschedule(self):
+        """Test that a key only ever has its latest timer"""
+        wheel = TimerWheel(tick=1.0, slots=4, levels=2)
+        wheel.schedule("a", 2)
+        wheel.schedule("b", 2)
+        wheel.cancel("b")
+        wheel.schedule("a", 6)
+        self.assertEqual(wheel.advance(5), [])
+        self.assertEqual(wheel.advance(6), ["a"])
+
+class TestIdleReaper(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.reaper = IdleReaper(ping_interval=10, idle_timeout=30, clock=lambda: self.now)
+        self.client, self.server_side = socket.socketpair()
+        self.client.settimeout(1)
+
+    def tearDown(self):
+        self.client.close()
+        self.server_side.close()
+
+    def advance(self, seconds):
+        self.now += seconds
+        return self.reaper.check()
+
+    def test_quiet_client_is_pinged_then_dropped(self):
+        """Test a PING after the interval and a disconnect after the timeout"""
+        self.reaper.watch(self.server_side, logged_in=True)
+        self.assertEqual(self.advance(10), [])
+        self.assertEqual(parse_message(MessageReader(self.client).read_message())['type'], "ping")
+        self.assertEqual(self.advance(10), [])
+        self.assertEqual(self.advance(10), [self.server_side])
+        self.assertEqual(self.client.recv(10), b"")
+
+    def test_traffic_keeps_a_client(self):
+        """Test that touched connections are neither pinged nor dropped"""
+        self.reaper.watch(self.server_side, logged_in=True)
+        for _ in range(10):
+            self.now += 6
+            self.reaper.touch(self.server_side)
+            self.assertEqual(self.reaper.check(), [])
+        self.client.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            self.client.recv(10)
+
+    def test_stalled_handshake_is_dropped_without_ping(self):
+        """Test that connections that never log in get no PING"""
+        self.reaper.watch(self.server_side)
+        self.assertEqual(self.advance(29), [])
+        self.assertEqual(self.advance(1), [self.server_side])
+        self.assertEqual(self.client.recv(10), b"")
+
+class TestLogArchiver(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.temp_dir.name
+        self.archiver = LogArchiver(self.directory, retention_days=30, max_archive_bytes=10 ** 6)
+        self.now = datetime(2025, 5, 10, 12, 0, 0)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_log(self, name, text, age_seconds=7200):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        mtime = self.now.timestamp() - age_seconds
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_finished_logs_are_archived(self):
+        """Test that only settled logs from earlier days are compressed"""
+        old = self.write_log("chat_log_2025-05-08.txt", "[10:00:00] alice: hi\n")
+        self.write_log("chat_log_2025-05-09.txt", "[23:59:00] bob: late\n", age_seconds=60)
+        self.write_log("chat_log_2025-05-10.txt", "[11:00:00] bob: today\n")
+        result = self.archiver.run_once(self.now)
+        self.assertEqual(result['archived'], ["chat_log_2025-05-08.txt"])
+        self.assertFalse(os.path.exists(old))
+        with gzip.open(os.path.join(self.directory, "archive", "chat_log_2025-05-08.txt.gz"), 'rt') as f:
+            self.assertEqual(f.read(), "[10:00:00] alice: hi\n")
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["archive", "chat_log_2025-05-09.txt", "chat_log_2025-05-10.txt"])
+
+    def test_retention_by_age_and_size(self):
+        """Test that expired archives go first, then the oldest until under the cap"""
+        self.write_log("chat_log_2025-03-01.txt", "expired\n")
+        self.write_log("debug_2025-05-01.log", os.urandom(600 * 1024).hex())
+        self.write_log("debug_2025-05-02.log", os.urandom(600 * 1024).hex())
+        result = self.archiver.run_once(self.now)
+        self.assertEqual(len(result['archived']), 3)
+        self.assertEqual(result['deleted'], ["chat_log_2025-03-01.txt.gz", "debug_2025-05-01.log.gz"])
+        self.assertEqual(os.listdir(os.path.join(self.directory, "archive")), ["debug_2025-05-02.log.gz"])
+
+    def test_search_index_counts_toward_cap(self):
+        """Test that index journals count toward the cap and lose the days that are pruned"""
+        index = SearchIndex(os.path.join(self.directory, "search_index.jsonl"))
+        self.archiver.search_index = index
+        try:
+            for date in ("2025-05-01", "2025-05-02", "2025-05-03"):
+                self.write_log(f"chat_log_{date}.txt", f"[10:00:00] alice: {date}\n")
+                index.add("alice", "x" * (340 * 1024), "10:00:00", date)
+            result = self.archiver.run_once(self.now)
+            # Over the 1 MB cap by the index alone
+            self.assertEqual(result['deleted'], ["chat_log_2025-05-01.txt.gz"])
+            self.assertEqual(result['unindexed'], 1)
+            self.assertEqual(sorted(journal_date_sizes(index.path)), ["2025-05-02", "2025-05-03"])
+            self.assertEqual(self.archiver.run_once(self.now)['deleted'], [])
+        finally:
+            index.close()
+
+    def test_history_reads_live_and_archived_logs(self):
+        """Test that chat history streams archived logs alongside live ones"""
+        self.write_log("chat_log_2025-05-08.txt", "[10:00:00] alice: hi: there\n")
+        self.archiver.run_once(self.now)
+        self.write_log("chat_log_2025-05-10.txt", "[11:00:00] bob: hello\nnot a message\n")
+        self.assertEqual(list(self.archiver.chat_history()), [
+            ("2025-05-08", "10:00:00", "alice", "hi: there"),
+            ("2025-05-10", "11:00:00", "bob", "hello"),
+        ])
+
+class TestEventCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.emitted = []
+        self.coalescer = EventCoalescer(lambda sock, event: self.emitted.append((sock, event.content)),
+                                        window=1.0, clock=lambda: self.now)
+
+    def typing(self, sock, typing: bool):
+        self.coalescer.submit(sock, EphemeralEvent.decode(create_typing_message(sock, typing)))
+
+    def test_burst_is_emitted_once_per_window(self):
+        """Test that repeats within a window are dropped and later ones refresh"""
+        for _ in range(100):
+            self.typing("alice", True)
+        self.assertEqual(self.emitted, [("alice", "start")])
+        self.now = 1.5
+        self.assertEqual(self.coalescer.check(), 0)
+        self.typing("alice", True)
+        self.assertEqual(self.emitted, [("alice", "start"), ("alice", "start")])
+
+    def test_last_change_goes_out_when_window_closes(self):
+        """Test trailing delivery of a change, and that a flicker back costs nothing"""
+        self.typing("alice", True)
+        self.typing("alice", False)
+        self.typing("bob", True)
+        self.typing("bob", False)
+        self.typing("bob", True)
+        self.now = 0.5
+        self.assertEqual(self.coalescer.check(), 0)
+        self.now = 1.0
+        self.assertEqual(self.coalescer.check(), 1)
+        self.assertEqual(self.emitted, [("alice", "start"), ("bob", "start"), ("alice", "stop")])
+
+    def test_forgotten_connection_has_nothing_pending(self):
+        self.typing("alice", True)
+        self.typing("alice", False)
+        self.coalescer.forget("alice")
+        self.now = 2.0
+        self.assertEqual(self.coalescer.check(), 0)
+        self.assertEqual(self.coalescer.last, {})
+
+class WriteLog:
+    """Stands in for a client socket, recording each write in a log shared by all of them"""
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+        self.shut_down = False
+
+    def sendall(self, data):
+        self.log.append((self.name, data))
+
+    def shutdown(self, how):
+        self.shut_down = True
+
+class TestOutboundScheduler(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        self.scheduler = OutboundScheduler(threads=0, quantum=10)
+        self.alice = WriteLog("alice", self.log)
+        self.bob = WriteLog("bob", self.log)
+        self.scheduler.register(self.alice)
+        self.scheduler.register(self.bob)
+
+    def test_lanes_go_out_in_priority_order(self):
+        """Test that a connection's control and system messages overtake its chat"""
+        self.scheduler.send(self.alice, b"chat1;", CHAT)
+        self.scheduler.send(self.alice, b"join;", SYSTEM)
+        self.scheduler.send(self.alice, b"ack;", CONTROL)
+        self.scheduler.send(self.alice, b"chat2;", CHAT)
+        self.scheduler.flush()
+        self.assertEqual(b"".join(data for _, data in self.log), b"ack;join;chat1;chat2;")
+
+    def test_control_is_not_stuck_behind_other_chat(self):
+        """Test that control for one client is served before another client's chat backlog"""
+        for i in range(5):
+            self.scheduler.send(self.alice, b"chat%d;" % i, CHAT)
+        self.scheduler.send(self.bob, b"ack;", CONTROL)
+        self.scheduler.flush()
+        self.assertEqual(self.log[0], ("bob", b"ack;"))
+        self.assertEqual(b"".join(data for _, data in self.log[1:]),
+                         b"chat0;chat1;chat2;chat3;chat4;")
+
+    def test_chat_is_shared_by_weight(self):
+        """Test deficit round robin between connections with different weights"""
+        self.scheduler.set_weight(self.alice, 2)
+        for _ in range(8):
+            self.scheduler.send_many([self.alice, self.bob], b"12345", CHAT)
+        self.scheduler.flush()
+        turns = [(name, len(data)) for name, data in self.log]
+        self.assertEqual(turns[:4], [("alice", 20), ("bob", 10), ("alice", 20), ("bob", 10)])
+
+    def test_slow_connection_is_dropped(self):
+        """Test that a connection too far behind is shut down and its queue discarded"""
+        scheduler = OutboundScheduler(threads=0, max_queued_bytes=12)
+        scheduler.register(self.alice)
+        scheduler.send(self.alice, b"chat1;", CHAT)
+        scheduler.send(self.alice, b"chat2;", CHAT)
+        self.assertFalse(self.alice.shut_down)
+        scheduler.send(self.alice, b"chat3;", CHAT)
+        self.assertTrue(self.alice.shut_down)
+        scheduler.flush()
+        self.assertEqual(self.log, [])
+        self.assertEqual(scheduler.pending_chat, 0)
+
+    def test_without_priority_arrival_order_is_kept(self):
+        """Test the single-lane mode used for comparison"""
+        scheduler = OutboundScheduler(threads=0, priority=False)
+        scheduler.register(self.alice)
+        scheduler.send(self.alice, b"chat;", CHAT)
+        scheduler.send(self.alice, b"ack;", CONTROL)
+        scheduler.flush()
+        self.assertEqual(b"".join(data for _, data in self.log), b"chat;ack;")
+
+    def test_control_fast_path_never_blocks(self):
+        """Test that a control send to a client that isn't reading returns at once and still arrives whole"""
+        scheduler = OutboundScheduler(threads=1)
+        scheduler.start()
+        server_side, client = socket.socketpair()
+        scheduler.register(server_side)
+        big = b"p" * (4 * 1024 * 1024 - 10) + b";"
+        try:
+            # In a thread, so a blocking send fails the test instead of hanging it
+            sending = threading.Thread(target=lambda: (scheduler.send(server_side, big),
+                                                       scheduler.send(server_side, b"ping;")))
+            sending.start()
+            sending.join(1.0)
+            self.assertFalse(sending.is_alive(), "send blocked on a client that isn't reading")
+            received = bytearray()
+            client.settimeout(5)
+            while len(received) < len(big) + 5:
+                received += client.recv(65536)
+            self.assertEqual(bytes(received), big + b"ping;")
+        finally:
+            scheduler.stop()
+            server_side.close()
+            client.close()
+
+    def test_stalled_clients_do_not_hold_the_senders(self):
+        """Test that clients that stop reading can't keep the senders from everyone else"""
+        scheduler = OutboundScheduler(threads=2)
+        scheduler.start()
+        stalled = [socket.socketpair() for _ in range(3)]
+        healthy_server, healthy_client = socket.socketpair()
+        for server_side, _ in stalled:
+            scheduler.register(server_side)
+        scheduler.register(healthy_server)
+        big = b"c" * (1024 * 1024 - 1) + b";"
+        try:
+            scheduler.send_many([server_side for server_side, _ in stalled], big, CHAT)
+            time.sleep(0.2)  # Let the senders fill the stalled sockets
+            scheduler.send(healthy_server, b"hello;", CHAT)
+            healthy_client.settimeout(2)
+            self.assertEqual(healthy_client.recv(64), b"hello;")
+
+            # A stalled client that starts reading again gets its data whole
+            reader = stalled[0][1]
+            reader.settimeout(5)
+            received = bytearray()
+            while len(received) < len(big):
+                received += reader.recv(65536)
+            self.assertEqual(bytes(received), big)
+        finally:
+            # Closing the readers fails the pending sends, so stop() can finish
+            for server_side, client in stalled:
+                client.close()
+            scheduler.stop()
+            for server_side, _ in stalled:
+                server_side.close()
+            healthy_server.close()
+            healthy_client.close()
+
+class TestSharedFanout(unittest.TestCase):
+    def setUp(self):
+        self.fanout = SharedFanout(helpers=2, ring_size=4096)
+        self.pairs = [socket.socketpair() for _ in range(3)]
+        for server_end, client_end in self.pairs:
+            client_end.settimeout(5)
+            self.fanout.register(server_end)
+
+    def tearDown(self):
+        self.fanout.stop()
+        for server_end, client_end in self.pairs:
+            server_end.close()
+            client_end.close()
+
+    def received(self, index: int, size: int) -> bytes:
+        return self.read_exactly(self.pairs[index][1], size)
+
+    def read_exactly(self, sock, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            data += sock.recv(size - len(data))
+        return data
+
+    def test_helpers_let_go_of_inherited_sockets(self):
+        """Test that closing a socket opened before the helpers started still hangs up on the peer"""
+        # Like a listener and clients taken over from a previous server process
+        server_end, client_end = socket.socketpair()
+        fanout = SharedFanout(helpers=1, ring_size=4096)
+        try:
+            # Any frame through the helper shows it is past its startup
+            fanout.register(self.pairs[0][0])
+            fanout.send(self.pairs[0][0], b"ready;")
+            self.assertEqual(self.received(0, 6), b"ready;")
+            server_end.close()
+            client_end.settimeout(5)
+            self.assertEqual(client_end.recv(1), b"")
+        finally:
+            fanout.stop()
+            client_end.close()
+
+    def test_broadcast_reaches_members_except_sender(self):
+        """Test that broadcasts skip the sender and clients not yet logged in"""
+        self.fanout.add_member(self.pairs[0][0])
+        self.fanout.add_member(self.pairs[1][0])
+        self.fanout.broadcast(b"hello;", exclude=self.pairs[0][0])
+        self.fanout.flush()
+        self.assertEqual(self.received(1, 6), b"hello;")
+        for index in (0, 2):
+            self.pairs[index][1].setblocking(False)
+            with self.assertRaises(BlockingIOError):
+                self.pairs[index][1].recv(16)
+
+    def test_unicast_and_ring_reuse(self):
+        """Test that frames keep their order while the ring wraps many times"""
+        expected = b"".join(b"frame %04d;" % i for i in range(1000))
+        result = []
+        reader = threading.Thread(target=lambda: result.append(self.received(2, len(expected))))
+        reader.start()
+        for i in range(1000):
+            self.fanout.send(self.pairs[2][0], b"frame %04d;" % i)
+        reader.join()
+        self.assertEqual(result, [expected])
+
+    def test_client_that_is_not_reading_is_cut_off(self):
+        """Test that a client that stops reading is shut down without holding up the others"""
+        fanout = SharedFanout(helpers=1, ring_size=4096, max_backlog=64 * 1024)
+        stalled, healthy = socket.socketpair(), socket.socketpair()
+        try:
+            for server_end, _ in (stalled, healthy):
+                fanout.register(server_end)
+                fanout.add_member(server_end)
+            frame = b"x" * 99 + b";"
+            result = []
+            healthy[1].settimeout(10)
+            reader = threading.Thread(target=lambda: result.append(
+                len(self.read_exactly(healthy[1], 5000 * len(frame)))))
+            reader.start()
+            # In a thread, so a helper stuck on the stalled client fails the test instead of hanging it
+            sending = threading.Thread(target=lambda: [fanout.broadcast(frame) for _ in range(5000)])
+            sending.start()
+            sending.join(10)
+            self.assertFalse(sending.is_alive(), "broadcasts stalled behind a client that isn't reading")
+            reader.join(10)
+            self.assertEqual(result, [5000 * len(frame)])
+            # The server's end of the stalled connection sees the shutdown
+            stalled[0].settimeout(5)
+            while stalled[0].recv(65536):
+                pass
+        finally:
+            fanout.stop()
+            for sock in (*stalled, *healthy):
+                sock.close()
+
+    def test_forgotten_client_gets_nothing(self):
+        """Test that a removed client is no longer sent broadcasts"""
+        self.fanout.add_member(self.pairs[0][0])
+        self.fanout.add_member(self.pairs[1][0])
+        self.fanout.forget(self.pairs[1][0])
+        self.fanout.broadcast(b"after;")
+        self.fanout.flush()
+        self.assertEqual(self.received(0, 6), b"after;")
+        self.pairs[1][1].setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            self.pairs[1][1].recv(16)
+
+class TestSimulation(unittest.TestCase):
+    def setUp(self):
+        self.simulation = Simulation(ping_interval=10, idle_timeout=30)
+
+    def tearDown(self):
+        self.simulation.close()
+
+    def test_chat_is_broadcast_and_acknowledged(self):
+        """Test that other clients get the message and the sender an ACK, once per retry"""
+        alice = self.simulation.connect("alice")
+        bob = self.simulation.connect("bob")
+        alice.chat("hello", msg_id="m1")
+        alice.chat("hello", msg_id="m1")
+        self.assertEqual(self.simulation.run(), 2)
+        self.assertEqual([msg["content"] for msg in bob.messages(MessageType.CHAT)], ["hello"])
+        self.assertEqual([msg["seq"] for msg in alice.messages(MessageType.ACK)], [1, 1])
+        self.assertEqual(alice.messages(MessageType.CHAT), [])
+
+    def test_retry_window_follows_the_virtual_clock(self):
+        """Test that a message ID is forgotten once the dedup window passes in virtual time"""
+        alice = self.simulation.connect("alice")
+        bob = self.simulation.connect("bob")
+        alice.chat("hello", msg_id="m1")
+        self.simulation.run()
+        for _ in range(7):
+            self.simulation.advance(10)
+            self.simulation.run()
+        alice.chat("hello", msg_id="m1")
+        self.simulation.run()
+        self.assertEqual([msg["content"] for msg in bob.messages(MessageType.CHAT)], ["hello", "hello"])
+        self.assertEqual([msg["seq"] for msg in alice.messages(MessageType.ACK)], [1, 2])
+
+    def test_messages_are_handled_in_rounds(self):
+        """Test the deterministic order: one message per client per round"""
+        alice = self.simulation.connect("alice")
+        bob = self.simulation.connect("bob")
+        carol = self.simulation.connect("carol")
+        for i in range(2):
+            alice.chat(f"a{i}")
+        bob.chat("b0")
+        self.simulation.run()
+        self.assertEqual([msg["content"] for msg in carol.messages(MessageType.CHAT)],
+                         ["a0", "b0", "a1"])
+
+    def test_invalid_chat_is_not_broadcast(self):
+        """Test that a message failing validation is dropped without a sequence number"""
+        alice = self.simulation.connect("alice")
+        bob = self.simulation.connect("bob")
+        alice.send(b'{"type": "chat", "username": "alice", "content": null, "timestamp": "t", "msg_id": "m1"}\n')
+        alice.chat("ok", msg_id="m2")
+        self.simulation.run()
+        self.assertEqual([msg["content"] for msg in bob.messages(MessageType.CHAT)], ["ok"])
+        self.assertEqual([msg["seq"] for msg in alice.messages(MessageType.ACK)], [1])
+
+    def test_malformed_frames_are_dropped(self):
+        """Test that frames with the wrong shape or field types are logged and skipped"""
+        alice = self.simulation.connect("alice")
+        bob = self.simulation.connect("bob")
+        for frame in (b'[1]', b'"chat"', b'{"type": ["chat"]}', b'{"type": "search"}',
+                      b'{"type": "search", "content": 5}', b'{"type": "roster", "content": {}}',
+                      b'{"type": "file_offer", "content": "a.txt", "size": "10"}',
+                      b'{"type": "file_offer", "content": null, "size": 10}'):
+            alice.send(frame + b'\n')
+        alice.send(create_message(MessageType.SEARCH, "alice", "hello"))
+        alice.chat("still here")
+        self.simulation.run()
+        self.assertTrue(alice.connected)
+        self.assertEqual(alice.messages(MessageType.ERROR), [])
+        self.assertEqual(len(alice.messages(MessageType.SEARCH)), 1)
+        self.assertEqual(len(alice.messages(MessageType.ROSTER)), 1)
+        self.assertEqual([msg["content"] for msg in bob.messages(MessageType.CHAT)], ["still here"])
+
+    def test_clients_cannot_forge_messages(self):
+        """Test that only chat is accepted from clients, under their own name, with no extra fields"""
+        alice = self.simulation.connect("alice")
+        bob = self.simulation.connect("bob")
+        self.simulation.run()
+        alice.send(create_message(MessageType.SYSTEM, "System", "the server is shutting down"))
+        alice.send(create_message(MessageType.ERROR, "System", "bad password"))
+        alice.send(create_message(MessageType.CHAT, "bob", "I agree"))
+        alice.send(b'{"type": "chat", "username": "alice", "content": "hi", "timestamp": "t", "html": "<b>"}\n')
+        alice.chat("as is")
+        self.simulation.run()
+        self.assertNotIn("the server is shutting down",
+                         [msg["content"] for msg in bob.messages(MessageType.SYSTEM)])
+        self.assertEqual(bob.messages(MessageType.ERROR), [])
+        chats = bob.messages(MessageType.CHAT)
+        self.assertEqual([(msg["username"], msg["content"]) for msg in chats],
+                         [("alice", "I agree"), ("alice", "hi"), ("alice", "as is")])
+        self.assertNotIn("html", chats[1])
+
+    def test_virtual_clock_drops_silent_clients(self):
+        """Test that only the client that ignores PINGs is dropped, and everyone is told"""
+        alice = self.simulation.connect("alice")
+        self.simulation.connect("bob", answer_pings=False)
+        self.assertEqual(self.simulation.advance(10), [])
+        self.assertEqual(self.simulation.advance(10), [])
+        self.assertEqual(self.simulation.advance(10), ["bob"])
+        self.assertEqual(list(self.simulation.clients), ["alice"])
+        self.assertEqual(self.simulation.server.roster.snapshot()[1], ["alice"])
+        self.assertIn("bob left the chat",
+                      [msg["content"] for msg in alice.messages(MessageType.SYSTEM)])
+
+    def test_typing_is_coalesced_and_never_logged(self):
+        """Test that a typing burst reaches the others once, under the sender's name, and leaves no trace"""
+        alice = self.simulation.connect("alice")
+        bob = self.simulation.connect("bob")
+        self.simulation.run()
+        log_dir = self.simulation.server.log_dir
+        logged = {name: os.path.getsize(os.path.join(log_dir, name)) for name in os.listdir(log_dir)}
+        for _ in range(50):
+            alice.send(create_typing_message("mallory", True))
+        alice.send(create_typing_message("alice", False))
+        self.assertEqual(self.simulation.run(), 51)
+        typing = [(msg["username"], msg["content"]) for msg in bob.messages(MessageType.TYPING)]
+        self.assertEqual(typing, [("alice", "start")])
+        self.simulation.advance(1)
+        typing = [(msg["username"], msg["content"]) for msg in bob.messages(MessageType.TYPING)]
+        self.assertEqual(typing, [("alice", "start"), ("alice", "stop")])
+        self.assertEqual(alice.messages(MessageType.TYPING), [])
+        self.assertEqual({name: os.path.getsize(os.path.join(log_dir, name)) for name in os.listdir(log_dir)},
+                         logged)
+        self.assertEqual(len(self.simulation.server.search_index), 0)
+
+class TestWorkers(unittest.TestCase):
+    """Two workers linked over a UNIX socket bus and writing one logs directory, as run_workers sets up"""
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        base = self.temp_dir.name
+        self.log_dir = os.path.join(base, 'logs')
+        os.makedirs(self.log_dir)
+        bus_paths = [os.path.join(base, f"worker{i}.sock") for i in range(2)]
+        self.workers = []
+        for i in range(2):
+            os.makedirs(os.path.join(base, f"worker{i}"))
+            worker = Simulation(directory=os.path.join(base, f"worker{i}"), log_dir=self.log_dir)
+            worker.server.enable_federation(f"worker{i}", bus_paths[i], bus_paths[:i], shared_logs=True)
+            self.workers.append(worker)
+        self.wait_for(lambda: all(worker.server.federation.links for worker in self.workers))
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.server.federation.stop()
+            worker.close()
+        self.temp_dir.cleanup()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "Timed out waiting for the other worker")
+            time.sleep(0.01)
+            for worker in self.workers:
+                worker.deliver()
+
+    def test_each_message_is_logged_once(self):
+        """Test that only the worker a message started on writes it to the shared log"""
+        alice = self.workers[0].connect("alice")
+        bob = self.workers[1].connect("bob")
+        alice.chat("hello")
+        self.workers[0].run()
+        self.wait_for(lambda: bob.messages(MessageType.CHAT))
+        self.workers[0].disconnect("alice")
+        self.wait_for(lambda: "alice left the chat" in
+                      [msg["content"] for msg in bob.messages(MessageType.SYSTEM)])
+        log_text = "".join(open(os.path.join(self.log_dir, name), encoding='utf-8').read()
+                           for name in os.listdir(self.log_dir) if name.startswith("chat_log_"))
+        self.assertEqual(log_text.count("alice: hello"), 1)
+        self.assertEqual(log_text.count("alice left the chat"), 1)
+
+class TestRoster(unittest.TestCase):
+    def test_roster_versions_only_change_on_presence(self):
+        """Test that duplicate sessions don't produce extra deltas"""
+        roster = Roster()
+        self.assertEqual(roster.join("alice"), 1)
+        self.assertIsNone(roster.join("alice"))
+        self.assertEqual(roster.join("bob"), 2)
+        self.assertIsNone(roster.leave("alice"))
+        self.assertEqual(roster.leave("alice"), 3)
+        self.assertIsNone(roster.leave("nobody"))
+        self.assertEqual(roster.snapshot(), (3, ["bob"]))
+
+    def test_roster_snapshot_message(self):
+        """Test roster snapshot encoding"""
+        data = parse_message(create_roster_message(4, ["alice", "bob"]))
+        self.assertEqual(data['type'], MessageType.ROSTER.value)
+        self.assertEqual(data['users'], ["alice", "bob"])
+        self.assertEqual(data['version'], 4)
+
+    def test_view_applies_deltas_in_order(self):
+        """Test the client view against snapshot plus deltas"""
+        view = RosterView()
+        # Deltas that arrive before the snapshot are held back
+        self.assertTrue(view.apply_delta(3, "join", "carol"))
+        self.assertTrue(view.apply_snapshot(2, ["alice", "bob"]))
+        self.assertEqual(view.members, {"alice", "bob", "carol"})
+
+        self.assertTrue(view.apply_delta(3, "join", "carol"))  # Stale, ignored
+        self.assertTrue(view.apply_delta(4, "leave", "alice"))
+        self.assertEqual(view.members, {"bob", "carol"})
+        self.assertEqual(view.version, 4)
+
+    def test_view_detects_gap(self):
+        """Test that a missing delta asks for a new snapshot"""
+        view = RosterView()
+        view.apply_snapshot(1, ["alice"])
+        self.assertFalse(view.apply_delta(3, "join", "bob"))
+        self.assertIsNone(view.version)
+        self.assertTrue(view.apply_snapshot(2, ["alice", "carol"]))
+        self.assertEqual(view.members, {"alice", "bob", "carol"})
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "search_index.jsonl")
+        self.index = SearchIndex(self.path)
+        self.index.add("alice", "deploy the server tonight", "09:00:00", "2025-05-07")
+        self.index.add("bob", "server server is down", "10:00:00", "2025-05-08")
+        self.index.add("alice", "Server back up after the deploy", "11:00:00", "2025-05-08")
+
+    def tearDown(self):
+        self.index.close()
+        self.directory.cleanup()
+
+    def test_all_terms_must_match_and_rank(self):
+        """Test conjunctive matching and tf-idf ordering"""
+        results = self.index.search("server deploy")
+        self.assertEqual([r['id'] for r in results], [2, 0])
+        self.assertEqual(self.index.search("server")[0]['username'], "bob")
+        self.assertEqual(self.index.search("missing words"), [])
+
+    def test_filters(self):
+        """Test from: and date: filters"""
+        results = self.index.search("server from:Alice date:2025-05-08")
+        self.assertEqual([r['content'] for r in results], ["Server back up after the deploy"])
+        self.assertEqual(len(self.index.search("from:alice")), 2)
+        self.assertEqual(len(self.index.search("date:2025-05-08")), 2)
+        self.assertEqual(self.index.search("server date:1999-01-01"), [])
+
+    def test_index_survives_restart(self):
+        """Test that the journal rebuilds the same index, dropping a torn write"""
+        self.index.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'{"date": "2025-05-0')
+        self.index = SearchIndex(self.path)
+        self.assertEqual(len(self.index), 3)
+        self.index.add("carol", "deploy done")
+        self.assertEqual([r['id'] for r in self.index.search("deploy")][0], 3)
+
+    def test_compact_drops_old_days(self):
+        """Test that compaction rewrites the journal without days before the cutoff"""
+        self.assertEqual(self.index.compact("2025-05-08"), 1)
+        self.assertEqual(self.index.compact("2025-05-08"), 0)
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual([r['content'] for r in self.index.search("deploy")], ["Server back up after the deploy"])
+        self.assertEqual(journal_date_sizes(self.path), {"2025-05-08": os.path.getsize(self.path)})
+        self.index.add("carol", "deploy done", "12:00:00", "2025-05-09")
+        self.index.close()
+        self.index = SearchIndex(self.path)
+        self.assertEqual(len(self.index.search("deploy")), 2)
+
+    def test_search_results_display(self):
+        """Test how search results are shown in the clients"""
+        text = format_message_for_display(
+            parse_message(create_search_results("deploy", self.index.search("deploy")))
+        )
+        self.assertIn("Search results for 'deploy'", text)
+        self.assertIn("2025-05-07 [09:00:00] alice: deploy the server tonight", text)
+        empty = parse_message(create_search_results("nothing", []))
+        self.assertIn("No matches", format_message_for_display(empty))
+
+class TestFileTransfer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = FileStore(os.path.join(self.directory.name, "uploads"))
+        self.uploaded = threading.Event()
+        self.server = FileServer(
+            self.store, "127.0.0.1", 0, on_upload=lambda file_id, meta: self.uploaded.set()
+        )
+        self.server.start()
+        self.address = ("127.0.0.1", self.server.port)
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def write_source(self, data):
+        path = os.path.join(self.directory.name, "report.bin")
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_upload_then_download(self):
+        """Test a multi-chunk round trip through the file port"""
+        data = os.urandom(300000)
+        file_id = self.store.offer("alice", "report.bin", len(data))
+        upload_file(self.address, file_id, self.write_source(data), chunk_size=65536)
+        self.assertTrue(self.uploaded.wait(5))
+        self.assertTrue(self.store.lookup(file_id)["complete"])
+
+        path = download_file(self.address, file_id, os.path.join(self.directory.name, "downloads"))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_unknown_or_unfinished_files(self):
+        """Test that only completed uploads can be downloaded"""
+        downloads = os.path.join(self.directory.name, "downloads")
+        with self.assertRaises(FileNotFoundError):
+            download_file(self.address, "0" * 32, downloads)
+        file_id = self.store.offer("alice", "report.bin", 10)
+        with self.assertRaises(FileNotFoundError):
+            download_file(self.address, file_id, downloads)
+        self.assertIsNone(self.store.lookup("../../etc/passwd"))
+        self.assertIsNone(self.store.offer("alice", "huge.bin", self.store.max_size + 1))
+
+    def test_oversized_upload_is_rejected(self):
+        """Test that a client can't send more than it offered"""
+        file_id = self.store.offer("alice", "report.bin", 10)
+        try:
+            upload_file(self.address, file_id, self.write_source(b"x" * 20))
+        except OSError:
+            pass  # The server may hang up before the whole body is sent
+        self.assertFalse(self.uploaded.wait(0.5))
+        self.assertFalse(self.store.lookup(file_id)["complete"])
+
+    def test_nodes_on_neighbouring_ports(self):
+        """Test that a server's file port doesn't take the next node's chat port"""
+        servers = []
+        try:
+            for port in (9870, 9871):
+                os.makedirs(os.path.join(self.directory.name, str(port)))
+                servers.append(start_server(port, cwd=os.path.join(self.directory.name, str(port))))
+            for port in (9870, 9871):
+                with socket.create_connection(("127.0.0.1", port), timeout=10) as sock:
+                    reader = MessageReader(sock)
+                    sock.sendall(create_handshake_message(MessageType.HELLO))
+                    self.assertEqual(parse_message(reader.read_message())["type"], MessageType.HELLO_ACK.value)
+                    sock.sendall(create_message(MessageType.USERNAME, "alice", "alice"))
+                    ack = parse_message(reader.read_message())
+                    self.assertEqual(ack["type"], MessageType.USERNAME_ACK.value)
+                    self.assertNotIn(ack["file_port"], (9870, 9871))
+            self.assertEqual([server.poll() for server in servers], [None, None])
+        finally:
+            stop_servers(servers)
+
+    def test_restart_with_client_connected(self):
+        """Test that a stopped server's port can be bound again straight away"""
+        os.makedirs(os.path.join(self.directory.name, "restart"))
+        cwd = os.path.join(self.directory.name, "restart")
+        server = start_server(9872, cwd=cwd)
+        try:
+            sock, reader = connect_client("127.0.0.1", 9872, "alice")
+        finally:
+            stop_servers([server])
+        # Reading to EOF before closing leaves the server's side in TIME_WAIT
+        while reader.read_message() is not None:
+            pass
+        sock.close()
+        server = start_server(9872, cwd=cwd)
+        try:
+            sock, _ = connect_client("127.0.0.1", 9872, "alice")
+            sock.close()
+            self.assertIsNone(server.poll())
+        finally:
+            stop_servers([server])
+
+class RecordingServer:
+    """Just enough of ChatServer for Federation to deliver into"""
+    def __init__(self):
+        self.roster = Roster()
+        self.presence = []
+        self.broadcasts = []
+
+    def announce_presence(self, version, action, username):
+        if version is not None:
+            self.presence.append((action, username))
+
+    def broadcast_message(self, message, sender_socket=None, relay=True, log=True):
+        self.broadcasts.append(message.to_dict())
+
+    def broadcast_event(self, sender_socket, event, relay=True):
+        self.broadcasts.append(event.to_dict())
+
+class RecordingLink:
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(parse_message(message))
+
+class TestFederation(unittest.TestCase):
+    def setUp(self):
+        self.server = RecordingServer()
+        self.federation = Federation(self.server, "a", ("127.0.0.1", 0))
+        self.from_b = RecordingLink("b")
+        self.to_c = RecordingLink("c")
+        self.federation.links = {"b": self.from_b, "c": self.to_c}
+
+    def deliver(self, message):
+        self.federation.handle_peer_message(self.from_b, memoryview(message))
+
+    def test_relay_is_delivered_once_and_not_forwarded(self):
+        """Test duplicate suppression on (origin, seq); in a full mesh the origin reaches every peer itself"""
+        chat = create_message(MessageType.CHAT, "bob", "hi").rstrip(b"\n").decode('utf-8')
+        relay = create_relay_message("b", 1, "chat", frame=chat)
+        self.deliver(relay)
+        self.deliver(relay)
+        self.assertEqual([m['content'] for m in self.server.broadcasts], ["hi"])
+        self.assertEqual(self.to_c.sent, [])
+        self.assertEqual(self.from_b.sent, [])
+
+        # Our own events coming back around are dropped
+        self.deliver(create_relay_message("a", 1, "chat", frame=chat))
+        self.assertEqual(len(self.server.broadcasts), 1)
+
+    def test_typing_events_are_relayed(self):
+        """Test that ephemeral events cross nodes, and invalid ones are dropped"""
+        event = create_typing_message("bob", True).rstrip(b"\n").decode('utf-8')
+        self.deliver(create_relay_message("b", 1, "event", frame=event))
+        self.deliver(create_relay_message("b", 2, "event", frame='{"type": "typing"}'))
+        self.assertEqual(self.server.broadcasts, [{"type": "typing", "username": "bob", "content": "start"}])
+        self.assertEqual(self.to_c.sent, [])
+
+    def test_presence_uses_absolute_session_counts(self):
+        """Test that replayed or stale presence can't skew the roster"""
+        self.deliver(create_relay_message("b", 1, "sync", sessions={"bob": 1}))
+        self.deliver(create_relay_message("b", 2, "presence", username="bob", sessions=2))
+        self.deliver(create_relay_message("b", 1, "presence", username="bob", sessions=0))
+        self.assertEqual(self.server.roster.sessions, {"bob": 2})
+        self.assertEqual(self.server.presence, [("join", "bob")])
+
+        self.deliver(create_relay_message("b", 3, "sync", sessions={"carol": 1}))
+        self.assertEqual(self.server.roster.sessions, {"carol": 1})
+
+    def test_missing_mesh_link_is_reported(self):
+        """Test that a node linked to a peer's peer is quiet, and one that isn't is told"""
+        self.deliver(create_relay_message("b", 1, "links", nodes=["a", "c"]))
+        self.assertEqual(self.federation.check_mesh(), set())
+        self.deliver(create_relay_message("b", 2, "links", nodes=["a", "c", "d"]))
+        self.assertEqual(self.federation.check_mesh(), {"d"})
+
+    def test_stalled_peer_never_blocks_senders(self):
+        """Test that sends to a peer that stops reading queue up, then fail once it is too far behind"""
+        ours, theirs = socket.socketpair()
+        link = PeerLink(ours, "b", "a", max_queued_bytes=1024 * 1024)
+        link.start()
+        message = b"x" * 1023 + b"\n"
+        start = time.monotonic()
+        with self.assertRaises(OSError):
+            for _ in range(100000):
+                link.send(message)
+        self.assertLess(time.monotonic() - start, 5)
+        link.close()
+        theirs.close()
+
+    def test_dropped_link_takes_users_offline(self):
+        """Test cleanup when a node goes away"""
+        self.deliver(create_relay_message("b", 1, "sync", sessions={"bob": 1}))
+        self.federation.drop_link(self.from_b)
+        self.assertNotIn("b", self.federation.links)
+        self.assertEqual(self.server.roster.snapshot(), (2, []))
+        self.assertIn("Lost server node b", self.server.broadcasts[-1]['content'])
+
 if __name__ == '__main__':
-    unittest.main() 
\ No newline at end of file
+    unittest.main()
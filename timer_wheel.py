@@ -0,0 +1,72 @@
+import math
+
+class TimerWheel:
+    """Hierarchical timing wheel.
+
+    Level 0 has one slot per tick; each slot on level n spans a full turn
+    of level n - 1. A timer is filed on the lowest level whose range covers
+    it, and moves down a level each time the wheel below completes a turn.
+    Scheduling and cancelling are O(1), and each tick only touches the slot
+    that comes due, however many timers are pending. Timers past the range
+    of the top level wait in its slots and are refiled until they are due.
+    """
+    def __init__(self, tick: float = 1.0, slots: int = 64, levels: int = 4, start: float = 0.0):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.current = int(start / tick)  # Ticks processed so far
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.timers = {}  # key -> (due tick, level, slot)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def schedule(self, key, deadline: float):
+        """Fire key at deadline (on the same clock as advance), replacing any earlier timer"""
+        self.cancel(key)
+        self._file(key, max(math.ceil(deadline / self.tick), self.current + 1))
+
+    def cancel(self, key):
+        entry = self.timers.pop(key, None)
+        if entry is not None:
+            _, level, slot = entry
+            self.wheels[level][slot].discard(key)
+
+    def _file(self, key, due: int):
+        level = 0
+        span = self.slots
+        while due - self.current >= span and level < self.levels - 1:
+            level += 1
+            span *= self.slots
+        slot = (due // self.slots ** level) % self.slots
+        self.wheels[level][slot].add(key)
+        self.timers[key] = (due, level, slot)
+
+    def advance(self, now: float) -> list:
+        """Move the wheel up to now and return the keys whose timers fired"""
+        expired = []
+        target = int(now / self.tick)
+        while self.current < target:
+            self.current += 1
+            # Each completed turn of a level pulls the next slot of the level above down
+            for level in range(1, self.levels):
+                width = self.slots ** level
+                if self.current % width:
+                    break
+                slot = (self.current // width) % self.slots
+                keys, self.wheels[level][slot] = self.wheels[level][slot], set()
+                for key in keys:
+                    self._file(key, self.timers[key][0])
+            slot = self.current % self.slots
+            keys, self.wheels[0][slot] = self.wheels[0][slot], set()
+            for key in keys:
+                due = self.timers[key][0]
+                if due <= self.current:
+                    del self.timers[key]
+                    expired.append(key)
+                else:
+                    self._file(key, due)
+        return expired